@@ -2,7 +2,9 @@
 # This software is distributed under the two-clause BSD license.
 # Copyright (c) The django-ldapdb project
 
+import asyncio
 import time
+from unittest import mock
 
 import factory
 import factory.django
@@ -13,6 +15,7 @@ from django.conf import settings
 from django.contrib.auth import hashers as auth_hashers
 from django.contrib.auth import models as auth_models
 from django.core import management
+from django.core.exceptions import ImproperlyConfigured
 from django.db import connections
 from django.db.models import Count, Q
 from django.test import TestCase
@@ -20,7 +23,10 @@ from django.utils import timezone
 
 from examples.models import (ConcreteGroup, FooGroup, LdapGroup,
                              LdapMultiPKRoom, LdapUser)
-from ldapdb.backends.ldap.compiler import SQLCompiler, query_as_ldap
+from ldapdb.backends.ldap import pool as ldapdb_pool
+from ldapdb.backends.ldap.compiler import (BulkOperationError, LdapDBError,
+                                           SQLCompiler, query_as_ldap)
+from ldapdb.models.expressions import AddValues, Increment, RemoveValues
 
 groups = ('ou=groups,dc=example,dc=org', {
     'objectClass': ['top', 'organizationalUnit'], 'ou': ['groups']})
@@ -145,6 +151,363 @@ class ConnectionTestCase(BaseTestCase):
         self.ldap_server.start()
         LdapUser.objects.get(username='foouser')
 
+    def test_liveness_checks(self):
+        for method in ['rootdse', 'whoami', 'bind', 'none']:
+            with self.subTest(method=method):
+                settings.DATABASES['ldap']['LIVENESS_CHECK'] = method
+                # Check the connection before each query
+                settings.DATABASES['ldap']['LIVENESS_INTERVAL'] = 0
+                try:
+                    LdapUser.objects.get(username='foouser')
+                    LdapUser.objects.get(username='foouser')
+                    self.ldap_server.stop()
+                    self.ldap_server.start()
+                    LdapUser.objects.get(username='foouser')
+                finally:
+                    del settings.DATABASES['ldap']['LIVENESS_CHECK']
+                    del settings.DATABASES['ldap']['LIVENESS_INTERVAL']
+
+    def test_liveness_interval(self):
+        settings.DATABASES['ldap']['LIVENESS_INTERVAL'] = 60
+        try:
+            connection = connections['ldap']
+            LdapUser.objects.get(username='foouser')
+            with mock.patch.object(connection, 'check_liveness') as check_liveness:
+                # No check within the interval
+                LdapUser.objects.get(username='foouser')
+                check_liveness.assert_not_called()
+
+                connection._last_activity -= 60
+                LdapUser.objects.get(username='foouser')
+                check_liveness.assert_called_once()
+        finally:
+            del settings.DATABASES['ldap']['LIVENESS_INTERVAL']
+
+    def test_invalid_liveness_check(self):
+        LdapUser.objects.get(username='foouser')
+        settings.DATABASES['ldap']['LIVENESS_CHECK'] = 'ping'
+        try:
+            with self.assertRaises(ImproperlyConfigured):
+                LdapUser.objects.get(username='foouser')
+        finally:
+            del settings.DATABASES['ldap']['LIVENESS_CHECK']
+
+
+class PoolTestCase(BaseTestCase):
+    directory = dict([people, foouser])
+
+    def setUp(self):
+        super().setUp()
+        connections['ldap'].close()
+        settings.DATABASES['ldap']['POOL'] = {'MAX_SIZE': 2}
+
+    def tearDown(self):
+        connections['ldap'].close()
+        del settings.DATABASES['ldap']['POOL']
+        ldapdb_pool.clear_pools()
+        super().tearDown()
+
+    def test_reuse_connection(self):
+        connection = connections['ldap']
+        LdapUser.objects.get(username='foouser')
+        connection.close()
+        LdapUser.objects.get(username='foouser')
+
+        stats = connection.pool.stats()
+        self.assertEqual(1, stats['created'])
+        self.assertEqual(2, stats['checkouts'])
+        self.assertEqual(1, stats['in_use'])
+
+    def test_reconnect(self):
+        LdapUser.objects.get(username='foouser')
+        self.ldap_server.stop()
+        self.ldap_server.start()
+        connections['ldap'].close()
+        LdapUser.objects.get(username='foouser')
+
+
+class EntryCacheTestCase(BaseTestCase):
+    directory = dict([people, foouser])
+
+    def setUp(self):
+        super().setUp()
+        connections['ldap'].close()
+        settings.DATABASES['ldap']['ENTRY_CACHE'] = {'MAX_SIZE': 10, 'TTL': 60}
+
+    def tearDown(self):
+        connections['ldap'].close()
+        del settings.DATABASES['ldap']['ENTRY_CACHE']
+        super().tearDown()
+
+    def test_cache_hits(self):
+        connection = connections['ldap']
+        dn = 'uid=foouser,%s' % LdapUser.base_dn
+        LdapUser.objects.get(dn=dn)
+        self.assertEqual(2000, LdapUser.objects.get(dn=dn).uid)
+
+        stats = connection.entry_cache.stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+
+        # Subtree searches don't go through the cache
+        LdapUser.objects.get(username='foouser')
+        self.assertEqual(1, connection.entry_cache.stats()['hits'])
+
+    def test_write_invalidation(self):
+        dn = 'uid=foouser,%s' % LdapUser.base_dn
+        user = LdapUser.objects.get(dn=dn)
+        user.first_name = 'Bar'
+        user.save()
+        self.assertEqual('Bar', LdapUser.objects.get(dn=dn).first_name)
+
+        LdapUser.objects.filter(dn=dn).update(first_name='Baz')
+        self.assertEqual('Baz', LdapUser.objects.get(dn=dn).first_name)
+
+        user.username = 'baruser'
+        user.save()
+        self.assertFalse(LdapUser.objects.filter(dn=dn).exists())
+
+
+class QueryCacheTestCase(BaseTestCase):
+    directory = dict([groups, foogroup, bargroup, wizgroup])
+
+    def setUp(self):
+        super().setUp()
+        connections['ldap'].close()
+        settings.DATABASES['ldap']['QUERY_CACHE'] = {'TTL': 60}
+
+    def tearDown(self):
+        connection = connections['ldap']
+        connection.query_cache.clear()
+        connection.close()
+        del settings.DATABASES['ldap']['QUERY_CACHE']
+        super().tearDown()
+
+    def test_cache_hits(self):
+        qs = LdapGroup.objects.filter(name__contains='group').order_by('name')
+        self.assertEqual(['bargroup', 'foogroup', 'wizgroup'], [g.name for g in qs])
+        self.assertEqual(['bargroup', 'foogroup', 'wizgroup'], [g.name for g in qs.all()])
+        self.assertEqual(['foogroup'], [g.name for g in qs[1:2]])
+
+        stats = connections['ldap'].query_cache.stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(2, stats['misses'])
+
+    def test_write_invalidation(self):
+        qs = LdapGroup.objects.order_by('name')
+        self.assertEqual([1001, 1000, 1002], [g.gid for g in qs])
+
+        LdapGroup.objects.filter(name='foogroup').update(gid=1010)
+        self.assertEqual([1001, 1010, 1002], [g.gid for g in qs.all()])
+
+        LdapGroup.objects.create(name='newgroup', gid=1020)
+        self.assertEqual([1001, 1010, 1020, 1002], [g.gid for g in qs.all()])
+
+    def test_django_cache(self):
+        connections['ldap'].close()
+        settings.DATABASES['ldap']['QUERY_CACHE'] = {'CACHE_ALIAS': 'default', 'TTL': 60}
+        qs = LdapGroup.objects.order_by('name')
+        self.assertEqual([1001, 1000, 1002], [g.gid for g in qs])
+        self.assertEqual([1001, 1000, 1002], [g.gid for g in qs.all()])
+        self.assertEqual({'hits': 1, 'misses': 1}, connections['ldap'].query_cache.stats())
+
+        LdapGroup.objects.filter(name='foogroup').update(gid=1010)
+        self.assertEqual([1001, 1010, 1002], [g.gid for g in qs.all()])
+
+    def test_model_ttl(self):
+        with mock.patch.object(LdapGroup, 'query_cache_ttl', 0):
+            list(LdapGroup.objects.all())
+            list(LdapGroup.objects.all())
+        self.assertEqual(0, connections['ldap'].query_cache.stats()['size'])
+
+
+class InChunksTestCase(BaseTestCase):
+    directory = dict([groups, foogroup, bargroup, wizgroup])
+
+    def setUp(self):
+        super().setUp()
+        connections['ldap'].close()
+        settings.DATABASES['ldap']['IN_CHUNK_SIZE'] = 2
+
+    def tearDown(self):
+        connections['ldap'].close()
+        del settings.DATABASES['ldap']['IN_CHUNK_SIZE']
+        super().tearDown()
+
+    def test_chunks(self):
+        names = ['foogroup', 'bargroup', 'wizgroup', 'nogroup', 'foogroup']
+        qs = LdapGroup.objects.filter(name__in=names)
+        with mock.patch.object(connections['ldap'], 'search_union', wraps=connections['ldap'].search_union) as search:
+            self.assertEqual(['bargroup', 'foogroup', 'wizgroup'], sorted(qs.values_list('name', flat=True)))
+        self.assertEqual(3, len(search.call_args[0][0]))
+
+        self.assertEqual(3, qs.count())
+        self.assertTrue(qs.exists())
+        self.assertEqual(['wizgroup', 'foogroup'], [g.name for g in qs.filter(gid__gte=1000).order_by('-gid')[:2]])
+        self.assertEqual(
+            ['bargroup', 'wizgroup'],
+            sorted(qs.filter(~Q(name='foogroup')).values_list('name', flat=True)),
+        )
+
+        # Small lists are not split
+        qs = LdapGroup.objects.filter(name__in=['foogroup', 'bargroup'])
+        with mock.patch.object(connections['ldap'], 'search_union') as search:
+            self.assertEqual(2, qs.count())
+        search.assert_not_called()
+
+    def test_chunks_pool(self):
+        settings.DATABASES['ldap']['POOL'] = {'MAX_SIZE': 3}
+        connections['ldap'].close()
+        try:
+            names = ['foogroup', 'bargroup', 'wizgroup', 'nogroup', 'foogroup']
+            qs = LdapGroup.objects.filter(name__in=names)
+            self.assertEqual(['bargroup', 'foogroup', 'wizgroup'], sorted(g.name for g in qs))
+            # Each chunk was searched on a connection checked out of the pool.
+            stats = connections['ldap'].pool.stats()
+            self.assertEqual(1 + 3, stats['checkouts'])
+            self.assertLessEqual(stats['created'], 3)
+        finally:
+            connections['ldap'].close()
+            del settings.DATABASES['ldap']['POOL']
+            ldapdb_pool.clear_pools()
+
+    def test_update_delete(self):
+        names = ['foogroup', 'bargroup', 'wizgroup']
+        self.assertEqual(3, LdapGroup.objects.filter(name__in=names).update(gid=2000))
+        self.assertEqual(3, LdapGroup.objects.filter(gid=2000).count())
+        self.assertEqual(3, LdapGroup.objects.filter(name__in=names).delete()[0])
+        self.assertEqual(0, LdapGroup.objects.count())
+
+
+contactgroup = ('cn=contactgroup,ou=contacts,ou=groups,dc=example,dc=org', {
+    'objectClass': ['posixGroup'], 'memberUid': ['foouser'],
+    'gidNumber': ['1003'], 'cn': ['contactgroup']})
+roomgroup = ('cn=roomgroup,ou=rooms,dc=example,dc=org', {
+    'objectClass': ['posixGroup'], 'memberUid': ['baruser'],
+    'gidNumber': ['1004'], 'cn': ['roomgroup']})
+
+
+class InBasesTestCase(BaseTestCase):
+    directory = dict([groups, contacts, rooms, foogroup, bargroup, wizgroup, contactgroup, roomgroup])
+
+    def test_merge(self):
+        qs = LdapGroup.objects.in_bases([contacts[0], rooms[0]])
+        self.assertEqual(['contactgroup', 'roomgroup'], sorted(g.name for g in qs))
+        self.assertEqual(2, qs.count())
+        self.assertTrue(qs.filter(name='roomgroup').exists())
+        self.assertEqual(1004, qs.get(name='roomgroup').gid)
+
+        # Chaining keeps the bases
+        self.assertEqual(['roomgroup'], [g.name for g in qs.filter(gid__gte=1004)])
+
+    def test_overlap(self):
+        qs = LdapGroup.objects.in_bases([groups[0], contacts[0]])
+        self.assertEqual(
+            ['bargroup', 'contactgroup', 'foogroup', 'wizgroup'],
+            sorted(qs.values_list('name', flat=True)),
+        )
+        self.assertEqual(4, qs.count())
+
+    def test_order_slice(self):
+        qs = LdapGroup.objects.in_bases([rooms[0], contacts[0], groups[0]]).order_by('-gid')
+        self.assertEqual(
+            ['roomgroup', 'contactgroup', 'wizgroup', 'bargroup', 'foogroup'],
+            [g.name for g in qs],
+        )
+        self.assertEqual(['contactgroup', 'wizgroup'], [g.name for g in qs[1:3]])
+        self.assertEqual(2, qs[1:3].count())
+
+    def test_missing_base(self):
+        qs = LdapGroup.objects.in_bases(['ou=missing,dc=example,dc=org', rooms[0]])
+        self.assertEqual(['roomgroup'], [g.name for g in qs])
+        self.assertFalse(LdapGroup.objects.in_bases([]).exists())
+
+    def test_update_delete(self):
+        qs = LdapGroup.objects.in_bases([contacts[0], rooms[0]])
+        self.assertEqual(2, qs.update(gid=2000))
+        self.assertEqual(2000, LdapGroup.objects.in_bases([rooms[0]]).get(name='roomgroup').gid)
+        self.assertEqual(2, qs.delete()[0])
+        self.assertEqual(3, LdapGroup.objects.count())
+
+    def test_pool(self):
+        settings.DATABASES['ldap']['POOL'] = {'MAX_SIZE': 3}
+        connections['ldap'].close()
+        try:
+            qs = LdapGroup.objects.in_bases([contacts[0], rooms[0]]).order_by('name')
+            self.assertEqual(['contactgroup', 'roomgroup'], [g.name for g in qs])
+            self.assertEqual(1 + 2, connections['ldap'].pool.stats()['checkouts'])
+        finally:
+            connections['ldap'].close()
+            del settings.DATABASES['ldap']['POOL']
+            ldapdb_pool.clear_pools()
+
+    def test_pool_saturated(self):
+        settings.DATABASES['ldap']['POOL'] = {'MAX_SIZE': 3}
+        connections['ldap'].close()
+        try:
+            connection = connections['ldap']
+            connection.ensure_connection()
+            # Other threads hold the remaining connections.
+            held = [connection.pool.acquire() for _i in range(2)]
+            try:
+                qs = LdapGroup.objects.in_bases([contacts[0], rooms[0]]).order_by('name')
+                self.assertEqual(['contactgroup', 'roomgroup'], [g.name for g in qs])
+            finally:
+                for held_connection in held:
+                    connection.pool.release(held_connection)
+            # The searches ran on the current connection, without waiting for the pool.
+            self.assertEqual(0, connection.pool.stats()['waits'])
+        finally:
+            connections['ldap'].close()
+            del settings.DATABASES['ldap']['POOL']
+            ldapdb_pool.clear_pools()
+
+
+class AsyncTestCase(BaseTestCase):
+    directory = dict([groups, contacts, foogroup, bargroup, wizgroup, contactgroup])
+
+    async def test_iter(self):
+        qs = LdapGroup.objects.order_by('-gid')
+        self.assertEqual(
+            ['contactgroup', 'wizgroup', 'bargroup', 'foogroup'],
+            [g.name async for g in qs],
+        )
+        self.assertEqual(['wizgroup', 'bargroup'], [g.name async for g in qs[1:3]])
+        self.assertEqual(
+            [1003, 1002],
+            [gid async for gid in qs.filter(gid__gte=1002).values_list('gid', flat=True)],
+        )
+        self.assertEqual(['contactgroup'], [g.name async for g in LdapGroup.objects.in_bases([contacts[0]])])
+
+    async def test_get(self):
+        group = await LdapGroup.objects.aget(name='foogroup')
+        self.assertEqual(1000, group.gid)
+        self.assertEqual(['foouser', 'baruser'], group.usernames)
+        with self.assertRaises(LdapGroup.DoesNotExist):
+            await LdapGroup.objects.aget(name='missing')
+        with self.assertRaises(LdapGroup.MultipleObjectsReturned):
+            await LdapGroup.objects.aget(usernames='baruser')
+
+    async def test_count_exists(self):
+        self.assertEqual(4, await LdapGroup.objects.acount())
+        self.assertEqual(2, await LdapGroup.objects.filter(name__in=['foogroup', 'bargroup', 'zoogroup']).acount())
+        self.assertEqual(2, await LdapGroup.objects.all()[2:].acount())
+        self.assertTrue(await LdapGroup.objects.filter(name='wizgroup').aexists())
+        self.assertFalse(await LdapGroup.objects.filter(name='missing').aexists())
+        self.assertFalse(await LdapGroup.objects.in_bases(['ou=missing,dc=example,dc=org']).aexists())
+
+    async def test_concurrent(self):
+        names = ['foogroup', 'bargroup', 'wizgroup', 'contactgroup'] * 5
+        groups = await asyncio.gather(*[LdapGroup.objects.aget(name=name) for name in names])
+        self.assertEqual(names, [g.name for g in groups])
+
+    @mock.patch('django.db.models.query.sync_to_async', side_effect=AssertionError("No thread expected"))
+    async def test_custom_manager(self, _sync_to_async):
+        # Managers subclassing django's Manager also search on the event loop.
+        self.assertEqual(['foogroup'], [g.name async for g in FooGroup.objects.all()])
+        self.assertEqual(1, await FooGroup.objects.acount())
+        self.assertEqual(1000, (await FooGroup.objects.aget(name='foogroup')).gid)
+
 
 class GroupTestCase(BaseTestCase):
     directory = dict([groups, foogroup, bargroup, wizgroup, people, foouser])
@@ -157,6 +520,20 @@ class GroupTestCase(BaseTestCase):
         qs = LdapGroup.objects.all()
         self.assertEqual(qs.count(), 3)
 
+    def test_count_slice(self):
+        qs = LdapGroup.objects.filter(name__contains='group')
+        self.assertEqual(qs[:2].count(), 2)
+        self.assertEqual(qs[:10].count(), 3)
+        self.assertEqual(qs[1:].count(), 2)
+        self.assertEqual(qs[1:2].count(), 1)
+        self.assertEqual(qs[5:].count(), 0)
+
+        # Filters of the sliced queryset are honored
+        qs = LdapGroup.objects.filter(name='foogroup')
+        self.assertEqual(qs[:2].count(), 1)
+        qs = LdapGroup.objects.filter(name='missing')
+        self.assertEqual(qs[:2].count(), 0)
+
     def test_aggregate_count(self):
         qs = LdapGroup.objects.all()
         result = qs.aggregate(num_groups=Count('name'))
@@ -208,14 +585,14 @@ class GroupTestCase(BaseTestCase):
         # AND filter
         qs = LdapGroup.objects.filter(gid=1000, name='foogroup')
         self.assertIn(get_filterstr(qs), [
-            '(&(objectClass=posixGroup)(&(gidNumber=1000)(cn=foogroup)))',
-            '(&(objectClass=posixGroup)(&(cn=foogroup)(gidNumber=1000)))',
+            '(&(objectClass=posixGroup)(gidNumber=1000)(cn=foogroup))',
+            '(&(objectClass=posixGroup)(cn=foogroup)(gidNumber=1000))',
         ])
 
         qs = LdapGroup.objects.filter(Q(gid=1000) & Q(name='foogroup'))
         self.assertIn(get_filterstr(qs), [
-            '(&(objectClass=posixGroup)(&(gidNumber=1000)(cn=foogroup)))',
-            '(&(objectClass=posixGroup)(&(cn=foogroup)(gidNumber=1000)))',
+            '(&(objectClass=posixGroup)(gidNumber=1000)(cn=foogroup))',
+            '(&(objectClass=posixGroup)(cn=foogroup)(gidNumber=1000))',
         ])
 
         # OR filter
@@ -239,10 +616,27 @@ class GroupTestCase(BaseTestCase):
             '(&(objectClass=posixGroup)(!(&(cn=foogroup)(gidNumber=1000))))',
         ])
 
+        # redundant filters
+        qs = LdapGroup.objects.filter(name='foogroup').filter(Q(name='foogroup') | Q(name='foogroup'))
+        self.assertEqual(get_filterstr(qs), '(&(objectClass=posixGroup)(cn=foogroup))')
+
+        qs = LdapGroup.objects.exclude(~Q(name='foogroup'))
+        self.assertEqual(get_filterstr(qs), '(&(objectClass=posixGroup)(cn=foogroup))')
+
+        # IN lists are merged into an enclosing OR
+        qs = LdapGroup.objects.filter(Q(name__in=['foogroup', 'bargroup']) | Q(name='wizgroup'))
+        self.assertEqual(
+            get_filterstr(qs),
+            '(&(objectClass=posixGroup)(|(cn=foogroup)(cn=bargroup)(cn=wizgroup)))',
+        )
+
+        qs = LdapGroup.objects.filter(name__in=['foogroup', 'foogroup'])
+        self.assertEqual(get_filterstr(qs), '(&(objectClass=posixGroup)(cn=foogroup))')
+
         qs = LdapGroup.objects.filter(name='foogroup').exclude(gid=1000)
         self.assertIn(get_filterstr(qs), [
-            '(&(objectClass=posixGroup)(&(cn=foogroup)(!(gidNumber=1000))))',
-            '(&(objectClass=posixGroup)(&(!(gidNumber=1000))(cn=foogroup)))',
+            '(&(objectClass=posixGroup)(cn=foogroup)(!(gidNumber=1000)))',
+            '(&(objectClass=posixGroup)(!(gidNumber=1000))(cn=foogroup))',
         ])
 
     def test_filter(self):
@@ -283,6 +677,12 @@ class GroupTestCase(BaseTestCase):
         qs2 = LdapGroup.objects.filter(name='missing')
         self.assertFalse(qs2.exists())
 
+    def test_exists_slice(self):
+        qs = LdapGroup.objects.filter(name__contains='group')
+        self.assertTrue(qs[2:].exists())
+        self.assertFalse(qs[3:].exists())
+        self.assertTrue(LdapGroup.objects.order_by('-name')[1:].exists())
+
     def test_get_by_dn(self):
         g = LdapGroup.objects.get(dn='cn=foogroup,%s' % LdapGroup.base_dn)
         self.assertEqual(g.dn, 'cn=foogroup,%s' % LdapGroup.base_dn)
@@ -323,6 +723,40 @@ class GroupTestCase(BaseTestCase):
         self.assertEqual(new.gid, 1010)
         self.assertCountEqual(new.usernames, ['someuser', 'foouser'])
 
+    def test_bulk_create(self):
+        groups = LdapGroup.objects.bulk_create([
+            LdapGroup(name='newgroup%d' % i, gid=1010 + i, usernames=['foouser'] if i % 2 else [])
+            for i in range(5)
+        ])
+        self.assertEqual(
+            ['cn=newgroup%d,%s' % (i, LdapGroup.base_dn) for i in range(5)],
+            [g.dn for g in groups],
+        )
+
+        qs = LdapGroup.objects.filter(name__startswith='newgroup').order_by('gid')
+        self.assertEqual([1010, 1011, 1012, 1013, 1014], [g.gid for g in qs])
+        self.assertEqual([[], ['foouser'], [], ['foouser'], []], [g.usernames for g in qs])
+
+        # Created entries can be updated
+        groups[0].gid = 1020
+        groups[0].save()
+        self.assertEqual(1020, LdapGroup.objects.get(name='newgroup0').gid)
+
+    def test_bulk_create_errors(self):
+        groups = [
+            LdapGroup(name='newgroup', gid=1010),
+            LdapGroup(name='foogroup', gid=1011),
+        ]
+        with self.assertRaises(BulkOperationError) as cm:
+            LdapGroup.objects.bulk_create(groups)
+
+        foogroup_dn = 'cn=foogroup,%s' % LdapGroup.base_dn
+        self.assertEqual([foogroup_dn], list(cm.exception.errors))
+        self.assertIsInstance(cm.exception.errors[foogroup_dn], ldap.ALREADY_EXISTS)
+        self.assertEqual(['cn=newgroup,%s' % LdapGroup.base_dn], cm.exception.succeeded)
+        self.assertEqual(1010, LdapGroup.objects.get(name='newgroup').gid)
+        self.assertEqual(1000, LdapGroup.objects.get(name='foogroup').gid)
+
     def test_order_by(self):
         # ascending name
         qs = LdapGroup.objects.order_by('name')
@@ -380,12 +814,38 @@ class GroupTestCase(BaseTestCase):
         self.assertEqual(qs[1].name, 'foogroup')
         self.assertEqual(qs[2].name, 'bargroup')
 
+    def test_iterator(self):
+        qs = LdapGroup.objects.all()
+        self.assertCountEqual(
+            ['bargroup', 'foogroup', 'wizgroup'],
+            [g.name for g in qs.iterator(chunk_size=1)],
+        )
+
+        # Client-side ordering still applies
+        qs = LdapGroup.objects.order_by('-gid')
+        self.assertEqual([1002, 1001, 1000], [g.gid for g in qs.iterator(chunk_size=2)])
+
+        qs = LdapGroup.objects.values_list('name', flat=True)
+        self.assertCountEqual(['bargroup', 'foogroup', 'wizgroup'], list(qs.iterator(chunk_size=1)))
+
     def test_bulk_delete(self):
         LdapGroup.objects.all().delete()
 
         qs = LdapGroup.objects.all()
         self.assertEqual(len(qs), 0)
 
+    def test_bulk_delete_count(self):
+        settings.DATABASES['ldap']['PIPELINE_WINDOW'] = 2
+        # Connection parameters are read when connecting
+        connections['ldap'].close()
+        try:
+            deleted, _rows = LdapGroup.objects.filter(name__in=['foogroup', 'bargroup', 'missing']).delete()
+        finally:
+            del settings.DATABASES['ldap']['PIPELINE_WINDOW']
+
+        self.assertEqual(2, deleted)
+        self.assertEqual(['wizgroup'], [g.name for g in LdapGroup.objects.all()])
+
     def test_bulk_delete_none(self):
         LdapGroup.objects.none().delete()
 
@@ -429,6 +889,27 @@ class GroupTestCase(BaseTestCase):
         self.assertEqual(len(objs), 1)
         self.assertEqual(objs[0].gid, 1001)
 
+    def test_slice_unordered(self):
+        qs = LdapGroup.objects.order_by()
+        self.assertEqual(2, len(qs[:2]))
+        self.assertEqual(1, len(qs[1:2]))
+        self.assertEqual(1, len(qs[2:5]))
+        self.assertEqual(3, len(qs[:10]))
+
+    def test_search_sizelimit(self):
+        connection = connections['ldap']
+        for page_size in [None, 1]:
+            with self.subTest(page_size=page_size):
+                results = connection.search_s(
+                    LdapGroup.base_dn,
+                    ldap.SCOPE_SUBTREE,
+                    '(objectClass=posixGroup)',
+                    ['cn'],
+                    page_size=page_size,
+                    sizelimit=2,
+                )
+                self.assertEqual(2, len(list(results)))
+
     def test_update(self):
         g = LdapGroup.objects.get(name='foogroup')
         g.gid = 1002
@@ -441,6 +922,110 @@ class GroupTestCase(BaseTestCase):
         self.assertEqual(new.gid, 1002)
         self.assertCountEqual(new.usernames, ['foouser2', u'baruseeer2'])
 
+    def test_update_from_snapshot(self):
+        g = LdapGroup.objects.get(name='foogroup')
+        LdapGroup.objects.filter(name='foogroup').update(usernames=['someuser'])
+
+        connection = connections['ldap']
+        with mock.patch.object(connection, 'search_s', wraps=connection.search_s) as search_s:
+            g.gid = 1010
+            g.save()
+        # Changes are computed from the loaded values, and only sent for changed attributes.
+        search_s.assert_not_called()
+        new = LdapGroup.objects.get(name='foogroup')
+        self.assertEqual(1010, new.gid)
+        self.assertEqual(['someuser'], new.usernames)
+
+    def test_update_list_delta(self):
+        g = LdapGroup.objects.get(name='foogroup')
+        LdapGroup.objects.filter(name='foogroup').update(usernames=['foouser', 'baruser', 'someuser'])
+
+        # Only the added value is sent, concurrent changes are kept.
+        g.usernames = g.usernames + ['newuser']
+        g.save()
+        new = LdapGroup.objects.get(name='foogroup')
+        self.assertCountEqual(['foouser', 'baruser', 'someuser', 'newuser'], new.usernames)
+
+        new.usernames = ['foouser', 'baruser', 'newuser']
+        new.save()
+        self.assertCountEqual(
+            ['foouser', 'baruser', 'newuser'],
+            LdapGroup.objects.get(name='foogroup').usernames,
+        )
+
+    def test_update_list_delta_conflict(self):
+        g = LdapGroup.objects.get(name='foogroup')
+        LdapGroup.objects.filter(name='foogroup').update(usernames=['foouser', 'newuser'])
+
+        # Adding a value already added by another client: the whole attribute is replaced.
+        g.usernames = g.usernames + ['newuser']
+        g.save()
+        self.assertCountEqual(
+            ['foouser', 'baruser', 'newuser'],
+            LdapGroup.objects.get(name='foogroup').usernames,
+        )
+
+    def test_update_verify_before_save(self):
+        g = LdapGroup.objects.get(name='foogroup')
+        LdapGroup.objects.filter(name='foogroup').update(usernames=['someuser'])
+
+        with mock.patch.object(LdapGroup, 'verify_before_save', True):
+            g.save()
+        new = LdapGroup.objects.get(name='foogroup')
+        self.assertCountEqual(['foouser', 'baruser'], new.usernames)
+
+    def test_update_deferred(self):
+        # The snapshot misses the gid, which is fetched
+        g = LdapGroup.objects.defer('gid').get(name='foogroup')
+        g.gid = 1010
+        g.save()
+        new = LdapGroup.objects.get(name='foogroup')
+        self.assertEqual(1010, new.gid)
+        self.assertCountEqual(['foouser', 'baruser'], new.usernames)
+
+    def test_queryset_update(self):
+        qs = LdapGroup.objects.filter(name__in=['foogroup', 'bargroup'])
+        self.assertEqual(2, qs.update(usernames=['someuser']))
+
+        qs = LdapGroup.objects.order_by('name')
+        self.assertEqual([['someuser'], ['someuser'], []], [g.usernames for g in qs])
+
+        # Empty lists remove the attribute
+        self.assertEqual(3, LdapGroup.objects.update(usernames=[]))
+        self.assertEqual([[], [], []], [g.usernames for g in qs])
+
+        self.assertEqual(0, LdapGroup.objects.filter(name='missing').update(gid=2000))
+        self.assertEqual(0, LdapGroup.objects.none().update(gid=2000))
+
+    def test_queryset_update_in_place(self):
+        qs = LdapGroup.objects.filter(name__in=['foogroup', 'bargroup'])
+        self.assertEqual(2, qs.update(gid=Increment(10)))
+        self.assertEqual(
+            [1011, 1010, 1002],
+            [g.gid for g in LdapGroup.objects.order_by('name')],
+        )
+
+        self.assertEqual(1, LdapGroup.objects.filter(name='foogroup').update(
+            usernames=AddValues('someuser', 'otheruser'),
+        ))
+        self.assertEqual(1, LdapGroup.objects.filter(name='foogroup').update(
+            usernames=RemoveValues('foouser'),
+        ))
+        self.assertCountEqual(
+            ['baruser', 'someuser', 'otheruser'],
+            LdapGroup.objects.get(name='foogroup').usernames,
+        )
+
+        # Removing a missing value fails
+        with self.assertRaises(BulkOperationError) as cm:
+            LdapGroup.objects.filter(name='foogroup').update(usernames=RemoveValues('foouser'))
+        self.assertEqual(['cn=foogroup,%s' % LdapGroup.base_dn], list(cm.exception.errors))
+
+    def test_queryset_update_primary_key(self):
+        with self.assertRaises(LdapDBError):
+            LdapGroup.objects.filter(name='foogroup').update(name='foogroup2')
+        self.assertTrue(LdapGroup.objects.filter(name='foogroup').exists())
+
     def test_update_change_dn(self):
         g = LdapGroup.objects.get(name='foogroup')
         g.name = 'foogroup2'
@@ -504,6 +1089,27 @@ class GroupTestCase(BaseTestCase):
         # Restore previous configuration
         del settings.DATABASES['ldap']['CONNECTION_OPTIONS']['page_size']
 
+    def test_paginated_search_prefetch(self):
+        settings.DATABASES['ldap']['CONNECTION_OPTIONS'] = settings.DATABASES['ldap'].get('CONNECTION_OPTIONS', {})
+        settings.DATABASES['ldap']['CONNECTION_OPTIONS']['page_size'] = 1
+        settings.DATABASES['ldap']['PAGE_PREFETCH'] = True
+        connections['ldap'].close()  # Force connection reload
+
+        try:
+            qs = LdapGroup.objects.filter(name__contains='group').order_by('name')
+            self.assertEqual(['bargroup', 'foogroup', 'wizgroup'], [g.name for g in qs])
+
+            # Stop iterating before the end; the pending page request is abandoned.
+            results = connections['ldap'].search_s(LdapGroup.base_dn, ldap.SCOPE_SUBTREE, '(cn=*group)', ['cn'])
+            next(results)
+            results.close()
+            self.assertEqual(3, LdapGroup.objects.count())
+        finally:
+            # Restore previous configuration
+            del settings.DATABASES['ldap']['CONNECTION_OPTIONS']['page_size']
+            del settings.DATABASES['ldap']['PAGE_PREFETCH']
+            connections['ldap'].close()
+
     def test_listfield(self):
         g = LdapGroup.objects.get(name='foogroup')
         self.assertCountEqual(['foouser', 'baruser'], g.usernames)
@@ -917,7 +1523,7 @@ class FooGroupTestCase(BaseTestCase):
         qs = FooGroup._base_manager.using(None).filter(dn=dn)
         lq = self.as_ldap_query(qs)
         self.assertEqual(lq.base, dn)
-        self.assertEqual(lq.filterstr, '(&(objectClass=posixGroup))')
+        self.assertEqual(lq.filterstr, '(objectClass=posixGroup)')
         self.assertEqual(qs.count(), 1)
 
     def test_update_group(self):
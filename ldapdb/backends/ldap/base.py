@@ -2,9 +2,24 @@
 # This software is distributed under the two-clause BSD license.
 # Copyright (c) The django-ldapdb project
 
+import asyncio
+import concurrent.futures
+import contextlib
+import functools
+import random
+import time
+
 import django
 import ldap
 import ldap.controls
+import ldap.controls.sss
+import ldap.controls.vlv
+import ldap.dn
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import Error as DjangoDatabaseError
+from django.db import connections
 from django.db.backends.base.base import BaseDatabaseWrapper
 from django.db.backends.base.client import BaseDatabaseClient
 from django.db.backends.base.creation import BaseDatabaseCreation
@@ -13,6 +28,18 @@ from django.db.backends.base.introspection import BaseDatabaseIntrospection
 from django.db.backends.base.operations import BaseDatabaseOperations
 from django.db.backends.base.schema import BaseDatabaseSchemaEditor
 from django.db.backends.base.validation import BaseDatabaseValidation
+from django.utils.functional import cached_property
+
+from . import cache as ldapdb_cache
+from . import health as ldapdb_health
+from . import pool as ldapdb_pool
+
+# Maximum time in seconds between polls of a pending asynchronous response,
+# should the socket miss a readiness notification.
+ASYNC_POLL_INTERVAL = 1.0
+
+# Values of the LIVENESS_CHECK setting, see DatabaseWrapper.check_liveness()
+LIVENESS_CHECKS = ('rootdse', 'whoami', 'bind', 'none')
 
 
 class DatabaseCreation(BaseDatabaseCreation):
@@ -46,7 +73,8 @@ class DatabaseCursor(object):
 
 
 class DatabaseFeatures(BaseDatabaseFeatures):
-    can_use_chunked_reads = False
+    can_use_chunked_reads = True
+    has_bulk_insert = True
     supports_transactions = False
     supports_column_check_constraints = False
     supports_table_check_constraints = False
@@ -57,6 +85,37 @@ class DatabaseFeatures(BaseDatabaseFeatures):
     def __init__(self, connection):
         self.connection = connection
 
+    @cached_property
+    def supported_controls(self):
+        """OIDs of the controls advertised in the server's root DSE.
+
+        Empty if the root DSE can't be read (e.g. denied by ACLs): queries then
+        sort their results client-side.
+        """
+        try:
+            with self.connection.cursor() as cursor:
+                results = cursor.connection.search_ext_s(
+                    base='',
+                    scope=ldap.SCOPE_BASE,
+                    filterstr='(objectClass=*)',
+                    attrlist=['supportedControl'],
+                    timeout=cursor.connection.timeout,
+                )
+        except ldap.LDAPError:
+            return frozenset()
+        controls = set()
+        for _dn, attrs in results:
+            controls.update(oid.decode('ascii') for oid in attrs.get('supportedControl', []))
+        return frozenset(controls)
+
+    @cached_property
+    def supports_server_side_sort(self):
+        return ldap.controls.sss.SSSRequestControl.controlType in self.supported_controls
+
+    @cached_property
+    def supports_virtual_list_view(self):
+        return ldap.controls.vlv.VLVRequestControl.controlType in self.supported_controls
+
 
 class DatabaseIntrospection(BaseDatabaseIntrospection):
     def get_table_list(self, cursor):
@@ -229,14 +288,51 @@ class DatabaseWrapper(BaseDatabaseWrapper):
         # Default page size of 1000 items, ActiveDirectory's default
         # See https://support.microsoft.com/en-us/help/315071/how-to-view-and-set-ldap-policy-in-active-directory-by-using-ntdsutil.exe  # noqa
         self.page_size = 1000
+        # Request the next page of results while the current one is processed
+        self.page_prefetch = False
+        # Maximum number of asynchronous write operations in flight in bulk operations
+        self.pipeline_window = 64
+        # Maximum number of searches run concurrently on pooled connections, by search_union()
+        self.search_concurrency = 4
+        # Shared pool of bound connections, if enabled through the 'POOL' setting
+        self.pool = None
+        # Cache of base-scope search results, if enabled through the 'ENTRY_CACHE' setting
+        self.entry_cache = None
+        # Process-wide cache of search results, if enabled through the 'QUERY_CACHE' setting
+        self.query_cache = None
+        # Response times and failures of the server, for routers
+        self.health = ldapdb_health.get_health(self.alias)
+        # Server-side sort rules rejected by the server, for sorting or Virtual List Views
+        self.failed_sort_rules = set()
+        self.failed_vlv_rules = set()
+        # Socket file descriptor -> [future, count] of coroutines waiting for responses
+        self._async_waiters = {}
+        # Asynchronous searches running on the connection, and the lock
+        # serializing their connection checks (see _aacquire()).
+        self._async_searches = 0
+        self._async_lock = None
+        # Time of the last successful exchange with the server, and whether
+        # the connection has just been opened (and bound).
+        self._last_activity = None
+        self._fresh_connection = False
 
     def close(self):
         if hasattr(self, 'validate_thread_sharing'):
             # django >= 1.4
             self.validate_thread_sharing()
+        self._release_connection()
+
+    def _release_connection(self, discard=False):
+        """Hand the current connection back to the pool, or unbind it."""
         if self.connection is not None:
-            if hasattr(self.connection, '_l'):
-                self.connection.unbind_s()
+            if self.pool is not None:
+                self.pool.release(self.connection, discard=discard, last_active=self._last_activity)
+            elif hasattr(self.connection, '_l'):
+                try:
+                    self.connection.unbind_s()
+                except ldap.LDAPError:
+                    # Already broken
+                    pass
             self.connection = None
 
     def get_connection_params(self):
@@ -244,38 +340,278 @@ class DatabaseWrapper(BaseDatabaseWrapper):
 
         Computed at system startup.
         """
+        uris = self.settings_dict['NAME']
+        if isinstance(uris, str):
+            uris = uris.split()
         return {
-            'uri': self.settings_dict['NAME'],
+            'uri': ' '.join(uris),
+            'uris': list(uris),
+            'failover': self.settings_dict.get('FAILOVER', 'ordered'),
             'tls': self.settings_dict.get('TLS', False),
             'bind_dn': self.settings_dict['USER'],
             'bind_pw': self.settings_dict['PASSWORD'],
             'retry_max': self.settings_dict.get('RETRY_MAX', 1),
-            'retry_delay': self.settings_dict.get('RETRY_DELAY', 60.0),
+            'retry_delay': self.settings_dict.get('RETRY_DELAY', 1.0),
+            'retry_delay_max': self.settings_dict.get('RETRY_DELAY_MAX', 30.0),
+            'circuit_breaker': self.settings_dict.get('CIRCUIT_BREAKER'),
             'options': {
                 k if isinstance(k, int) else k.lower(): v
                 for k, v in self.settings_dict.get('CONNECTION_OPTIONS', {}).items()
             },
+            'page_prefetch': self.settings_dict.get('PAGE_PREFETCH', False),
+            'pipeline_window': self.settings_dict.get('PIPELINE_WINDOW', 64),
+            'in_chunk_size': self.settings_dict.get('IN_CHUNK_SIZE', 0),
+            'search_concurrency': self.settings_dict.get('SEARCH_CONCURRENCY', 4),
+            'pool': self.settings_dict.get('POOL'),
+            'entry_cache': self.settings_dict.get('ENTRY_CACHE'),
+            'query_cache': self.settings_dict.get('QUERY_CACHE'),
+            'liveness_check': self.settings_dict.get('LIVENESS_CHECK', 'rootdse'),
+            'liveness_interval': self.settings_dict.get('LIVENESS_INTERVAL', 10),
         }
 
     def ensure_connection(self):
+        try:
+            self._ensure_connection()
+        except (ldap.LDAPError, DjangoDatabaseError):
+            # Unreachable server: let routers avoid it for a while.
+            self.health.failure()
+            raise
+
+    def _ensure_connection(self):
         super().ensure_connection()
 
-        # Do a test bind, which will revive the connection if interrupted, or reconnect
         conn_params = self.get_connection_params()
-        try:
+        if conn_params['liveness_check'] not in LIVENESS_CHECKS:
+            # Don't wait for the check to be due to report it.
+            raise ImproperlyConfigured("Unknown LDAP liveness check: %r" % conn_params['liveness_check'])
+        while True:
+            if self._fresh_connection:
+                # Just opened and bound, no need to check it.
+                self._fresh_connection = False
+                return
+
+            if (self._last_activity is not None
+                    and time.monotonic() - self._last_activity < conn_params['liveness_interval']):
+                return
+
+            # Check the connection, which will revive it if interrupted, or reconnect
+            try:
+                self.check_liveness(conn_params)
+            except ldap.SERVER_DOWN:
+                self._server_down(conn_params)
+                # The next pooled connection may be broken as well (e.g. after
+                # a server restart): check it in turn, until a new one is opened.
+                self._release_connection(discard=True)
+                self.connect()
+            else:
+                self._mark_alive()
+                return
+
+    def _server_down(self, conn_params):
+        """Report the server of the connection as unreachable, after a failed liveness check.
+
+        Its circuit breaker counts a failure, and the idle pooled connections
+        to it are closed, so that the next connection fails over to another server.
+        """
+        uri = getattr(self.connection, '_uri', None)
+        if uri is None:
+            return
+        breaker = self._get_breaker(uri, conn_params)
+        if breaker is not None:
+            breaker.failure()
+        if self.pool is not None:
+            self.pool.discard_idle(lambda connection: getattr(connection, '_uri', None) == uri)
+
+    def check_liveness(self, conn_params):
+        """Run a cheap operation on the connection, to detect a dead server.
+
+        The operation is chosen by the LIVENESS_CHECK setting:
+
+        - 'rootdse': read the root DSE, without any attribute;
+        - 'whoami': send a "Who am I?" extended operation (RFC 4532);
+        - 'bind': bind again with the configured credentials;
+        - 'none': don't check the connection.
+        """
+        method = conn_params['liveness_check']
+        if method == 'rootdse':
+            self.connection.search_ext_s(
+                base='',
+                scope=ldap.SCOPE_BASE,
+                filterstr='(objectClass=*)',
+                attrlist=['1.1'],
+                timeout=self.connection.timeout,
+            )
+        elif method == 'whoami':
+            self.connection.whoami_s()
+        elif method == 'bind':
             self.connection.simple_bind_s(
                 conn_params['bind_dn'],
                 conn_params['bind_pw'],
             )
-        except ldap.SERVER_DOWN:
-            self.connect()
+        elif method not in LIVENESS_CHECKS:
+            raise ImproperlyConfigured("Unknown LDAP liveness check: %r" % method)
+
+    def _mark_alive(self):
+        self._last_activity = time.monotonic()
+
+    def _mark_down(self):
+        """Note that the server stopped answering on the connection.
+
+        The connection will be checked before its next use, even within
+        LIVENESS_INTERVAL, including once handed back to the pool.
+        """
+        self.health.failure()
+        self._last_activity = None
+
+    def get_primary_alias(self):
+        """Alias of the database this one is a replica of (see ldapdb.router.ReplicaRouter), or its own."""
+        for alias, settings_dict in settings.DATABASES.items():
+            if self.alias in settings_dict.get('REPLICAS', []):
+                return alias
+        return self.alias
 
     def get_new_connection(self, conn_params):
-        """Build a connection from its parameters."""
+        """Build a connection from its parameters, or check one out of the pool."""
+        options = conn_params['options']
+        if 'page_size' in options:
+            self.page_size = int(options['page_size'])
+        self.page_prefetch = bool(conn_params['page_prefetch'])
+        self.pipeline_window = max(int(conn_params['pipeline_window']), 1)
+        self.search_concurrency = max(int(conn_params['search_concurrency']), 1)
+
+        # Replicas share the caches of their primary, invalidated by its writes.
+        cache_alias = self.get_primary_alias()
+        uri = conn_params['uri']
+        if cache_alias != self.alias:
+            uri = connections[cache_alias].get_connection_params()['uri']
+        cache_options = conn_params['entry_cache']
+        if cache_options is None:
+            self.entry_cache = None
+        elif 'CACHE_ALIAS' in cache_options:
+            self.entry_cache = ldapdb_cache.DjangoCache(
+                cache_options['CACHE_ALIAS'],
+                key_prefix='ldapdb:%s:entry' % cache_alias,
+                ttl=cache_options.get('TTL', 60),
+            )
+        elif not isinstance(self.entry_cache, ldapdb_cache.EntryCache):
+            # Cached entries survive reconnections.
+            self.entry_cache = ldapdb_cache.EntryCache(
+                max_size=cache_options.get('MAX_SIZE', 1000),
+                ttl=cache_options.get('TTL', 60),
+            )
+
+        cache_options = conn_params['query_cache']
+        if cache_options is None:
+            self.query_cache = None
+        elif 'CACHE_ALIAS' in cache_options:
+            self.query_cache = ldapdb_cache.DjangoCache(
+                cache_options['CACHE_ALIAS'],
+                key_prefix='ldapdb:%s:query' % cache_alias,
+                ttl=cache_options.get('TTL', 60),
+            )
+        else:
+            self.query_cache = ldapdb_cache.get_query_cache(
+                (cache_alias, uri),
+                max_bytes=cache_options.get('MAX_BYTES', 10 * 1024 * 1024),
+                ttl=cache_options.get('TTL', 60),
+            )
+
+        pool_options = conn_params['pool']
+        if pool_options is None:
+            self.pool = None
+            self._fresh_connection = True
+            return self._open_connection(conn_params)
+
+        self.pool = ldapdb_pool.get_pool(
+            (self.alias, conn_params['uri'], conn_params['bind_dn']),
+            functools.partial(self._open_connection, conn_params),
+            max_size=pool_options.get('MAX_SIZE', 10),
+            max_idle=pool_options.get('MAX_IDLE', 300),
+            max_lifetime=pool_options.get('MAX_LIFETIME', 3600),
+            timeout=pool_options.get('TIMEOUT', 30),
+        )
+        connection = self.pool.acquire()
+        # Connections coming back from the pool go through the liveness check,
+        # unless they exchanged with the server within LIVENESS_INTERVAL.
+        self._last_activity = self.pool.last_active(connection)
+        self._fresh_connection = False
+        return connection
+
+    @classmethod
+    def _open_connection(cls, conn_params):
+        """Open and bind a new connection to the first reachable server.
+
+        Servers are tried in the configured order, or in random order with
+        FAILOVER = 'random'. Up to RETRY_MAX rounds are made, separated by
+        a randomized, exponentially growing delay. Servers whose circuit breaker
+        is open are skipped; if they all are, fail right away.
+        """
+        failover = conn_params['failover']
+        if failover not in ('ordered', 'random'):
+            raise ImproperlyConfigured("Unknown LDAP failover mode: %r" % failover)
+
+        uris = list(conn_params['uris'])
+        error = None
+        for attempt in range(max(int(conn_params['retry_max']), 1)):
+            if attempt:
+                time.sleep(ldapdb_health.backoff_delay(
+                    attempt, conn_params['retry_delay'], conn_params['retry_delay_max']))
+            if failover == 'random':
+                random.shuffle(uris)
+
+            attempted = False
+            for uri in uris:
+                breaker = cls._get_breaker(uri, conn_params)
+                if breaker is not None and not breaker.allow():
+                    continue
+                attempted = True
+                try:
+                    connection = cls._connect(uri, conn_params)
+                except (ldap.SERVER_DOWN, ldap.TIMEOUT, ldap.CONNECT_ERROR) as e:
+                    if breaker is not None:
+                        breaker.failure()
+                    error = e
+                    continue
+                except Exception:
+                    # The server answered, e.g. rejecting the credentials.
+                    if breaker is not None:
+                        breaker.success()
+                    raise
+                if breaker is not None:
+                    breaker.success()
+                return connection
+
+            if not attempted:
+                break
+
+        if error is None:
+            raise ldap.SERVER_DOWN({
+                'desc': "Can't contact LDAP server",
+                'info': "Circuit breaker open for %s" % ', '.join(uris),
+            })
+        raise error
+
+    @staticmethod
+    def _get_breaker(uri, conn_params):
+        """Return the circuit breaker of the server at uri, if enabled through the 'CIRCUIT_BREAKER' setting."""
+        breaker_options = conn_params['circuit_breaker']
+        if breaker_options is None:
+            return None
+        return ldapdb_health.get_breaker(
+            uri,
+            failure_threshold=breaker_options.get('FAILURE_THRESHOLD', 3),
+            reset_timeout=breaker_options.get('RESET_TIMEOUT', 5),
+            max_reset_timeout=breaker_options.get('MAX_RESET_TIMEOUT', 300),
+        )
+
+    @staticmethod
+    def _connect(uri, conn_params):
+        """Open and bind a new connection to the server at uri."""
         connection = ldap.ldapobject.ReconnectLDAPObject(
-            uri=conn_params['uri'],
-            retry_max=conn_params['retry_max'],
-            retry_delay=conn_params['retry_delay'],
+            uri=uri,
+            # Should the connection drop, reconnect once, without waiting: further
+            # attempts go through _open_connection(), with failover and backoff.
+            retry_max=1,
             bytes_mode=False)
 
         options = conn_params['options']
@@ -283,7 +619,8 @@ class DatabaseWrapper(BaseDatabaseWrapper):
             if opt == 'query_timeout':
                 connection.timeout = int(value)
             elif opt == 'page_size':
-                self.page_size = int(value)
+                # Handled by get_new_connection()
+                pass
             else:
                 connection.set_option(opt, value)
 
@@ -312,63 +649,628 @@ class DatabaseWrapper(BaseDatabaseWrapper):
     def _set_autocommit(self, autocommit):
         pass
 
+    def _caches(self):
+        """List the caches holding results affected by writes to this database.
+
+        Those are its own caches, and those of its replicas' connections in
+        the current thread, which may share them.
+        """
+        wrappers = [self] + [connections[alias] for alias in self.settings_dict.get('REPLICAS', [])]
+        caches = {}
+        for wrapper in wrappers:
+            for cache in (wrapper.entry_cache, wrapper.query_cache):
+                if cache is None:
+                    continue
+                if isinstance(cache, ldapdb_cache.DjangoCache):
+                    key = (cache.cache_alias, cache.key_prefix)
+                else:
+                    key = id(cache)
+                caches.setdefault(key, cache)
+        return list(caches.values())
+
+    def _invalidate(self, dn, subtree=False):
+        """Forget cached results affected by a write to dn (or its subtree).
+
+        Also lets routers send the next reads of the request here (see ldapdb.router.ReplicaRouter).
+        """
+        ldapdb_health.record_write()
+        for cache in self._caches():
+            cache.invalidate(dn, subtree=subtree)
+
+    def _invalidate_many(self, dns):
+        """Forget cached results affected by writes to each of dns, see _invalidate()."""
+        if dns:
+            ldapdb_health.record_write()
+        for cache in self._caches():
+            cache.invalidate_many(dns)
+
     def add_s(self, dn, modlist):
         with self.cursor() as cursor:
-            return cursor.connection.add_s(dn, modlist)
+            try:
+                result = cursor.connection.add_s(dn, modlist)
+            except ldap.SERVER_DOWN:
+                self._mark_down()
+                raise
+            finally:
+                self._invalidate(dn)
+            self._mark_alive()
+            return result
 
     def delete_s(self, dn):
-        cursor = self._cursor()
         with self.cursor() as cursor:
-            return cursor.connection.delete_s(dn)
+            try:
+                result = cursor.connection.delete_s(dn)
+            except ldap.SERVER_DOWN:
+                self._mark_down()
+                raise
+            finally:
+                self._invalidate(dn)
+            self._mark_alive()
+            return result
 
     def modify_s(self, dn, modlist):
         with self.cursor() as cursor:
-            return cursor.connection.modify_s(dn, modlist)
+            try:
+                result = cursor.connection.modify_s(dn, modlist)
+            except ldap.SERVER_DOWN:
+                self._mark_down()
+                raise
+            finally:
+                self._invalidate(dn)
+            self._mark_alive()
+            return result
 
     def rename_s(self, dn, newrdn):
-        cursor = self._cursor()
-        with self.cursor() as cursor:
-            return cursor.connection.rename_s(dn, newrdn)
-
-    def search_s(self, base, scope, filterstr='(objectClass=*)', attrlist=None):
         with self.cursor() as cursor:
-            query_timeout = cursor.connection.timeout
+            try:
+                result = cursor.connection.rename_s(dn, newrdn)
+            except ldap.SERVER_DOWN:
+                self._mark_down()
+                raise
+            finally:
+                # The whole subtree moved.
+                self._invalidate(dn, subtree=True)
+                self._invalidate(','.join([newrdn] + ldap.dn.explode_dn(dn)[1:]), subtree=True)
+            self._mark_alive()
+            return result
+
+    def pipeline(self, operations, window=None):
+        """Run asynchronous write operations, keeping up to ``window`` of them in flight.
+
+        ``operations`` yields (dn, method, args) tuples, ``method`` being the name
+        of an asynchronous LDAPObject method taking the DN as first argument
+        (e.g. 'delete_ext'); it is consumed lazily.
+
+        Returns a list of (dn, error) pairs, in the order operations were sent;
+        ``error`` is the LDAPError returned by the server, or None on success.
+        Losing the connection aborts the whole pipeline.
+        """
+        window = window or self.pipeline_window
+        operations = iter(operations)
+        results = []
+
+        with self.cursor() as cursor, contextlib.ExitStack() as stack:
+            # Once all operations were answered (or the connection was lost),
+            # invalidate the cached results affected by any of them at once.
+            stack.callback(lambda: self._invalidate_many([dn for dn, _error in results]))
+            connection = cursor.connection
+            # msgid -> index of the operation in results; dicts keep insertion order.
+            in_flight = {}
+            exhausted = False
+            while not exhausted or in_flight:
+                while not exhausted and len(in_flight) < window:
+                    operation = next(operations, None)
+                    if operation is None:
+                        exhausted = True
+                        break
+                    dn, method, args = operation
+                    results.append((dn, None))
+                    try:
+                        msgid = getattr(connection, method)(dn, *args)
+                    except ldap.SERVER_DOWN:
+                        self._mark_down()
+                        raise
+                    except ldap.LDAPError as e:
+                        # Rejected client-side, e.g. invalid DN.
+                        results[-1] = (dn, e)
+                    else:
+                        in_flight[msgid] = len(results) - 1
+
+                if not in_flight:
+                    continue
+
+                # Servers answer operations in order, wait for the oldest one.
+                msgid = next(iter(in_flight))
+                index = in_flight.pop(msgid)
+                try:
+                    connection.result3(msgid, timeout=connection.timeout)
+                except ldap.SERVER_DOWN:
+                    self._mark_down()
+                    raise
+                except ldap.LDAPError as e:
+                    results[index] = (results[index][0], e)
+                self._mark_alive()
+
+        return results
+
+    def search_s(self, base, scope, filterstr='(objectClass=*)', attrlist=None, page_size=None, serverctrls=None,
+                 sizelimit=0):
+        """Run a paginated search, yielding (dn, attrs) pairs as pages arrive.
+
+        page_size defaults to the connection's page size; serverctrls are sent
+        along with the paging control. With a sizelimit, at most that many
+        entries are returned, and reaching the server's size limit is not an error.
+
+        Base-scope searches go through the entry cache, if enabled.
+        """
+        if self.entry_cache is None or scope != ldap.SCOPE_BASE or serverctrls:
+            yield from self._search_s(base, scope, filterstr, attrlist, page_size, serverctrls, sizelimit)
+            return
+
+        key = self.entry_cache.make_key(base, filterstr, attrlist)
+        entries = self.entry_cache.get(key, base)
+        if entries is None:
+            version = self.entry_cache.version(base)
+            entries = list(self._search_s(base, scope, filterstr, attrlist, page_size, serverctrls, sizelimit))
+            self.entry_cache.set(key, base, entries, version=version)
+        yield from entries[:sizelimit or None]
+
+    def search_union(self, searches, attrlist=None, page_size=None, sizelimit=0):
+        """Run several searches, yielding the (dn, attrs) pairs of the entries matched by any of them.
+
+        ``searches`` is a list of (base, scope, filterstr) tuples. Entries are
+        only returned once, even if matched by several searches. Searches on
+        a missing base match no entry. With a sizelimit, at most that many
+        entries are returned.
+
+        With a connection pool, up to ``search_concurrency`` searches run
+        concurrently, each on a connection checked out of the pool; searches
+        finding all pooled connections in use run on the current connection.
+        """
+        seen = set()
+        for dn, attrs in self._search_all(searches, attrlist, page_size, sizelimit):
+            key = ldapdb_cache.normalize_dn(dn)
+            if key in seen:
+                continue
+            seen.add(key)
+            yield dn, attrs
+            if len(seen) == sizelimit:
+                return
+
+    def _search_all(self, searches, attrlist, page_size, sizelimit):
+        if self.connection is None:
+            # Connecting sets up the pool (and the concurrency) from the current settings.
+            self.ensure_connection()
+        workers = min(len(searches), self.search_concurrency)
+        if self.pool is not None:
+            # Keep a pooled connection for the current thread, if it holds one.
+            workers = min(workers, self.pool.max_size - (self.connection is not None))
+
+        def search_here(base, scope, filterstr):
+            # On the current thread's connection
+            try:
+                yield from self.search_s(base, scope, filterstr, attrlist, page_size, sizelimit=sizelimit)
+            except ldap.NO_SUCH_OBJECT:
+                pass
+
+        if self.pool is None or workers < 2:
+            for search_args in searches:
+                yield from search_here(*search_args)
+            return
+
+        def search(base, scope, filterstr):
+            # A broken connection is replaced once.
+            for attempt in range(2):
+                # Don't wait for a connection while holding ours: with all of them
+                # in use by other threads, the search would stall until the pool
+                # times out. Leave the search to the current thread instead.
+                connection = self.pool.acquire(wait=False)
+                if connection is None:
+                    return None
+                discard = False
+                last_active = None
+                try:
+                    entries = list(self._search_s(
+                        base, scope, filterstr, attrlist, page_size, None, sizelimit, connection=connection,
+                    ))
+                except ldap.NO_SUCH_OBJECT:
+                    last_active = time.monotonic()
+                    return []
+                except ldap.SERVER_DOWN:
+                    discard = True
+                    if attempt:
+                        raise
+                else:
+                    last_active = time.monotonic()
+                    return entries
+                finally:
+                    self.pool.release(connection, discard=discard, last_active=last_active)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(search, *search_args) for search_args in searches]
+            try:
+                for future, search_args in zip(futures, searches):
+                    entries = future.result()
+                    if entries is None:
+                        entries = search_here(*search_args)
+                    yield from entries
+            finally:
+                # Results are no longer wanted (e.g. the iterator was closed early).
+                for future in futures:
+                    future.cancel()
+
+    def _search_s(self, base, scope, filterstr, attrlist, page_size, serverctrls, sizelimit, connection=None):
+        page_size = page_size or self.page_size
+        # Small enough size limits fit in a single response, no need for paging.
+        paged = not sizelimit or sizelimit > page_size
+
+        # Our own connection isn't checked within LIVENESS_INTERVAL: should
+        # it turn out broken before the first response (e.g. the server
+        # restarted since its last use), replace it and search again, once.
+        can_reconnect = connection is None
+        if connection is None:
+            context = self.cursor()
+        else:
+            # A connection checked out of the pool by the caller.
+            context = contextlib.nullcontext(DatabaseCursor(connection))
+        with context as cursor:
+            connection = cursor.connection
+            query_timeout = connection.timeout
 
             # Request pagination; don't fail if the server doesn't support it.
             ldap_control = ldap.controls.SimplePagedResultsControl(
                 criticality=False,
-                size=self.page_size,
+                size=page_size,
                 cookie='',
             )
 
-            # Fetch results
-            page = 0
-
-            while True:
-                msgid = cursor.connection.search_ext(
+            def request_page(cookie):
+                ldap_control.cookie = cookie
+                return connection.search_ext(
                     base=base,
                     scope=scope,
                     filterstr=filterstr,
                     attrlist=attrlist,
-                    serverctrls=[ldap_control],
+                    serverctrls=([ldap_control] if paged else []) + list(serverctrls or []),
                     timeout=query_timeout,
+                    sizelimit=sizelimit,
                 )
 
-                _res_type, results, _res_msgid, server_controls = cursor.connection.result3(
+            def read_page(msgid, limit):
+                if limit is None:
+                    _res_type, results, _res_msgid, server_controls = connection.result3(
+                        msgid,
+                        timeout=query_timeout,
+                    )
+                    return results, server_controls
+
+                # Read messages one at a time, to keep the entries received
+                # before the server hits the size limit, and to stop as soon as
+                # enough entries arrived.
+                results = []
+                # Entries received so far, referrals excluded
+                count = 0
+                while True:
+                    try:
+                        res_type, res_data, _res_msgid, server_controls = connection.result3(
+                            msgid,
+                            all=0,
+                            timeout=query_timeout,
+                        )
+                    except ldap.SIZELIMIT_EXCEEDED:
+                        return results, []
+                    results.extend(res_data)
+                    if res_type == ldap.RES_SEARCH_RESULT:
+                        return results, server_controls
+                    count += sum(1 for dn, _attrs in res_data if dn is not None)
+                    if count >= limit:
+                        # We don't need the rest of the response.
+                        connection.abandon(msgid)
+                        return results, []
+
+            # Fetch results
+            remaining = sizelimit or None
+            started = time.monotonic()
+            msgid = request_page('')
+            self.health.begin()
+            try:
+                while msgid is not None:
+                    current_msgid, msgid = msgid, None
+                    try:
+                        results, server_controls = read_page(current_msgid, remaining)
+                    except ldap.SERVER_DOWN:
+                        if started is None or not can_reconnect:
+                            raise
+                        can_reconnect = False
+                        self._mark_down()
+                        self._release_connection(discard=True)
+                        self.ensure_connection()
+                        connection = self.connection
+                        msgid = request_page('')
+                        continue
+                    if started is not None:
+                        self.health.record_latency(time.monotonic() - started)
+                        started = None
+                    self._mark_alive()
+
+                    # skip referrals
+                    entries = [(dn, attrs) for dn, attrs in results if dn is not None]
+
+                    # No paging control in the response: the server doesn't support paging,
+                    # and returned all results at once.
+                    cookie = None
+                    for ctrl in server_controls:
+                        if ctrl.controlType == ldap.CONTROL_PAGEDRESULTS:
+                            cookie = ctrl.cookie
+
+                    if remaining is not None:
+                        entries = entries[:remaining]
+                        remaining -= len(entries)
+                        if remaining <= 0:
+                            # We have enough entries, don't ask for more.
+                            cookie = None
+
+                    if cookie and self.page_prefetch:
+                        # Let the server prepare the next page while we process this one.
+                        msgid = request_page(cookie)
+
+                    yield from entries
+
+                    if cookie and msgid is None:
+                        msgid = request_page(cookie)
+            except ldap.SERVER_DOWN:
+                self._mark_down()
+                raise
+            finally:
+                self.health.end()
+                if msgid is not None:
+                    # Results are no longer wanted (e.g. the iterator was closed early).
+                    try:
+                        connection.abandon(msgid)
+                    except ldap.LDAPError:
+                        pass
+
+    def search_vlv_s(self, base, scope, filterstr, attrlist, sort_control, offset, count):
+        """Fetch a window of sorted results, through a Virtual List View.
+
+        Returns the (at most) ``count`` entries starting at the 0-based ``offset``
+        in the results sorted according to ``sort_control``.
+        """
+        with self.cursor() as cursor:
+            connection = cursor.connection
+            vlv_control = ldap.controls.vlv.VLVRequestControl(
+                criticality=True,
+                before_count=0,
+                after_count=count - 1,
+                # VLV offsets start at 1; a content count of 0 asks the server
+                # to use its own count, i.e. to interpret the offset as absolute.
+                offset=offset + 1,
+                content_count=0,
+            )
+            try:
+                msgid = connection.search_ext(
+                    base=base,
+                    scope=scope,
+                    filterstr=filterstr,
+                    attrlist=attrlist,
+                    serverctrls=[sort_control, vlv_control],
+                    timeout=connection.timeout,
+                )
+                _res_type, results, _res_msgid, server_controls = connection.result3(
                     msgid,
+                    timeout=connection.timeout,
+                )
+            except ldap.SERVER_DOWN:
+                self._mark_down()
+                raise
+            self._mark_alive()
+
+        results = [(dn, attrs) for dn, attrs in results if dn is not None]
+        for ctrl in server_controls:
+            if ctrl.controlType == ldap.controls.vlv.VLVResponseControl.controlType:
+                # Past the end of the list, the server targets the last entry instead.
+                skip = offset + 1 - ctrl.target_position
+                if skip > 0:
+                    results = results[skip:]
+        return results
+
+    async def asearch_s(self, base, scope, filterstr='(objectClass=*)', attrlist=None, page_size=None,
+                        serverctrls=None, sizelimit=0):
+        """Asynchronous version of search_s(), yielding (dn, attrs) pairs as they arrive.
+
+        Responses are polled without blocking, the event loop waiting for the
+        connection's socket to become readable in between; only checking (or
+        opening) the connection runs in a thread. The entry cache is bypassed.
+        Concurrent searches share the connection, which is released once the
+        last of them is done and CONN_MAX_AGE has elapsed.
+        """
+        connection = await self._aacquire()
+        query_timeout = connection.timeout
+        page_size = page_size or self.page_size
+        paged = not sizelimit or sizelimit > page_size
+
+        ldap_control = ldap.controls.SimplePagedResultsControl(
+            criticality=False,
+            size=page_size,
+            cookie='',
+        )
+        remaining = sizelimit or None
+        started = time.monotonic()
+        cookie = ''
+        msgid = None
+        self.health.begin()
+        try:
+            while cookie is not None:
+                ldap_control.cookie = cookie
+                cookie = None
+                msgid = connection.search_ext(
+                    base=base,
+                    scope=scope,
+                    filterstr=filterstr,
+                    attrlist=attrlist,
+                    serverctrls=([ldap_control] if paged else []) + list(serverctrls or []),
                     timeout=query_timeout,
+                    sizelimit=sizelimit,
                 )
-                page_controls = [ctrl for ctrl in server_controls if ctrl.controlType == ldap.CONTROL_PAGEDRESULTS]
 
-                for dn, attrs in results:
-                    # skip referrals
-                    if dn is not None:
+                # Read messages one at a time, yielding entries as soon as they arrive.
+                while msgid is not None:
+                    try:
+                        res_type, res_data, server_controls = await self._aresult(connection, msgid, query_timeout)
+                    except ldap.SIZELIMIT_EXCEEDED:
+                        if not sizelimit:
+                            raise
+                        msgid = None
+                        break
+                    if started is not None:
+                        self.health.record_latency(time.monotonic() - started)
+                        started = None
+                    self._mark_alive()
+
+                    if res_type == ldap.RES_SEARCH_RESULT:
+                        msgid = None
+                        for ctrl in server_controls:
+                            if ctrl.controlType == ldap.CONTROL_PAGEDRESULTS:
+                                cookie = ctrl.cookie or None
+                        break
+
+                    for dn, attrs in res_data:
+                        # skip referrals
+                        if dn is None:
+                            continue
                         yield dn, attrs
+                        if remaining is not None:
+                            remaining -= 1
+                            if remaining <= 0:
+                                # We don't need the rest of the response.
+                                return
+        except ldap.SERVER_DOWN:
+            self._mark_down()
+            raise
+        finally:
+            self.health.end()
+            if msgid is not None:
+                # Results are no longer wanted (e.g. the iterator was closed early).
+                try:
+                    connection.abandon(msgid)
+                except ldap.LDAPError:
+                    pass
+            self._arelease()
+
+    async def _aacquire(self):
+        """Make sure the connection is usable for an asynchronous search, and count it.
+
+        Only opening the connection runs in a thread; checking it reads the
+        root DSE on the event loop, unless it is already in use by concurrent
+        searches (which would notice a dead server anyway). Each call must be
+        followed by _arelease().
+        """
+        if self._async_lock is None:
+            self._async_lock = asyncio.Lock()
+        async with self._async_lock:
+            if self.connection is None:
+                await sync_to_async(self.ensure_connection)()
+            elif not self._async_searches:
+                await self._acheck_liveness()
+            self._async_searches += 1
+        return self.connection
+
+    def _arelease(self):
+        """Stop counting an asynchronous search; release the connection once idle and obsolete."""
+        self._async_searches -= 1
+        close_at = getattr(self, 'close_at', None)
+        if not self._async_searches and close_at is not None and time.monotonic() >= close_at:
+            # What Django does with the connections of synchronous code at the end of each request.
+            self._release_connection()
+
+    async def _acheck_liveness(self):
+        """Asynchronous version of the liveness check of _ensure_connection().
+
+        Whatever the LIVENESS_CHECK method (other than 'none'), reads the root DSE.
+        """
+        conn_params = self.get_connection_params()
+        if self._fresh_connection:
+            self._fresh_connection = False
+            return
+        if conn_params['liveness_check'] == 'none' or (
+                self._last_activity is not None
+                and time.monotonic() - self._last_activity < conn_params['liveness_interval']):
+            return
+
+        connection = self.connection
+        try:
+            msgid = connection.search_ext(
+                base='',
+                scope=ldap.SCOPE_BASE,
+                filterstr='(objectClass=*)',
+                attrlist=['1.1'],
+                timeout=connection.timeout,
+            )
+            res_type = None
+            while res_type != ldap.RES_SEARCH_RESULT:
+                res_type, _res_data, _server_controls = await self._aresult(connection, msgid, connection.timeout)
+        except ldap.SERVER_DOWN:
+            self._server_down(conn_params)
+            self._release_connection(discard=True)
+            await sync_to_async(self.ensure_connection)()
+        else:
+            self._mark_alive()
 
-                page_control = page_controls[0]
-                page += 1
-                if page_control.cookie:
-                    ldap_control.cookie = page_control.cookie
-                else:
-                    # End of pages
-                    break
+    async def _aresult(self, connection, msgid, timeout):
+        """Wait for the next message of the response to msgid, without blocking the event loop.
+
+        Returns its (res_type, res_data, server_controls); a negative timeout waits forever.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None or timeout < 0 else loop.time() + timeout
+        while True:
+            res_type, res_data, _res_msgid, server_controls = connection.result3(msgid, all=0, timeout=0)
+            if res_type is not None:
+                # Responses to other searches may have been read from the socket
+                # along with this one: let their coroutines look for them.
+                self._wake_waiters(connection.fileno())
+                return res_type, res_data, server_controls
+
+            delay = ASYNC_POLL_INTERVAL
+            if deadline is not None:
+                delay = min(delay, deadline - loop.time())
+                if delay <= 0:
+                    raise ldap.TIMEOUT({'desc': "Timed out"})
+            await self._wait_readable(connection.fileno(), delay)
+
+    async def _wait_readable(self, fd, timeout):
+        """Wait until fd is readable, for at most timeout seconds.
+
+        Coroutines of the connection searching concurrently share a single
+        reader callback on its socket, the event loop only supporting one per fd.
+        """
+        entry = self._async_waiters.get(fd)
+        if entry is None:
+            loop = asyncio.get_running_loop()
+            try:
+                loop.add_reader(fd, self._wake_waiters, fd)
+            except NotImplementedError:
+                # Event loops without reader callbacks (e.g. the proactor on Windows): poll.
+                await asyncio.sleep(min(timeout, 0.01))
+                return
+            # [future resolved once fd is readable, number of waiting coroutines]
+            entry = self._async_waiters[fd] = [loop.create_future(), 0]
+
+        entry[1] += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(entry[0]), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            entry[1] -= 1
+            if not entry[1] and self._async_waiters.get(fd) is entry:
+                self._wake_waiters(fd)
+
+    def _wake_waiters(self, fd):
+        """Wake the coroutines waiting for fd to become readable."""
+        entry = self._async_waiters.pop(fd, None)
+        if entry is not None:
+            waiter = entry[0]
+            waiter.get_loop().remove_reader(fd)
+            if not waiter.done():
+                waiter.set_result(None)
@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+# This software is distributed under the two-clause BSD license.
+# Copyright (c) The django-ldapdb project
+
+import collections
+import hashlib
+import marshal
+import random
+import threading
+import time
+import zlib
+
+import ldap.dn
+from django.core.cache import caches as django_caches
+
+
+def normalize_dn(dn):
+    """Normalize a DN for comparisons; DNs are mostly case-insensitive."""
+    return dn.lower()
+
+
+def in_subtree(dn, base):
+    """Tell whether the (normalized) dn lies within the subtree rooted at (normalized) base."""
+    return not base or dn == base or dn.endswith(',' + base)
+
+
+def subtree_bases(dn):
+    """List the bases whose subtree contains the (normalized) dn, according to in_subtree()."""
+    return [dn, ''] + [dn[i + 1:] for i, char in enumerate(dn) if char == ',']
+
+
+class EntryCache(object):
+    """A LRU cache of base-scope search results, for a single connection.
+
+    Results are keyed by (dn, filterstr, attrlist), and expire ``ttl`` seconds
+    after being stored; at most ``max_size`` results are kept.
+
+    All caches share the interface of this class: get(), set(), version(),
+    invalidate(), invalidate_many(), clear() and stats().
+    """
+
+    def __init__(self, max_size=1000, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        # (dn, filterstr, attrlist) -> (expires_at, entries); least recently used first.
+        self._results = collections.OrderedDict()
+        # Keys of the cached results, for each DN.
+        self._keys_by_dn = collections.defaultdict(set)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(dn, filterstr, attrlist):
+        return (normalize_dn(dn), filterstr, None if attrlist is None else tuple(attrlist))
+
+    def _discard(self, key):
+        del self._results[key]
+        keys = self._keys_by_dn[key[0]]
+        keys.discard(key)
+        if not keys:
+            del self._keys_by_dn[key[0]]
+
+    def get(self, key, base):
+        """Return the (dn, attrs) list cached for key, a search on base, or None."""
+        cached = self._results.get(key)
+        if cached is not None and cached[0] <= time.monotonic():
+            self._discard(key)
+            cached = None
+
+        if cached is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._results.move_to_end(key)
+        return cached[1]
+
+    def version(self, base):
+        # A connection doesn't run searches concurrently to its writes.
+        return None
+
+    def set(self, key, base, entries, ttl=None, version=None):
+        """Cache the results of a search on base; ttl defaults to the cache's ttl."""
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+        if key in self._results:
+            self._discard(key)
+        self._results[key] = (time.monotonic() + ttl, entries)
+        self._keys_by_dn[key[0]].add(key)
+        while len(self._results) > self.max_size:
+            self._discard(next(iter(self._results)))
+
+    def invalidate(self, dn, subtree=False):
+        """Forget results for dn, and for any entry below it if ``subtree``."""
+        dn = normalize_dn(dn)
+        if subtree:
+            dns = [cached_dn for cached_dn in self._keys_by_dn if in_subtree(cached_dn, dn)]
+        else:
+            dns = [dn] if dn in self._keys_by_dn else []
+        for cached_dn in dns:
+            for key in self._keys_by_dn.pop(cached_dn):
+                del self._results[key]
+
+    def invalidate_many(self, dns):
+        """Forget results for each of dns, e.g. after a bulk operation."""
+        for dn in dns:
+            self.invalidate(dn)
+
+    def clear(self):
+        self._results.clear()
+        self._keys_by_dn.clear()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._results),
+            'max_size': self.max_size,
+        }
+
+
+def estimate_size(entries):
+    """Roughly estimate the memory used by a list of (dn, attrs) search results, in bytes."""
+    # Fixed costs per entry, attribute and value, close to CPython's object overheads.
+    size = 64
+    for dn, attrs in entries:
+        size += 200 + len(dn)
+        for name, values in attrs.items():
+            size += 120 + len(name)
+            size += sum(40 + len(value) for value in values)
+    return size
+
+
+class QueryCache(object):
+    """A thread-safe LRU cache of search results, shared by all connections of the process.
+
+    Results are stored along with the (normalized) base of their search, and
+    expire after the ttl provided when storing them. The estimated size of
+    cached results is kept below ``max_bytes``.
+    """
+
+    def __init__(self, max_bytes=10 * 1024 * 1024, ttl=60):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # key -> (base, expires_at, size, results); least recently used first.
+        self._results = collections.OrderedDict()
+        # Keys of the cached results, for each search base.
+        self._keys_by_base = collections.defaultdict(set)
+        self._bytes = 0
+        # Incremented on each invalidation
+        self._version = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _discard(self, key):
+        base, _expires_at, size, _results = self._results.pop(key)
+        self._bytes -= size
+        keys = self._keys_by_base[base]
+        keys.discard(key)
+        if not keys:
+            del self._keys_by_base[base]
+
+    def get(self, key, base):
+        """Return the results cached for key, a search on base, or None."""
+        with self._lock:
+            cached = self._results.get(key)
+            if cached is not None and cached[1] <= time.monotonic():
+                self._discard(key)
+                cached = None
+
+            if cached is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._results.move_to_end(key)
+            return cached[3]
+
+    def version(self, base):
+        """Return a token to pass to set(), for results of a search on base fetched after this call."""
+        with self._lock:
+            return self._version
+
+    def set(self, key, base, results, ttl=None, version=None):
+        """Cache the results of a search on base; ttl defaults to the cache's ttl.
+
+        Results are dropped if an invalidation happened since ``version`` was
+        obtained, as they could predate a write.
+        """
+        ttl = self.ttl if ttl is None else ttl
+        size = estimate_size(results)
+        if ttl <= 0 or size > self.max_bytes:
+            return
+        base = normalize_dn(base)
+        with self._lock:
+            if version is not None and version != self._version:
+                return
+            if key in self._results:
+                self._discard(key)
+            self._results[key] = (base, time.monotonic() + ttl, size, results)
+            self._keys_by_base[base].add(key)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._discard(next(iter(self._results)))
+
+    def invalidate(self, dn, subtree=False):
+        """Forget results of searches that may include dn, or entries below it if ``subtree``."""
+        dn = normalize_dn(dn)
+        with self._lock:
+            self._version += 1
+            bases = [
+                base for base in self._keys_by_base
+                if in_subtree(dn, base) or (subtree and in_subtree(base, dn))
+            ]
+            for base in bases:
+                for key in list(self._keys_by_base[base]):
+                    self._discard(key)
+
+    def invalidate_many(self, dns):
+        """Forget results of searches that may include any of dns, e.g. after a bulk operation."""
+        affected = set()
+        for dn in dns:
+            affected.update(subtree_bases(normalize_dn(dn)))
+        with self._lock:
+            self._version += 1
+            for base in [base for base in self._keys_by_base if base in affected]:
+                for key in list(self._keys_by_base[base]):
+                    self._discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+            self._keys_by_base.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._results),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+            }
+
+
+_query_caches = {}
+_query_caches_lock = threading.Lock()
+
+
+def get_query_cache(key, **options):
+    """Return the process-wide query cache registered for ``key``, creating it if needed."""
+    with _query_caches_lock:
+        cache = _query_caches.get(key)
+        if cache is None:
+            cache = _query_caches[key] = QueryCache(**options)
+        return cache
+
+
+def clear_query_caches():
+    """Empty and forget all query caches."""
+    with _query_caches_lock:
+        caches = list(_query_caches.values())
+        _query_caches.clear()
+    for cache in caches:
+        cache.clear()
+
+
+def ancestors(dn):
+    """List the (normalized) dn and all its ancestors, up to the root DSE ('')."""
+    rdns = ldap.dn.explode_dn(normalize_dn(dn)) if dn else []
+    return [','.join(rdns[i:]) for i in range(len(rdns) + 1)]
+
+
+def common_ancestor(dns):
+    """Return the deepest (normalized) DN having all dns in its subtree."""
+    if len(set(dns)) == 1:
+        return normalize_dn(dns[0])
+    common = ancestors(dns[0])
+    for dn in dns[1:]:
+        dn_ancestors = set(ancestors(dn))
+        common = [ancestor for ancestor in common if ancestor in dn_ancestors]
+    return common[0]
+
+
+class DjangoCache(object):
+    """Search results stored through Django's cache framework, shared between processes.
+
+    Each DN has two generation numbers: one bumped by writes to the DN or below
+    it, and one bumped when its whole subtree changes (e.g. it was renamed).
+    Cache keys include the former generation of the search base, and the latter
+    of the base and all its ancestors; bumping generations invalidates results
+    in all processes, without scanning keys.
+
+    Results are stored in a compact marshal dump, compressed if large.
+    """
+
+    # Results larger than that are compressed.
+    compress_threshold = 1024
+
+    def __init__(self, cache_alias, key_prefix, ttl=60):
+        self.cache_alias = cache_alias
+        self.key_prefix = '%s:%d' % (key_prefix, marshal.version)
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    make_key = staticmethod(EntryCache.make_key)
+
+    @property
+    def cache(self):
+        return django_caches[self.cache_alias]
+
+    def _generation_key(self, kind, dn):
+        return '%s:%s:%s' % (self.key_prefix, kind, hashlib.sha1(dn.encode('utf-8')).hexdigest())
+
+    def version(self, base):
+        """Return the generations of base and its ancestors, for use in cache keys."""
+        dns = ancestors(base)
+        keys = [self._generation_key('gen', dns[0])] + [self._generation_key('moved', dn) for dn in dns]
+        generations = self.cache.get_many(keys)
+        return tuple(generations.get(key, 0) for key in keys)
+
+    def _bump(self, key):
+        try:
+            self.cache.incr(key)
+        except ValueError:
+            # Unknown (possibly evicted) generation: pick a new one at random,
+            # lest stale results stored under a former generation reappear.
+            self.cache.set(key, random.getrandbits(62), None)
+
+    def _results_key(self, key, version):
+        digest = hashlib.sha1(repr((key, version)).encode('utf-8')).hexdigest()
+        return '%s:results:%s' % (self.key_prefix, digest)
+
+    @classmethod
+    def dumps(cls, results):
+        data = marshal.dumps(list(results))
+        if len(data) > cls.compress_threshold:
+            return b'z' + zlib.compress(data)
+        return b'm' + data
+
+    @staticmethod
+    def loads(data):
+        if data[:1] == b'z':
+            return marshal.loads(zlib.decompress(data[1:]))
+        return marshal.loads(data[1:])
+
+    def get(self, key, base):
+        data = self.cache.get(self._results_key(key, self.version(base)))
+        if data is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self.loads(data)
+
+    def set(self, key, base, results, ttl=None, version=None):
+        """Cache the results of a search on base, fetched after version() returned ``version``."""
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+        if version is None:
+            version = self.version(base)
+        self.cache.set(self._results_key(key, version), self.dumps(results), ttl)
+
+    def invalidate(self, dn, subtree=False):
+        dns = ancestors(dn)
+        for ancestor in dns:
+            self._bump(self._generation_key('gen', ancestor))
+        if subtree:
+            self._bump(self._generation_key('moved', dns[0]))
+
+    def invalidate_many(self, dns):
+        """Invalidate results for each of dns, bumping the generation of their common ancestors only once."""
+        ancestors_dns = set()
+        for dn in dns:
+            ancestors_dns.update(ancestors(dn))
+        for ancestor in sorted(ancestors_dns):
+            self._bump(self._generation_key('gen', ancestor))
+
+    def clear(self):
+        """Invalidate all results, as if the whole tree changed."""
+        self.invalidate('', subtree=True)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+        }
@@ -2,20 +2,29 @@
 # This software is distributed under the two-clause BSD license.
 # Copyright (c) The django-ldapdb project
 
+import asyncio
 import collections
-import re
+import copy
+import itertools
 
 import ldap
+import ldap.controls.sss
 from django.db.models import aggregates
 from django.db.models.sql import compiler
 from django.db.models.sql.constants import GET_ITERATOR_CHUNK_SIZE
 from django.db.models.sql.where import AND, OR, WhereNode
 
 from ldapdb import escape_ldap_filter
+from ldapdb.backends.ldap import cache as ldapdb_cache
+from ldapdb.models.expressions import AttributeOperation
+from ldapdb.models.fields import LdapLookup as LdapFieldLookup
 from ldapdb.models.fields import ListField
 
-_ORDER_BY_LIMIT_OFFSET_RE = re.compile(
-    r"(?:\bORDER BY\b\s+([\w\.]+)\s(?P<order>\bASC\b)|(\bDESC\b))\s{1,2}(?:\bLIMIT\b\s+(?P<limit>-?\d+))?[\)\s]?(?:\bOFFSET\b\s+(?P<offset>(\d+)))?"  # noqa: E501
+# Errors returned by servers unable to sort on the requested attributes
+_SORT_ERRORS = (
+    ldap.INAPPROPRIATE_MATCHING,
+    ldap.UNAVAILABLE_CRITICAL_EXTENSION,
+    ldap.UNWILLING_TO_PERFORM,
 )
 
 
@@ -23,6 +32,54 @@ class LdapDBError(Exception):
     """Base class for LDAPDB errors."""
 
 
+class BulkOperationError(LdapDBError):
+    """Some entries of a bulk operation could not be processed.
+
+    ``errors`` maps the DN of each failed entry to the LDAPError returned for it,
+    and ``succeeded`` lists the DNs of the entries processed successfully.
+    """
+
+    def __init__(self, message, errors, succeeded):
+        super().__init__(message)
+        self.errors = errors
+        self.succeeded = succeeded
+
+
+class RowCount(object):
+    """Minimal cursor for write queries, exposing the number of affected entries."""
+
+    def __init__(self, rowcount):
+        self.rowcount = rowcount
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+def run_pipeline(connection, operations, action, ignored=()):
+    """Pipeline write operations, raising BulkOperationError if any of them failed.
+
+    Errors of the ``ignored`` types are neither failures nor successes.
+    Returns the DNs of successfully processed entries.
+    """
+    succeeded = []
+    errors = {}
+    for dn, error in connection.pipeline(operations):
+        if error is None:
+            succeeded.append(dn)
+        elif not isinstance(error, ignored):
+            errors[dn] = error
+    if errors:
+        raise BulkOperationError(
+            "Could not %s %d of %d entries" % (action, len(errors), len(errors) + len(succeeded)),
+            errors=errors,
+            succeeded=succeeded,
+        )
+    return succeeded
+
+
 LdapLookup = collections.namedtuple('LdapLookup', ['base', 'scope', 'filterstr'])
 
 
@@ -35,10 +92,6 @@ def query_as_ldap(query, compiler, connection):
         # FIXME(rbarrois): Support migrations
         return
 
-    # FIXME(rbarrois): this could be an extra Where clause
-    filterstr = ''.join(['(objectClass=%s)' % cls for cls in
-                         query.model.object_classes])
-
     # FIXME(rbarrois): Remove this code as part of #101
     if (len(query.where.children) == 1
             and not isinstance(query.where.children[0], WhereNode)
@@ -51,52 +104,269 @@ def query_as_ldap(query, compiler, connection):
         return LdapLookup(
             base=lookup.rhs,
             scope=ldap.SCOPE_BASE,
-            filterstr='(&%s)' % filterstr,
+            filterstr=filter_template(query.model, None, compiler)[0],
         )
 
-    sql, params = compiler.compile(query.where)
-    if sql:
-        filterstr += '(%s)' % (sql % tuple(escape_ldap_filter(param) for param in params))
+    params = []
+    shape = where_shape(query.where, params)
+    escaped_params = [escape_ldap_filter(param) for param in params]
+    key = None
+    if shape is not None:
+        # The optimizer merges duplicate clauses: which parameters are equal
+        # is part of the query shape.
+        first_index = {}
+        equal_params = tuple(first_index.setdefault(value, index) for index, value in enumerate(escaped_params))
+        key = (query.model, tuple(query.model.object_classes), shape, equal_params)
+
+    cached = _filter_templates.get(key)
+    if cached is None:
+        template, compiled_params = filter_template(query.model, query.where, compiler)
+        compiled_params = [escape_ldap_filter(param) for param in compiled_params]
+        # Only cache templates whose parameters are known without compiling.
+        if key is not None and all(param in first_index for param in compiled_params):
+            if len(_filter_templates) >= FILTER_TEMPLATES_MAX_SIZE:
+                _filter_templates.clear()
+            _filter_templates[key] = (template, tuple(first_index[param] for param in compiled_params))
+    else:
+        template, indexes = cached
+        compiled_params = [escaped_params[index] for index in indexes]
+
     return LdapLookup(
         base=query.model.base_dn,
         scope=query.model.search_scope,
-        filterstr='(&%s)' % filterstr,
+        filterstr=template % tuple(compiled_params),
     )
 
 
-def where_node_as_ldap(where, compiler, connection):
-    """Parse a django.db.models.sql.where.WhereNode.
+def query_as_ldap_chunks(query, compiler, connection):
+    """Convert a django.db.models.sql.query.Query to a list of LdapLookup.
+
+    The query matches the entries matched by any of the lookups: IN lookups
+    with more than ``IN_CHUNK_SIZE`` values are split into several lookups,
+    and each base DN set through QuerySet.in_bases() gets its own lookups.
+    Returns None if the query can't match any entry.
+    """
+    chunk_size = connection.get_connection_params()['in_chunk_size']
+    wheres = split_in_lookup(query.where, chunk_size) if chunk_size else [query.where]
+
+    lookups = []
+    for where in wheres:
+        if where is query.where:
+            chunk_query = query
+        else:
+            chunk_query = query.clone()
+            chunk_query.where = where
+        lookup = query_as_ldap(chunk_query, compiler, connection)
+        if lookup is None:
+            return None
+        lookups.append(lookup)
+
+    base_dns = getattr(query, 'ldap_base_dns', None)
+    # Lookups on a single DN ignore the search bases.
+    if base_dns is not None and lookups[0].scope != ldap.SCOPE_BASE:
+        lookups = [lookup._replace(base=base_dn) for base_dn in base_dns for lookup in lookups]
+    return lookups or None
+
+
+def split_in_lookup(where, chunk_size):
+    """Split the largest IN lookup of a WhereNode, if it has more than chunk_size values.
+
+    Returns a list of WhereNodes, holding a chunk of the values each, which
+    together match the same entries as where. Only lookups outside any
+    negation are split.
+    """
+    candidates = [(path, lookup) for path, lookup in in_lookups(where) if len(lookup.rhs) > chunk_size]
+    if not candidates:
+        return [where]
+
+    path, lookup = max(candidates, key=lambda candidate: len(candidate[1].rhs))
+    values = list(lookup.rhs)
+    wheres = []
+    for start in range(0, len(values), chunk_size):
+        chunk_lookup = copy.copy(lookup)
+        chunk_lookup.rhs = values[start:start + chunk_size]
+        wheres.append(replace_where_child(where, path, chunk_lookup))
+    return wheres
+
+
+def in_lookups(where, path=()):
+    """Yield the (path, lookup) of IN lookups of a WhereNode, outside any negation.
+
+    A path is the list of indexes leading to the lookup in nested children.
+    """
+    if where.negated:
+        return
+    for index, item in enumerate(where.children):
+        if isinstance(item, WhereNode):
+            yield from in_lookups(item, path + (index,))
+        elif is_plain_lookup(item) and item.rhs_is_iterable:
+            yield path + (index,), item
+
+
+def replace_where_child(where, path, child):
+    """Copy a WhereNode, replacing the child at path."""
+    where = copy.copy(where)
+    where.children = list(where.children)
+    index = path[0]
+    if len(path) > 1:
+        child = replace_where_child(where.children[index], path[1:], child)
+    where.children[index] = child
+    return where
+
+
+# Maximum number of cached filter templates
+FILTER_TEMPLATES_MAX_SIZE = 1000
+# (model, object classes, where_shape(), equal parameters) -> (filter template, parameter indexes)
+_filter_templates = {}
+
+
+def filter_template(model, where, compiler):
+    """Compile the filter of a query on model, restricted by the ``where`` WhereNode if provided.
 
     Returns:
-        (clause, [params]): the filter clause, with a list of unescaped parameters.
+        (template, [params]): the filter, with placeholders for the unescaped parameters.
     """
-    bits, params = [], []
+    # FIXME(rbarrois): this could be an extra Where clause
+    node = FilterOperation('&', [FilterClause('objectClass=%s' % cls, []) for cls in model.object_classes])
+    where_node = None if where is None else where_node_as_filter(where, compiler, compiler.connection)
+    if where_node is not None:
+        node.children.append(where_node)
+    clause, params = render_filter(optimize_filter(node))
+    return '(%s)' % clause, params
+
+
+def where_shape(where, params):
+    """Describe the structure of a WhereNode, which determines its filter template.
+
+    The parameters of its lookups are appended to params, in the order of the
+    template placeholders. Returns None for trees whose template can't be cached.
+    """
+    children = []
     for item in where.children:
         if isinstance(item, WhereNode):
-            clause, clause_params = compiler.compile(item)
+            shape = where_shape(item, params)
+            if shape is None:
+                return None
+        elif is_plain_lookup(item):
+            rhs = item.rhs if item.rhs_is_iterable else [item.rhs]
+            shape = (type(item), item.lhs.target.column, len(rhs))
+            params.extend(rhs)
         else:
-            clause, clause_params = item.as_sql(compiler, connection)
+            return None
+        children.append(shape)
+    return (where.connector, where.negated, tuple(children))
 
-        bits.append(clause)
-        params.extend(clause_params)
 
-    if not bits:
-        return '', []
+def is_plain_lookup(item):
+    """Whether item is a lookup of ldapdb fields, compiled by LdapLookup.as_sql()."""
+    return isinstance(item, LdapFieldLookup) and type(item).as_sql is LdapFieldLookup.as_sql
+
+
+# A filter clause, without its enclosing parentheses, e.g. ('cn=%s', ['foo']).
+FilterClause = collections.namedtuple('FilterClause', ['template', 'params'])
+# A boolean operator ('&', '|' or '!') applied to a list of filter nodes.
+FilterOperation = collections.namedtuple('FilterOperation', ['operator', 'children'])
+
+
+def where_node_as_filter(where, compiler, connection):
+    """Convert a django.db.models.sql.where.WhereNode to a tree of filter nodes.
+
+    Returns None for nodes without any condition.
+    """
+    children = []
+    for item in where.children:
+        if isinstance(item, WhereNode):
+            child = where_node_as_filter(item, compiler, connection)
+            if child is None:
+                continue
+        elif is_plain_lookup(item) and item.rhs_is_iterable:
+            # Keep one clause per value, so that the optimizer can fold them
+            # into an enclosing OR.
+            lhs, _lhs_params = item.process_lhs(compiler, connection)
+            clause = item._as_ldap(lhs)
+            child = FilterOperation('|', [FilterClause(clause, [value]) for value in item.rhs])
+        else:
+            child = FilterClause(*item.as_sql(compiler, connection))
+        children.append(child)
+
+    if not children:
+        return None
 
-    # FIXME(rbarrois): shouldn't we flatten recursive AND / OR?
-    if len(bits) == 1:
-        clause = bits[0]
-    elif where.connector == AND:
-        clause = '&' + ''.join('(%s)' % bit for bit in bits)
+    if where.connector == AND:
+        node = FilterOperation('&', children)
     elif where.connector == OR:
-        clause = '|' + ''.join('(%s)' % bit for bit in bits)
+        node = FilterOperation('|', children)
     else:
         raise LdapDBError("Unhandled WHERE connector: %s" % where.connector)
 
     if where.negated:
-        clause = ('!(%s)' % clause)
+        node = FilterOperation('!', [node])
+    return node
 
-    return clause, params
+
+def optimize_filter(node):
+    """Simplify a tree of filter nodes, without changing its meaning.
+
+    - Nested AND (resp. OR) operations are merged into their parent;
+    - Duplicate operands of AND and OR are removed;
+    - Operations with a single operand are replaced with it;
+    - Double negations cancel out.
+    """
+    if isinstance(node, FilterClause):
+        return node
+
+    children = [optimize_filter(child) for child in node.children]
+    if node.operator == '!':
+        child, = children
+        if isinstance(child, FilterOperation) and child.operator == '!':
+            return child.children[0]
+        return FilterOperation('!', children)
+
+    operands, seen = [], set()
+    for child in children:
+        if isinstance(child, FilterOperation) and child.operator == node.operator:
+            merged = child.children
+        else:
+            merged = [child]
+        for operand in merged:
+            clause, params = render_filter(operand)
+            key = clause % tuple(escape_ldap_filter(param) for param in params)
+            if key not in seen:
+                seen.add(key)
+                operands.append(operand)
+
+    if len(operands) == 1:
+        return operands[0]
+    return FilterOperation(node.operator, operands)
+
+
+def render_filter(node):
+    """Render a tree of filter nodes.
+
+    Returns:
+        (clause, [params]): the filter clause, with a list of unescaped parameters.
+    """
+    if isinstance(node, FilterClause):
+        return node.template, list(node.params)
+
+    bits, params = [], []
+    for child in node.children:
+        clause, child_params = render_filter(child)
+        bits.append('(%s)' % clause)
+        params.extend(child_params)
+    return node.operator + ''.join(bits), params
+
+
+def where_node_as_ldap(where, compiler, connection):
+    """Parse a django.db.models.sql.where.WhereNode.
+
+    Returns:
+        (clause, [params]): the filter clause, with a list of unescaped parameters.
+    """
+    node = where_node_as_filter(where, compiler, connection)
+    if node is None:
+        return '', []
+    return render_filter(optimize_filter(node))
 
 
 class SQLCompiler(compiler.SQLCompiler):
@@ -116,119 +386,63 @@ class SQLCompiler(compiler.SQLCompiler):
         # Setup self.select, self.klass_info, self.annotation_col_map
         # All expected from ModelIterable.__iter__
         self.pre_sql_setup()
-        lookup = query_as_ldap(self.query, compiler=self, connection=self.connection)
-
-        if lookup is None:
-            return
 
+        if not all(isinstance(e[0], aggregates.Count) for e in self.select):
+            # Regular query: entries are fetched lazily, when iterating over results_iter().
+            return self.results_iter(chunked_fetch=chunked_fetch, chunk_size=chunk_size)
+
+        return [self.count_entries()] * len(self.select)
+
+    def count_entries(self):
+        """Count the entries matched by the query, within its slice bounds.
+
+        Entries are counted as they arrive, without fetching any attribute.
+        """
+        # Counting a sliced (or distinct) queryset goes through an AggregateQuery
+        # wrapping the actual query.
+        query = getattr(self.query, 'inner_query', None) or self.query
+        lookups = query_as_ldap_chunks(query, compiler=self, connection=self.connection)
+        if lookups is None:
+            return 0
+
+        vals = self.search_lookups(
+            lookups,
+            # RFC 4511 4.5.1.8: "1.1" requests no attributes.
+            attrlist=['1.1'],
+            # Entries past the upper bound don't count; any such entries will do.
+            sizelimit=query.high_mark or 0,
+        )
+        count = 0
         try:
-            vals = self.connection.search_s(
-                base=lookup.base,
-                scope=lookup.scope,
-                filterstr=lookup.filterstr,
-                attrlist=['dn'],
-            )
-            # Flatten iterator
-            vals = list(vals)
+            for _entry in vals:
+                count += 1
         except ldap.NO_SUCH_OBJECT:
-            vals = []
-
-        if not vals:
-            return None
-
-        output = []
-        self.setup_query()
-        for e in self.select:
-            if isinstance(e[0], aggregates.Count):
-                # Check if the SQL query has a limit value and append
-                # that value, else append the length of the return values
-                # from LDAP.
-                sql = self.as_sql()[0]
-                if hasattr(self.query, 'subquery') and self.query.subquery:
-                    sql = self.query.subquery
-                m = _ORDER_BY_LIMIT_OFFSET_RE.search(sql)
-                if m:
-                    limit = m.group('limit')
-                    offset = m.group('offset')
-                    if limit and int(limit) >= 0:
-                        output.append(int(limit))
-                    elif offset:
-                        output.append(len(vals) - int(offset))
-                else:
-                    output.append(len(vals))
-            else:
-                output.append(e[0])
-        return output
+            return 0
+        return max(count - query.low_mark, 0)
 
     def results_iter(self, results=None, tuple_expected=False, chunked_fetch=False, chunk_size=GET_ITERATOR_CHUNK_SIZE):
-        lookup = query_as_ldap(self.query, compiler=self, connection=self.connection)
-        if lookup is None:
+        if results is not None:
+            # Rows prepared by execute_sql()
+            yield from results
             return
 
-        if len(self.query.select):
-            fields = [x.field for x in self.query.select]
-        else:
-            fields = self.query.model._meta.fields
-
-        attrlist = [x.db_column for x in fields if x.db_column]
-
-        try:
-            vals = self.connection.search_s(
-                base=lookup.base,
-                scope=lookup.scope,
-                filterstr=lookup.filterstr,
-                attrlist=attrlist,
-            )
-        except ldap.NO_SUCH_OBJECT:
+        vals, low_mark, high_mark = self.fetch_entries(chunked_fetch, chunk_size)
+        if vals is None:
             return
 
-        # perform sorting
-        if self.query.extra_order_by:
-            ordering = self.query.extra_order_by
-        elif not self.query.default_ordering:
-            ordering = self.query.order_by
-        else:
-            ordering = self.query.order_by or self.query.model._meta.ordering
-
-        for fieldname in reversed(ordering):
-            if fieldname.startswith('-'):
-                sort_field = fieldname[1:]
-                reverse = True
-            else:
-                sort_field = fieldname
-                reverse = False
-
-            if sort_field == 'pk':
-                sort_field = self.query.model._meta.pk.name
-            field = self.query.model._meta.get_field(sort_field)
-
-            if sort_field == 'dn':
-                vals = sorted(vals, key=lambda pair: pair[0], reverse=reverse)
-            else:
-                def get_key(obj):
-                    attr = field.from_ldap(
-                        obj[1].get(field.db_column, []),
-                        connection=self.connection,
-                    )
-                    if hasattr(attr, 'lower'):
-                        attr = attr.lower()
-                    return attr
-                vals = sorted(vals, key=get_key, reverse=reverse)
-
         # process results
         pos = 0
         results = []
+        self.setup_query()
         for dn, attrs in vals:
             # FIXME : This is not optimal, we retrieve more results than we
-            # need but there is probably no other options as we can't perform
-            # ordering server side.
-            if (self.query.low_mark and pos < self.query.low_mark) or \
-               (self.query.high_mark is not None
-                    and pos >= self.query.high_mark):
+            # need when the window can't be requested from the server.
+            if high_mark is not None and pos >= high_mark:
+                break
+            if low_mark and pos < low_mark:
                 pos += 1
                 continue
             row = []
-            self.setup_query()
             for e in self.select:
                 if isinstance(e[0], aggregates.Count):
                     value = 0
@@ -261,50 +475,495 @@ class SQLCompiler(compiler.SQLCompiler):
             yield row
             pos += 1
 
-    def has_results(self):
-        import inspect
-        iterator = self.results_iter()
-        if inspect.isgenerator(iterator):
+    def get_attrlist(self):
+        """List the attributes to fetch for the selected fields."""
+        if len(self.query.select):
+            fields = [x.field for x in self.query.select]
+        else:
+            fields = self.query.model._meta.fields
+        return [x.db_column for x in fields if x.db_column]
+
+    def fetch_entries(self, chunked_fetch=False, chunk_size=GET_ITERATOR_CHUNK_SIZE):
+        """Fetch the entries matched by the query.
+
+        Returns the (dn, attrs) pairs, or None if the search base doesn't
+        exist, along with the slice bounds still to apply to them.
+        """
+        entries = getattr(self.query, 'ldap_entries', None)
+        if entries is not None:
+            # Entries fetched by afetch_entries()
+            return entries, 0, None
+
+        lookups = query_as_ldap_chunks(self.query, compiler=self, connection=self.connection)
+        if lookups is None:
+            return None, 0, None
+        # Writes to any of the searched subtrees affect the results.
+        base = ldapdb_cache.common_ancestor([lookup.base for lookup in lookups])
+        attrlist = self.get_attrlist()
+
+        # Stream entries from the server by chunks of the expected size.
+        page_size = chunk_size if chunked_fetch else None
+        ordering = self.get_ldap_ordering()
+
+        query_cache = self.connection.query_cache
+        ttl = getattr(self.query.model, 'query_cache_ttl', None)
+        if query_cache is None or chunked_fetch or self.query.distinct or ttl == 0:
+            vals, low_mark, high_mark = self.search_entries(lookups, attrlist, page_size, ordering)
+        else:
+            key = (
+                tuple(lookups),
+                tuple(attrlist),
+                tuple((field.get_attname(), reverse) for field, reverse in ordering),
+                self.query.low_mark,
+                self.query.high_mark,
+            )
+            vals = query_cache.get(key, base)
+            if vals is None:
+                version = query_cache.version(base)
+                vals, low_mark, high_mark = self.search_entries(lookups, attrlist, page_size, ordering)
+                try:
+                    # Cache the requested slice only.
+                    vals = [] if vals is None else list(itertools.islice(vals, low_mark, high_mark))
+                except ldap.NO_SUCH_OBJECT:
+                    vals = []
+                query_cache.set(key, base, vals, ttl=ttl, version=version)
+            low_mark, high_mark = 0, None
+        return vals, low_mark, high_mark
+
+    def search_entries(self, lookups, attrlist, page_size, ordering):
+        """Fetch the entries matching any of lookups, sorted according to ordering.
+
+        Returns the (dn, attrs) pairs, or None if the search base doesn't
+        exist, along with the slice bounds still to apply to them.
+        """
+        vals = None
+        # Slice bounds still to apply to the results
+        low_mark, high_mark = self.query.low_mark, self.query.high_mark
+        # Results of several lookups are merged, then sorted client-side.
+        sort_control = self.server_sort_control(ordering) if len(lookups) == 1 else None
+        if sort_control is not None:
+            lookup = lookups[0]
+            if self._can_use_vlv():
+                vals = self._vlv_search(lookup, attrlist, sort_control)
+                if vals is not None:
+                    # Only the requested window was returned.
+                    low_mark, high_mark = 0, None
+            if vals is None:
+                vals = self._server_sorted_search(
+                    lookup, attrlist, sort_control, page_size,
+                    sizelimit=self._size_limit(),
+                )
+
+        if vals is None:
             try:
-                next(iterator)
-                return True
-            except StopIteration:
-                return False
+                vals = self.search_lookups(
+                    lookups,
+                    attrlist=attrlist,
+                    page_size=page_size,
+                    # Without ordering, any high_mark entries will do.
+                    sizelimit=0 if ordering else self._size_limit(),
+                )
+            except ldap.NO_SUCH_OBJECT:
+                return None, low_mark, high_mark
+
+            vals = self.sort_entries(vals, ordering)
+
+        return vals, low_mark, high_mark
+
+    def sort_entries(self, vals, ordering):
+        """Sort (dn, attrs) pairs client-side, according to ordering."""
+        for field, reverse in reversed(ordering):
+            if field.get_attname() == 'dn':
+                vals = sorted(vals, key=lambda pair: pair[0], reverse=reverse)
+            else:
+                def get_key(obj):
+                    attr = field.from_ldap(
+                        obj[1].get(field.db_column, []),
+                        connection=self.connection,
+                    )
+                    if hasattr(attr, 'lower'):
+                        attr = attr.lower()
+                    return attr
+                vals = sorted(vals, key=get_key, reverse=reverse)
+        return vals
+
+    def search_lookups(self, lookups, attrlist, page_size=None, sizelimit=0):
+        """Search the entries matching any of lookups, yielding (dn, attrs) pairs."""
+        if len(lookups) == 1:
+            lookup = lookups[0]
+            return self.connection.search_s(
+                base=lookup.base,
+                scope=lookup.scope,
+                filterstr=lookup.filterstr,
+                attrlist=attrlist,
+                page_size=page_size,
+                sizelimit=sizelimit,
+            )
+        return self.connection.search_union(
+            [(lookup.base, lookup.scope, lookup.filterstr) for lookup in lookups],
+            attrlist=attrlist,
+            page_size=page_size,
+            sizelimit=sizelimit,
+        )
+
+    def get_ldap_ordering(self):
+        """Return the requested ordering, as a list of (field, reverse) pairs."""
+        if self.query.extra_order_by:
+            ordering = self.query.extra_order_by
+        elif not self.query.default_ordering:
+            ordering = self.query.order_by
         else:
+            ordering = self.query.order_by or self.query.model._meta.ordering
+
+        fields = []
+        for fieldname in ordering:
+            if fieldname.startswith('-'):
+                sort_field = fieldname[1:]
+                reverse = True
+            else:
+                sort_field = fieldname
+                reverse = False
+
+            if sort_field == 'pk':
+                sort_field = self.query.model._meta.pk.name
+            fields.append((self.query.model._meta.get_field(sort_field), reverse))
+        return fields
+
+    def server_sort_control(self, ordering):
+        """Build a server-side sort control (RFC 2891) for the ordering.
+
+        Returns None if there is nothing to sort, or the server can't perform
+        the sort; results should then be sorted client-side.
+        """
+        if not ordering or not self.connection.features.supports_server_side_sort:
+            return None
+
+        rules = []
+        for field, reverse in ordering:
+            if not field.db_column:
+                # The DN is not an attribute, the server can't sort on it.
+                return None
+            rules.append('%s%s' % ('-' if reverse else '', field.db_column))
+
+        if tuple(rules) in self.connection.failed_sort_rules:
+            return None
+        return ldap.controls.sss.SSSRequestControl(criticality=True, ordering_rules=rules)
+
+    def _size_limit(self):
+        """Maximum number of entries to request from the server, 0 for no limit.
+
+        Only valid when results are not sorted client-side.
+        """
+        if self.query.high_mark is None or self.query.distinct:
+            return 0
+        return self.query.high_mark
+
+    def _server_sorted_search(self, lookup, attrlist, sort_control, page_size, sizelimit=0):
+        """Run a search sorted by the server.
+
+        Returns None if the server refused to sort the results.
+        """
+        vals = self.connection.search_s(
+            base=lookup.base,
+            scope=lookup.scope,
+            filterstr=lookup.filterstr,
+            attrlist=attrlist,
+            page_size=page_size,
+            serverctrls=[sort_control],
+            sizelimit=sizelimit,
+        )
+        # The server reports sorting failures along with the first page.
+        try:
+            first = next(vals)
+        except (StopIteration, ldap.NO_SUCH_OBJECT):
+            return iter(())
+        except _SORT_ERRORS:
+            self.connection.failed_sort_rules.add(tuple(sort_control.ordering_rules))
+            return None
+        return itertools.chain([first], vals)
+
+    def _can_use_vlv(self):
+        return (
+            self.query.high_mark is not None
+            and not self.query.distinct
+            and self.connection.features.supports_virtual_list_view
+        )
+
+    def _vlv_search(self, lookup, attrlist, sort_control):
+        """Fetch the requested slice of sorted results, using a Virtual List View.
+
+        Returns None if the server refused the request.
+        """
+        rules = tuple(sort_control.ordering_rules)
+        if rules in self.connection.failed_vlv_rules:
+            return None
+        try:
+            return self.connection.search_vlv_s(
+                base=lookup.base,
+                scope=lookup.scope,
+                filterstr=lookup.filterstr,
+                attrlist=attrlist,
+                sort_control=sort_control,
+                offset=self.query.low_mark,
+                count=self.query.high_mark - self.query.low_mark,
+            )
+        except ldap.NO_SUCH_OBJECT:
+            return []
+        except _SORT_ERRORS + (ldap.VLV_ERROR,):
+            self.connection.failed_vlv_rules.add(rules)
+            return None
+
+    def has_results(self):
+        """Tell whether the query matches any entry, fetching at most one of them."""
+        lookups = query_as_ldap_chunks(self.query, compiler=self, connection=self.connection)
+        if lookups is None:
             return False
 
+        # QuerySet.exists() sets the upper bound right after the lower bound.
+        vals = self.search_lookups(
+            lookups,
+            attrlist=['1.1'],
+            sizelimit=self.query.high_mark or self.query.low_mark + 1,
+        )
+        try:
+            for _entry in itertools.islice(vals, self.query.low_mark, None):
+                return True
+            return False
+        except ldap.NO_SUCH_OBJECT:
+            return False
+        finally:
+            # Abandon the search if it is still running.
+            vals.close()
+
+    async def asearch_lookups(self, lookups, attrlist, sizelimit=0, serverctrls=None):
+        """Asynchronous version of search_lookups().
+
+        Several lookups are searched concurrently on the connection, up to
+        SEARCH_CONCURRENCY at a time, and their entries merged in the order of
+        lookups; a single one streams its entries as they arrive.
+        """
+        if len(lookups) == 1:
+            lookup = lookups[0]
+            vals = self.connection.asearch_s(
+                base=lookup.base,
+                scope=lookup.scope,
+                filterstr=lookup.filterstr,
+                attrlist=attrlist,
+                serverctrls=serverctrls,
+                sizelimit=sizelimit,
+            )
+            try:
+                async for entry in vals:
+                    yield entry
+            finally:
+                await vals.aclose()
+            return
+
+        semaphore = asyncio.Semaphore(self.connection.search_concurrency)
+
+        async def search(lookup):
+            async with semaphore:
+                vals = self.connection.asearch_s(
+                    base=lookup.base,
+                    scope=lookup.scope,
+                    filterstr=lookup.filterstr,
+                    attrlist=attrlist,
+                    serverctrls=serverctrls,
+                    sizelimit=sizelimit,
+                )
+                try:
+                    return [entry async for entry in vals]
+                except ldap.NO_SUCH_OBJECT:
+                    # Like search_union(), searches on a missing base match no entry.
+                    return []
+                finally:
+                    await vals.aclose()
+
+        seen = set()
+        for vals in await asyncio.gather(*[search(lookup) for lookup in lookups]):
+            for dn, attrs in vals:
+                key = ldapdb_cache.normalize_dn(dn)
+                if key in seen:
+                    continue
+                seen.add(key)
+                yield dn, attrs
+                if len(seen) == sizelimit:
+                    return
+
+    async def afetch_entries(self):
+        """Asynchronous version of fetch_entries(), returning the sorted and sliced entries.
+
+        Like search_entries(), a single lookup is sorted by the server if
+        possible, fetching at most high_mark entries; virtual list views and
+        caches are not used.
+        """
+        lookups = query_as_ldap_chunks(self.query, compiler=self, connection=self.connection)
+        if lookups is None:
+            return []
+
+        attrlist = self.get_attrlist()
+        ordering = self.get_ldap_ordering()
+        # Results of several lookups are merged, then sorted client-side.
+        sort_control = self.server_sort_control(ordering) if len(lookups) == 1 else None
+        try:
+            if sort_control is not None:
+                try:
+                    vals = self.asearch_lookups(
+                        lookups,
+                        attrlist=attrlist,
+                        sizelimit=self._size_limit(),
+                        serverctrls=[sort_control],
+                    )
+                    entries = [entry async for entry in vals]
+                    return entries[self.query.low_mark:self.query.high_mark]
+                except _SORT_ERRORS:
+                    self.connection.failed_sort_rules.add(tuple(sort_control.ordering_rules))
+
+            vals = self.asearch_lookups(
+                lookups,
+                attrlist=attrlist,
+                # Without ordering, any high_mark entries will do.
+                sizelimit=0 if ordering else self._size_limit(),
+            )
+            entries = [entry async for entry in vals]
+        except ldap.NO_SUCH_OBJECT:
+            return []
+        entries = self.sort_entries(entries, ordering)
+        return entries[self.query.low_mark:self.query.high_mark]
+
+    async def acount_entries(self):
+        """Asynchronous version of count_entries()."""
+        query = getattr(self.query, 'inner_query', None) or self.query
+        lookups = query_as_ldap_chunks(query, compiler=self, connection=self.connection)
+        if lookups is None:
+            return 0
+
+        count = 0
+        try:
+            async for _entry in self.asearch_lookups(lookups, attrlist=['1.1'], sizelimit=query.high_mark or 0):
+                count += 1
+        except ldap.NO_SUCH_OBJECT:
+            return 0
+        return max(count - query.low_mark, 0)
+
+    async def ahas_results(self):
+        """Asynchronous version of has_results()."""
+        lookups = query_as_ldap_chunks(self.query, compiler=self, connection=self.connection)
+        if lookups is None:
+            return False
+
+        vals = self.asearch_lookups(
+            lookups,
+            attrlist=['1.1'],
+            sizelimit=self.query.high_mark or self.query.low_mark + 1,
+        )
+        pos = 0
+        try:
+            async for _entry in vals:
+                if pos >= self.query.low_mark:
+                    return True
+                pos += 1
+            return False
+        except ldap.NO_SUCH_OBJECT:
+            return False
+        finally:
+            # Abandon the search if it is still running.
+            await vals.aclose()
+
 
 class SQLInsertCompiler(compiler.SQLInsertCompiler, SQLCompiler):
-    pass
+    def execute_sql(self, returning_fields=None):
+        # Like Model._save_table(), primary keys only make up the DN.
+        fields = [field for field in self.query.fields if not field.primary_key]
+        entries = [
+            (obj, obj.build_dn(), obj.build_add_modlist(fields, self.connection))
+            for obj in self.query.objs
+        ]
+
+        created = set()
+        try:
+            created.update(run_pipeline(
+                self.connection,
+                ((dn, 'add_ext', (modlist,)) for _obj, dn, modlist in entries),
+                action='create',
+            ))
+        except BulkOperationError as e:
+            created.update(e.succeeded)
+            raise
+        finally:
+            for obj, dn, _modlist in entries:
+                if dn in created:
+                    obj.dn = obj._saved_dn = dn
+                    obj._ldap_snapshot = obj._get_db_values(fields, self.connection)
+        return []
 
 
 class SQLDeleteCompiler(compiler.SQLDeleteCompiler, SQLCompiler):
     def execute_sql(self, result_type=compiler.MULTI):
-        lookup = query_as_ldap(self.query, compiler=self, connection=self.connection)
-        if not lookup:
+        lookups = query_as_ldap_chunks(self.query, compiler=self, connection=self.connection)
+        if not lookups:
             return
 
         try:
-            vals = self.connection.search_s(
-                base=lookup.base,
-                scope=lookup.scope,
-                filterstr=lookup.filterstr,
-                attrlist=['dn'],
-            )
+            dns = [dn for dn, _attrs in self.search_lookups(lookups, attrlist=['1.1'])]
         except ldap.NO_SUCH_OBJECT:
             return
 
-        # FIXME : there is probably a more efficient way to do this
-        for dn, attrs in vals:
-            self.connection.delete_s(dn)
+        # Entries removed concurrently are not counted as deleted.
+        deleted = run_pipeline(
+            self.connection,
+            ((dn, 'delete_ext', ()) for dn in dns),
+            action='delete',
+            ignored=ldap.NO_SUCH_OBJECT,
+        )
+        return RowCount(len(deleted))
 
 
 class SQLUpdateCompiler(compiler.SQLUpdateCompiler, SQLCompiler):
-    pass
+    def get_modlist(self):
+        """Build the modlist applied to every matching entry."""
+        modlist = []
+        for field, _model, value in self.query.values:
+            if field.primary_key:
+                raise LdapDBError("Cannot update %s: primary keys make up the DN" % field.name)
+            if isinstance(value, AttributeOperation):
+                modlist.extend(value.as_ldap_modlist(field, self.connection))
+                continue
+            if hasattr(value, 'resolve_expression'):
+                raise LdapDBError("Unsupported update value for %s: %r" % (field.name, value))
+            # Replacing with an empty list removes the attribute, if present.
+            modlist.append((
+                ldap.MOD_REPLACE,
+                field.db_column,
+                field.get_db_prep_save(value, connection=self.connection),
+            ))
+        return modlist
+
+    def execute_sql(self, result_type=compiler.MULTI):
+        modlist = self.get_modlist()
+        lookups = query_as_ldap_chunks(self.query, compiler=self, connection=self.connection)
+        if not lookups or not modlist:
+            return 0
+
+        try:
+            dns = [dn for dn, _attrs in self.search_lookups(lookups, attrlist=['1.1'])]
+        except ldap.NO_SUCH_OBJECT:
+            return 0
+
+        # Entries removed concurrently are not counted as modified.
+        modified = run_pipeline(
+            self.connection,
+            ((dn, 'modify_ext', (modlist,)) for dn in dns),
+            action='update',
+            ignored=ldap.NO_SUCH_OBJECT,
+        )
+        return len(modified)
 
 
 class SQLAggregateCompiler(compiler.SQLAggregateCompiler, SQLCompiler):
     def execute_sql(self, result_type=compiler.SINGLE):
         # Return only number values through the aggregate compiler
         output = super().execute_sql(result_type)
+        if output is None:
+            return None
         return filter(lambda a: isinstance(a, int), output)
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+# This software is distributed under the two-clause BSD license.
+# Copyright (c) The django-ldapdb project
+
+import random
+import threading
+import time
+
+from asgiref.local import Local
+
+
+class ServerHealth(object):
+    """Thread-safe load and health indicators of a LDAP database, shared by all connections of the process.
+
+    - ``latency``: exponentially weighted moving average of response times,
+      in seconds (None until measured); recent samples weigh ``smoothing``;
+    - ``outstanding``: number of searches currently running;
+    - ``last_failure``: monotonic time at which the server was last found
+      unreachable, reset by the next successful exchange.
+    """
+
+    def __init__(self, smoothing=0.2):
+        self.smoothing = smoothing
+        self._lock = threading.Lock()
+        self.latency = None
+        self.outstanding = 0
+        self.last_failure = None
+
+    def record_latency(self, seconds):
+        with self._lock:
+            if self.latency is None:
+                self.latency = seconds
+            else:
+                self.latency += self.smoothing * (seconds - self.latency)
+            self.last_failure = None
+
+    def begin(self):
+        with self._lock:
+            self.outstanding += 1
+
+    def end(self):
+        with self._lock:
+            self.outstanding -= 1
+
+    def failure(self):
+        with self._lock:
+            self.last_failure = time.monotonic()
+
+    def ejected(self, eject_time):
+        """Whether the server failed less than ``eject_time`` seconds ago."""
+        last_failure = self.last_failure
+        return last_failure is not None and time.monotonic() - last_failure < eject_time
+
+    def stats(self):
+        with self._lock:
+            return {
+                'latency': self.latency,
+                'outstanding': self.outstanding,
+                'last_failure': self.last_failure,
+            }
+
+
+_health = {}
+_health_lock = threading.Lock()
+
+
+def get_health(alias):
+    """Return the health indicators of the database ``alias``, creating them if needed."""
+    with _health_lock:
+        health = _health.get(alias)
+        if health is None:
+            health = _health[alias] = ServerHealth()
+        return health
+
+
+def clear_health():
+    """Forget all health indicators."""
+    with _health_lock:
+        _health.clear()
+
+
+# Time of the last write of the current request (or thread), for routers.
+_last_write = Local()
+
+
+def record_write():
+    """Note that the current request wrote to a LDAP database."""
+    _last_write.time = time.monotonic()
+
+
+def last_write():
+    """Monotonic time of the last write of the current request, if any."""
+    return getattr(_last_write, 'time', None)
+
+
+def reset_last_write(**kwargs):
+    """Forget writes of the previous request; connected to ``request_started`` by ldapdb.router."""
+    _last_write.time = None
+
+
+class CircuitBreaker(object):
+    """Thread-safe circuit breaker guarding connections to a LDAP server, shared by all connections of the process.
+
+    The breaker opens after ``failure_threshold`` consecutive connection failures,
+    rejecting attempts for a while: ``reset_timeout`` seconds, doubled each time
+    it opens again without a success in between, up to ``max_reset_timeout``.
+    That delay is randomized between half and all of its value, so that
+    processes don't all retry at the same time.
+
+    Once the delay elapsed, the breaker is half-open: a single attempt is let
+    through, closing the breaker if it succeeds, opening it again otherwise.
+    """
+
+    def __init__(self, failure_threshold=3, reset_timeout=5, max_reset_timeout=300):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self._lock = threading.Lock()
+        # Consecutive failures, and consecutive openings
+        self.failures = 0
+        self.trips = 0
+        # Monotonic time until which attempts are rejected, while open
+        self.open_until = None
+        # Whether the single attempt of the half-open state is running
+        self._probing = False
+
+    @property
+    def state(self):
+        with self._lock:
+            if self.open_until is None:
+                return 'closed'
+            if time.monotonic() < self.open_until or self._probing:
+                return 'open'
+            return 'half-open'
+
+    def allow(self):
+        """Tell whether a connection may be attempted; callers must report its outcome."""
+        with self._lock:
+            if self.open_until is None:
+                return True
+            if time.monotonic() < self.open_until or self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.trips = 0
+            self.open_until = None
+            self._probing = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._probing or self.failures >= self.failure_threshold:
+                self.trips += 1
+                timeout = min(self.reset_timeout * 2 ** (self.trips - 1), self.max_reset_timeout)
+                self.open_until = time.monotonic() + random.uniform(timeout / 2, timeout)
+                self._probing = False
+
+    def stats(self):
+        with self._lock:
+            return {
+                'failures': self.failures,
+                'trips': self.trips,
+                'open_until': self.open_until,
+            }
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(uri, **options):
+    """Return the circuit breaker of the server at ``uri``, creating it if needed."""
+    with _breakers_lock:
+        breaker = _breakers.get(uri)
+        if breaker is None:
+            breaker = _breakers[uri] = CircuitBreaker(**options)
+        return breaker
+
+
+def clear_breakers():
+    """Forget all circuit breakers."""
+    with _breakers_lock:
+        _breakers.clear()
+
+
+def backoff_delay(attempt, base, maximum):
+    """Delay before the ``attempt``-th retry (starting at 1): exponential, capped, with full jitter."""
+    return random.uniform(0, min(base * 2 ** (attempt - 1), maximum))
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+# This software is distributed under the two-clause BSD license.
+# Copyright (c) The django-ldapdb project
+
+import collections
+import logging
+import threading
+import time
+
+import ldap
+
+logger = logging.getLogger('ldapdb')
+
+
+class ConnectionPool(object):
+    """A thread-safe pool of bound LDAP connections.
+
+    Connections are built on demand through ``factory``, up to ``max_size``
+    concurrently open connections; callers beyond that limit wait up to
+    ``timeout`` seconds for a connection to be released.
+
+    Idle connections are closed after ``max_idle`` seconds, and any connection
+    is closed once it is older than ``max_lifetime`` seconds; ``None`` disables
+    either limit.
+
+    The pool also remembers when each connection last successfully exchanged
+    with the server, as reported on release, for liveness checks.
+    """
+
+    def __init__(self, factory, max_size=10, max_idle=300, max_lifetime=3600, timeout=30):
+        self.factory = factory
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.timeout = timeout
+
+        self._cond = threading.Condition()
+        # Idle connections, as (connection, released_at); most recently used on the right.
+        self._idle = collections.deque()
+        # Creation and last successful activity time of every open connection.
+        self._created = {}
+        self._last_active = {}
+        self._size = 0
+
+        self._stats = collections.Counter()
+
+    def _expired(self, connection, now):
+        if self.max_lifetime is None:
+            return False
+        return now - self._created[connection] >= self.max_lifetime
+
+    def _idle_expired(self, released_at, now):
+        if self.max_idle is None:
+            return False
+        return now - released_at >= self.max_idle
+
+    def _forget(self, connection):
+        """Remove a connection from the accounting; must hold the lock."""
+        del self._created[connection]
+        self._last_active.pop(connection, None)
+        self._size -= 1
+        self._stats['closed'] += 1
+        self._cond.notify()
+
+    def _close(self, connection):
+        try:
+            if hasattr(connection, '_l'):
+                connection.unbind_s()
+        except ldap.LDAPError:
+            logger.debug("Error while closing pooled LDAP connection", exc_info=True)
+
+    def _prune(self, now):
+        """Collect idle connections past their idle time or lifetime; must hold the lock."""
+        stale = []
+        for connection, released_at in list(self._idle):
+            if self._idle_expired(released_at, now):
+                self._stats['evicted_idle'] += 1
+            elif self._expired(connection, now):
+                self._stats['evicted_lifetime'] += 1
+            else:
+                continue
+            self._idle.remove((connection, released_at))
+            self._forget(connection)
+            stale.append(connection)
+        return stale
+
+    def acquire(self, wait=True):
+        """Check out a connection, building a new one if none is idle.
+
+        Without ``wait``, return None instead of waiting for a connection to be
+        released when ``max_size`` connections are in use.
+        """
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        waited = False
+        exhausted = False
+        stale = []
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                stale.extend(self._prune(now))
+                if self._idle:
+                    connection, _released_at = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    # Reserve the slot; the connection is built outside the lock.
+                    connection = None
+                    self._size += 1
+                    break
+
+                if not wait:
+                    exhausted = True
+                    break
+                if not waited:
+                    waited = True
+                    self._stats['waits'] += 1
+                remaining = None if deadline is None else deadline - now
+                if remaining is not None and remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise ldap.TIMEOUT({
+                        'desc': "Timed out waiting for a pooled LDAP connection",
+                        'info': "%d connections in use" % self._size,
+                    })
+                self._cond.wait(remaining)
+
+            if not exhausted:
+                self._stats['checkouts'] += 1
+
+        for stale_connection in stale:
+            self._close(stale_connection)
+
+        if exhausted:
+            return None
+        if connection is not None:
+            return connection
+
+        try:
+            connection = self.factory()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+        with self._cond:
+            # The connection was just bound.
+            self._created[connection] = self._last_active[connection] = time.monotonic()
+            self._stats['created'] += 1
+        return connection
+
+    def release(self, connection, discard=False, last_active=None):
+        """Return a checked out connection to the pool.
+
+        Connections flagged with ``discard``, or past their lifetime, are closed.
+        ``last_active`` is the monotonic time of the connection's last successful
+        exchange with the server; ``None`` if unknown, e.g. after an error.
+        """
+        now = time.monotonic()
+        with self._cond:
+            if connection not in self._created:
+                # Not ours, or already forgotten (e.g. the pool was cleared).
+                stale = [connection]
+            elif discard or self._expired(connection, now):
+                self._forget(connection)
+                stale = [connection]
+            else:
+                self._last_active[connection] = last_active
+                self._idle.append((connection, now))
+                self._cond.notify()
+                stale = []
+            self._stats['checkins'] += 1
+
+        for stale_connection in stale:
+            self._close(stale_connection)
+
+    def last_active(self, connection):
+        """Monotonic time of the connection's last known successful exchange with the server, if any."""
+        with self._cond:
+            return self._last_active.get(connection)
+
+    def discard_idle(self, predicate):
+        """Close the idle connections for which predicate(connection) is true, e.g. to a failed server."""
+        with self._cond:
+            stale = [connection for connection, _released_at in self._idle if predicate(connection)]
+            self._idle = collections.deque(
+                (connection, released_at) for connection, released_at in self._idle if not predicate(connection)
+            )
+            for connection in stale:
+                self._forget(connection)
+
+        for connection in stale:
+            self._close(connection)
+
+    def clear(self):
+        """Close all idle connections; checked out connections are closed on release."""
+        with self._cond:
+            stale = [connection for connection, _released_at in self._idle]
+            self._idle.clear()
+            for connection in stale:
+                self._forget(connection)
+            # Connections still in use are no longer tracked.
+            self._size -= len(self._created)
+            self._created.clear()
+            self._last_active.clear()
+            self._cond.notify_all()
+
+        for connection in stale:
+            self._close(connection)
+
+    def stats(self):
+        """Return a snapshot of the pool statistics."""
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update(
+                size=self._size,
+                idle=len(self._idle),
+                in_use=self._size - len(self._idle),
+                max_size=self.max_size,
+            )
+        for key in ('checkouts', 'checkins', 'waits', 'timeouts', 'created', 'closed',
+                    'evicted_idle', 'evicted_lifetime'):
+            stats.setdefault(key, 0)
+        return stats
+
+
+# key -> (pool, options)
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(key, factory, **options):
+    """Return the process-wide pool registered for ``key``, creating it if needed.
+
+    A pool registered with other options (e.g. after a settings change) is
+    replaced; its connections are closed as they are released.
+    """
+    replaced = None
+    with _pools_lock:
+        pool, pool_options = _pools.get(key, (None, None))
+        if pool is not None and pool_options != options:
+            replaced, pool = pool, None
+        if pool is None:
+            pool = ConnectionPool(factory, **options)
+            _pools[key] = (pool, options)
+    if replaced is not None:
+        replaced.clear()
+    return pool
+
+
+def clear_pools():
+    """Close all idle pooled connections, and forget the pools."""
+    with _pools_lock:
+        pools = [pool for pool, _options in _pools.values()]
+        _pools.clear()
+    for pool in pools:
+        pool.clear()
@@ -2,4 +2,4 @@
 # This software is distributed under the two-clause BSD license.
 # Copyright (c) The django-ldapdb project
 
-from ldapdb.models.base import Model  # noqa
+from ldapdb.models.base import Manager, Model, QuerySet  # noqa
@@ -6,31 +6,172 @@ import logging
 
 import django.db.models
 import ldap
+from asgiref.sync import sync_to_async
 from django.db import connections, router
 from django.db.models import signals
+from django.db.models.query import MAX_GET_RESULTS
 
 from . import fields as ldapdb_fields
 
 logger = logging.getLogger('ldapdb')
 
 
+def build_delta_modlist(colname, old_values, new_values):
+    """
+    Build the modlist turning the values of a multi-valued attribute from old_values into new_values.
+
+    Only added and removed values are sent, unless that amounts to more values
+    than replacing the whole attribute.
+    """
+    old_set = set(old_values)
+    new_set = set(new_values)
+    removed = [value for value in old_values if value not in new_set]
+    added = [value for value in new_values if value not in old_set]
+
+    if len(removed) + len(added) >= len(new_values):
+        return [(ldap.MOD_DELETE if new_values == [] else ldap.MOD_REPLACE, colname, new_values)]
+
+    modlist = []
+    if removed:
+        modlist.append((ldap.MOD_DELETE, colname, removed))
+    if added:
+        modlist.append((ldap.MOD_ADD, colname, added))
+    return modlist
+
+
+class QuerySet(django.db.models.QuerySet):
+    """
+    QuerySet of LDAP models.
+    """
+
+    def in_bases(self, base_dns):
+        """
+        Search below each of base_dns, instead of the model's base_dn.
+
+        The searches run concurrently on pooled connections (see the
+        SEARCH_CONCURRENCY setting), and their results are merged: ordering
+        and slicing apply to all matching entries.
+        """
+        clone = self._chain()
+        clone.query.ldap_base_dns = list(base_dns)
+        return clone
+
+    # Asynchronous API: searches run on the event loop, instead of in a thread.
+
+    async def _afetch_all(self):
+        if self._result_cache is None:
+            compiler = self.query.get_compiler(using=self.db)
+            clone = self._chain()
+            # Instances are then built from the fetched entries, without any further search.
+            clone.query.ldap_entries = await compiler.afetch_entries()
+            self._result_cache = list(self._iterable_class(clone))
+        if self._prefetch_related_lookups and not self._prefetch_done:
+            await sync_to_async(self._prefetch_related_objects)()
+
+    def __aiter__(self):
+        async def generator():
+            await self._afetch_all()
+            for item in self._result_cache:
+                yield item
+
+        return generator()
+
+    async def acount(self):
+        if self._result_cache is not None:
+            return len(self._result_cache)
+        return await self.query.get_compiler(using=self.db).acount_entries()
+
+    async def aexists(self):
+        if self._result_cache is not None:
+            return bool(self._result_cache)
+        query = self.query.exists()
+        return await query.get_compiler(using=self.db).ahas_results()
+
+    async def aget(self, *args, **kwargs):
+        clone = self.filter(*args, **kwargs)
+        if clone.query.can_filter():
+            clone = clone.order_by()
+        clone.query.set_limits(high=MAX_GET_RESULTS)
+        await clone._afetch_all()
+        num = len(clone._result_cache)
+        if num == 1:
+            return clone._result_cache[0]
+        if not num:
+            raise self.model.DoesNotExist(
+                "%s matching query does not exist." % self.model._meta.object_name
+            )
+        raise self.model.MultipleObjectsReturned(
+            "get() returned more than one %s -- it returned %s!" % (
+                self.model._meta.object_name,
+                num if num < MAX_GET_RESULTS else 'more than %s' % (MAX_GET_RESULTS - 1),
+            )
+        )
+
+
+Manager = django.db.models.Manager.from_queryset(QuerySet)
+
+
 class Model(django.db.models.base.Model):
     """
     Base class for all LDAP models.
     """
     dn = ldapdb_fields.CharField(max_length=200, primary_key=True)
 
+    objects = Manager()
+
     # meta-data
     base_dn = None
     search_scope = ldap.SCOPE_SUBTREE
     object_classes = ['top']
+    # Lifetime of cached search results (see the QUERY_CACHE setting);
+    # None uses the setting's TTL, 0 disables caching for this model.
+    query_cache_ttl = None
+    # Compare changes against the entry fetched from the server before saving,
+    # instead of the values the instance was loaded with.
+    verify_before_save = False
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        # Prepared values of attributes, as last loaded from or saved to the server.
+        self._ldap_snapshot = None
         self._saved_dn = self.dn
         if self.dn:
             self.base_dn = self.dn.split(',', 1)[1]
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        loaded = set(field_names)
+        instance._ldap_snapshot = instance._get_db_values(
+            [field for field in cls._meta.concrete_fields if field.attname in loaded and not field.primary_key],
+            connections[db],
+        )
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None, **kwargs):
+        deferred = self.get_deferred_fields()
+        super().refresh_from_db(using=using, fields=fields, **kwargs)
+        refreshed = [
+            field
+            for field in self._meta.concrete_fields
+            if not field.primary_key and (
+                field.attname in fields if fields is not None else field.attname not in deferred
+            )
+        ]
+        self._ldap_snapshot = dict(
+            self._ldap_snapshot or {},
+            **self._get_db_values(refreshed, connections[self._state.db]),
+        )
+
+    def _get_db_values(self, fields, connection):
+        """
+        Prepare the values of the given fields, keyed by attribute name.
+        """
+        return {
+            field.attname: field.get_db_prep_save(getattr(self, field.attname), connection=connection)
+            for field in fields
+        }
+
     def build_rdn(self):
         """
         Build the Relative Distinguished Name for this entry.
@@ -50,6 +191,20 @@ class Model(django.db.models.base.Model):
         """
         return "%s,%s" % (self.build_rdn(), self.base_dn)
 
+    def build_add_modlist(self, fields, connection):
+        """
+        Build the modlist creating this entry, holding the values of the given fields.
+        """
+        # FIXME(rbarrois): This should be handled through a hidden field.
+        modlist = [
+            ('objectClass', [obj_class.encode('utf-8') for obj_class in self.object_classes])
+        ]
+        for field in sorted(fields, key=lambda field: field.db_column):
+            value = field.get_db_prep_save(getattr(self, field.get_attname()), connection=connection)
+            if value != []:
+                modlist.append((field.db_column, value))
+        return modlist
+
     def delete(self, using=None):
         """
         Delete this entry.
@@ -82,18 +237,20 @@ class Model(django.db.models.base.Model):
                 if field.concrete and not field.primary_key
             ]
 
-        def get_field_value(field, instance):
-            python_value = getattr(instance, field.get_attname())
-            return field.get_db_prep_save(python_value, connection=connection)
-
+        new_values = self._get_db_values(target_fields, connection)
+        snapshot = self._ldap_snapshot or {}
         if create:
-            old = None
-        else:
+            old_values = {}
+        elif self.verify_before_save or any(field.attname not in snapshot for field in target_fields):
+            # Unknown (or untrusted) previous values: fetch them.
             old = cls._base_manager.using(using).get(dn=self._saved_dn)
+            old_values = old._get_db_values(target_fields, connection)
+        else:
+            old_values = snapshot
         changes = {
             field.db_column: (
-                None if old is None else get_field_value(field, old),
-                get_field_value(field, self),
+                old_values.get(field.attname),
+                new_values[field.attname],
             )
             for field in target_fields
         }
@@ -106,31 +263,31 @@ class Model(django.db.models.base.Model):
 
         # Insertion
         if create:
-            # FIXME(rbarrois): This should be handled through a hidden field.
-            hidden_values = [
-                ('objectClass', [obj_class.encode('utf-8') for obj_class in self.object_classes])
-            ]
-            new_values = hidden_values + [
-                (colname, change[1])
-                for colname, change in sorted(changes.items())
-                if change[1] != []
-            ]
             new_dn = self.build_dn()
             logger.debug("Creating new LDAP entry %s", new_dn)
-            connection.add_s(new_dn, new_values)
+            connection.add_s(new_dn, self.build_add_modlist(target_fields, connection))
 
         # Update
         else:
+            multi_valued = {field.db_column for field in target_fields if field.multi_valued_field}
             modlist = []
+            # The same changes, replacing attributes instead of sending added and removed values.
+            replace_modlist = []
             for colname, change in sorted(changes.items()):
                 old_value, new_value = change
                 if old_value == new_value:
                     continue
-                modlist.append((
+                if colname in multi_valued and old_value:
+                    modlist.extend(build_delta_modlist(colname, old_value, new_value))
+                    replace_modlist.append((ldap.MOD_REPLACE, colname, new_value))
+                    continue
+                modification = (
                     ldap.MOD_DELETE if new_value == [] else ldap.MOD_REPLACE,
                     colname,
                     new_value,
-                ))
+                )
+                modlist.append(modification)
+                replace_modlist.append(modification)
 
             if new_dn != old_dn:
                 logger.debug("renaming ldap entry %s to %s", old_dn, new_dn)
@@ -138,13 +295,22 @@ class Model(django.db.models.base.Model):
 
             if modlist:
                 logger.debug("Modifying existing LDAP entry %s", new_dn)
-                connection.modify_s(new_dn, modlist)
+                try:
+                    connection.modify_s(new_dn, modlist)
+                except (ldap.NO_SUCH_ATTRIBUTE, ldap.TYPE_OR_VALUE_EXISTS):
+                    if modlist == replace_modlist:
+                        raise
+                    # Values changed on the server since the instance was loaded:
+                    # overwrite them, as when saving the whole attribute.
+                    logger.debug("Replacing attributes of LDAP entry %s", new_dn)
+                    connection.modify_s(new_dn, replace_modlist)
             updated = True
 
         self.dn = new_dn
 
         # Finishing
         self._saved_dn = self.dn
+        self._ldap_snapshot = dict(snapshot, **new_values)
         return updated
 
     @classmethod
@@ -174,3 +340,26 @@ class Model(django.db.models.base.Model):
 
     class Meta:
         abstract = True
+
+
+def use_ldap_queryset(sender, **kwargs):
+    """
+    Have the managers of LDAP models build ldapdb QuerySets.
+
+    Custom managers subclassing django.db.models.Manager would otherwise build
+    plain QuerySets, whose asynchronous methods run searches in a thread.
+    """
+    if not issubclass(sender, Model):
+        return
+    # Managers inherited from abstract models are copied from their local_managers.
+    managers = list(sender._meta.managers)
+    for klass in sender.__mro__:
+        opts = getattr(klass, '_meta', None)
+        if opts is not None:
+            managers.extend(opts.local_managers)
+    for manager in managers:
+        if manager._queryset_class is django.db.models.QuerySet:
+            manager._queryset_class = QuerySet
+
+
+signals.class_prepared.connect(use_ldap_queryset, dispatch_uid='ldapdb.models.use_ldap_queryset')
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+# This software is distributed under the two-clause BSD license.
+# Copyright (c) The django-ldapdb project
+
+import ldap
+from django.core.exceptions import FieldError
+
+from . import fields as ldapdb_fields
+
+
+class AttributeOperation(object):
+    """
+    Base class for in-place modifications of an attribute, for QuerySet.update().
+
+    The server applies the modification to the values it stores; the entries
+    don't have to be read first.
+    """
+    operation = None
+
+    def resolve_expression(self, *args, **kwargs):
+        # Nothing to resolve: the modification is sent as is.
+        return self
+
+    def check_field(self, field):
+        raise NotImplementedError()
+
+    def get_values(self, field, connection):
+        raise NotImplementedError()
+
+    def as_ldap_modlist(self, field, connection):
+        self.check_field(field)
+        return [(self.operation, field.db_column, self.get_values(field, connection))]
+
+
+class Increment(AttributeOperation):
+    """
+    Add ``amount`` to an IntegerField (RFC 4525); use a negative amount to decrement.
+    """
+    operation = ldap.MOD_INCREMENT
+
+    def __init__(self, amount=1):
+        self.amount = amount
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.amount)
+
+    def check_field(self, field):
+        if not isinstance(field, ldapdb_fields.IntegerField):
+            raise FieldError("Cannot increment non-integer field %s" % field.name)
+
+    def get_values(self, field, connection):
+        return field.get_db_prep_save(self.amount, connection=connection)
+
+
+class AddValues(AttributeOperation):
+    """
+    Add values to a ListField.
+    """
+    operation = ldap.MOD_ADD
+
+    def __init__(self, *values):
+        if not values:
+            raise ValueError("%s requires at least one value" % self.__class__.__name__)
+        self.values = list(values)
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join(repr(value) for value in self.values))
+
+    def check_field(self, field):
+        if not field.multi_valued_field:
+            raise FieldError("Cannot add values to single-valued field %s" % field.name)
+
+    def get_values(self, field, connection):
+        return field.get_db_prep_save(self.values, connection=connection)
+
+
+class RemoveValues(AddValues):
+    """
+    Remove values from a ListField.
+    """
+    operation = ldap.MOD_DELETE
+
+    def check_field(self, field):
+        if not field.multi_valued_field:
+            raise FieldError("Cannot remove values from single-valued field %s" % field.name)
@@ -2,8 +2,17 @@
 # This software is distributed under the two-clause BSD license.
 # Copyright (c) The django-ldapdb project
 
+import asyncio
+import random
+import time
+
+import ldap
 from django.apps import apps
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import request_started
+from django.db import DatabaseError, connections
 
+from ldapdb.backends.ldap import health as ldapdb_health
 from ldapdb.models import Model
 
 
@@ -53,3 +62,126 @@ class Router(object):
         if is_ldap_model(model):
             return self.ldap_alias
         return None
+
+
+# Response times below that are considered equivalent, in seconds.
+MIN_LATENCY = 0.001
+
+# Forget writes of the previous request.
+reset_last_write = ldapdb_health.reset_last_write
+request_started.connect(reset_last_write, dispatch_uid='ldapdb.router.reset_last_write')
+
+
+class ReplicaRouter(Router):
+    """
+    A router sending writes on LDAP models to the primary LDAP database, and
+    reads to its replicas.
+
+    Replicas are the aliases listed in the ``REPLICAS`` key of the primary
+    database settings; the primary is the first LDAP database not listed as a
+    replica. The following keys of the primary settings tune the routing:
+
+    - ``REPLICA_SELECTION``: ``'latency'`` spreads reads at random, each
+      replica getting a share inversely proportional to its response time;
+      ``'least_outstanding'`` picks the replica running the fewest searches;
+    - ``REPLICA_EJECT_TIME``: seconds during which a replica which failed to
+      answer gets no reads;
+    - ``READ_YOUR_WRITES_WINDOW``: seconds during which reads go to the
+      primary after a write, within the same request.
+
+    Before being picked, a replica is connected to (or its connection checked,
+    see ``LIVENESS_INTERVAL``); should that fail, it is ejected, and another
+    one is picked.
+    """
+
+    def __init__(self):
+        from django.conf import settings
+        ldap_aliases = [
+            alias for alias, settings_dict in settings.DATABASES.items()
+            if settings_dict['ENGINE'] == 'ldapdb.backends.ldap'
+        ]
+        replicas = {
+            replica
+            for alias in ldap_aliases
+            for replica in settings.DATABASES[alias].get('REPLICAS', [])
+        }
+        primaries = [alias for alias in ldap_aliases if alias not in replicas]
+        self.ldap_alias = primaries[0] if primaries else None
+
+        options = settings.DATABASES[self.ldap_alias] if self.ldap_alias else {}
+        self.replicas = list(options.get('REPLICAS', []))
+        self.selection = options.get('REPLICA_SELECTION', 'latency')
+        if self.selection not in ('latency', 'least_outstanding'):
+            raise ImproperlyConfigured("Unknown LDAP replica selection: %r" % self.selection)
+        self.eject_time = options.get('REPLICA_EJECT_TIME', 30)
+        self.read_your_writes_window = options.get('READ_YOUR_WRITES_WINDOW', 5)
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in self.replicas:
+            return False
+        return super().allow_migrate(db, app_label, model_name=model_name, **hints)
+
+    def db_for_read(self, model, **hints):
+        "Point reads on LDAP models to a replica, unless the request just wrote"
+        alias = super().db_for_read(model, **hints)
+        if alias is None or not self.replicas:
+            return alias
+
+        # Writes are recorded by the database backend, as they are sent:
+        # db_for_write() is also used for reads, e.g. by get_or_create().
+        last_write = ldapdb_health.last_write()
+        if last_write is not None and time.monotonic() - last_write < self.read_your_writes_window:
+            return alias
+
+        failed = set()
+        while True:
+            replica = self.select_replica(exclude=failed)
+            if replica is None:
+                return alias
+            if self.check_replica(replica):
+                return replica
+            failed.add(replica)
+
+    def check_replica(self, alias):
+        """Tell whether the replica answers, connecting to it if needed; eject it otherwise.
+
+        Within an event loop, where connecting would block, replicas are
+        assumed to answer.
+        """
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            pass
+        else:
+            return True
+
+        try:
+            connections[alias].ensure_connection()
+        except (ldap.LDAPError, DatabaseError):
+            ldapdb_health.get_health(alias).failure()
+            return False
+        return True
+
+    def select_replica(self, exclude=()):
+        """Pick the replica to read from, or None if all of them (but those in exclude) are ejected."""
+        candidates = [
+            (replica, ldapdb_health.get_health(replica))
+            for replica in self.replicas
+            if replica not in exclude
+        ]
+        candidates = [(replica, health) for replica, health in candidates if not health.ejected(self.eject_time)]
+        if not candidates:
+            return None
+
+        if self.selection == 'least_outstanding':
+            fewest = min(health.outstanding for _replica, health in candidates)
+            return random.choice([replica for replica, health in candidates if health.outstanding == fewest])
+
+        # Replicas not measured yet are tried as if they were the fastest.
+        latencies = [health.latency for _replica, health in candidates if health.latency is not None]
+        fastest = min(latencies) if latencies else 1.0
+        weights = [
+            1.0 / max(fastest if health.latency is None else health.latency, MIN_LATENCY)
+            for _replica, health in candidates
+        ]
+        return random.choices([replica for replica, _health in candidates], weights=weights)[0]
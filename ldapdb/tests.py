@@ -3,8 +3,17 @@
 # Copyright (c) The django-ldapdb project
 
 
+import asyncio
+import collections
 import datetime
+import itertools
+import socket
+from unittest import mock
 
+import ldap
+from django.conf import settings
+from django.contrib.auth import models as auth_models
+from django.core.exceptions import FieldError, ImproperlyConfigured
 from django.db import connections
 from django.db.models import expressions
 from django.db.models.sql import query as django_query
@@ -12,8 +21,13 @@ from django.db.models.sql.where import AND, OR, WhereNode
 from django.test import TestCase
 from django.utils import timezone
 
-from ldapdb import escape_ldap_filter, models
+from ldapdb import escape_ldap_filter, models, router
+from ldapdb.backends.ldap import base as ldapdb_base
+from ldapdb.backends.ldap import cache as ldapdb_cache
 from ldapdb.backends.ldap import compiler as ldapdb_compiler
+from ldapdb.backends.ldap import health as ldapdb_health
+from ldapdb.backends.ldap import pool as ldapdb_pool
+from ldapdb.models import expressions as ldapdb_expressions
 from ldapdb.models import fields
 
 UTC = datetime.timezone.utc
@@ -248,30 +262,1457 @@ class WhereTestCase(TestCase):
         self.assertEqual(self._where_as_ldap(where), "(|(cn=foo)(givenName=bar))")
 
 
-class CompilerRegexTestCase(TestCase):
+class FilterTemplateTests(TestCase):
+    _build_lookup = WhereTestCase._build_lookup
 
-    def _run_regex(self, sql):
-        match = ldapdb_compiler._ORDER_BY_LIMIT_OFFSET_RE.search(sql)
-        self.assertIsNotNone(match)
-        return match
+    def setUp(self):
+        super().setUp()
+        ldapdb_compiler._filter_templates.clear()
 
-    def test_regex(self):
-        sql = "SELECT examples_ldapgroup.cn AS Col1 FROM examples_ldapgroup ORDER BY examples_ldapgroup.gidNumber ASC LIMIT 2"  # noqa: E501
-        match = self._run_regex(sql)
-        self.assertEqual(match.group('limit'), '2')
-        self.assertEqual(match.group('offset'), None)
+    def _query_as_ldap(self, where):
+        query = django_query.Query(model=FakeModel)
+        query.where = where
+        compiler = ldapdb_compiler.SQLCompiler(
+            query=query,
+            connection=connections['ldap'],
+            using=None,
+        )
+        return ldapdb_compiler.query_as_ldap(query, compiler, connections['ldap']).filterstr
+
+    def _build_where(self, name, names):
+        where = WhereNode()
+        where.add(self._build_lookup('cn', 'exact', name), AND)
+        where.add(self._build_lookup('givenName', 'in', names), OR)
+        return where
+
+    def test_shape(self):
+        params = []
+        shape = ldapdb_compiler.where_shape(self._build_where('foo', ['bar', 'baz']), params)
+        self.assertEqual(['foo', 'bar', 'baz'], params)
+
+        other_params = []
+        other_shape = ldapdb_compiler.where_shape(self._build_where('(x)', ['y', 'z']), other_params)
+        self.assertEqual(shape, other_shape)
+        self.assertEqual(['(x)', 'y', 'z'], other_params)
+
+        # Lists of a different length make for a different template
+        self.assertNotEqual(shape, ldapdb_compiler.where_shape(self._build_where('foo', ['bar']), []))
+
+    def test_reuse(self):
+        self.assertEqual(
+            '(&(objectClass=inetOrgPerson)(|(cn=foo)(givenName=bar)(givenName=baz)))',
+            self._query_as_ldap(self._build_where('foo', ['bar', 'baz'])),
+        )
+        self.assertEqual(1, len(ldapdb_compiler._filter_templates))
+
+        with mock.patch.object(ldapdb_compiler, 'where_node_as_filter') as where_node_as_filter:
+            self.assertEqual(
+                '(&(objectClass=inetOrgPerson)(|(cn=\\28x\\29)(givenName=y\\2a)(givenName=z)))',
+                self._query_as_ldap(self._build_where('(x)', ['y*', 'z'])),
+            )
+        where_node_as_filter.assert_not_called()
+        self.assertEqual(1, len(ldapdb_compiler._filter_templates))
+
+    def test_empty_where(self):
+        self.assertEqual('(objectClass=inetOrgPerson)', self._query_as_ldap(WhereNode()))
+        self.assertEqual('(objectClass=inetOrgPerson)', self._query_as_ldap(WhereNode()))
+
+    def test_duplicate_params(self):
+        self.assertEqual(
+            '(&(objectClass=inetOrgPerson)(|(cn=foo)(givenName=bar)(givenName=baz)))',
+            self._query_as_ldap(self._build_where('foo', ['bar', 'baz'])),
+        )
+        # Same shape, but a duplicate clause is dropped
+        self.assertEqual(
+            '(&(objectClass=inetOrgPerson)(|(cn=foo)(givenName=bar)))',
+            self._query_as_ldap(self._build_where('foo', ['bar', 'bar'])),
+        )
+        self.assertEqual(
+            '(&(objectClass=inetOrgPerson)(|(cn=foo)(givenName=wiz)))',
+            self._query_as_ldap(self._build_where('foo', ['wiz', 'wiz'])),
+        )
+        # Equal values for different attributes are kept
+        self.assertEqual(
+            '(&(objectClass=inetOrgPerson)(|(cn=foo)(givenName=foo)(givenName=bar)))',
+            self._query_as_ldap(self._build_where('foo', ['foo', 'bar'])),
+        )
+
+
+class OptimizeFilterTests(TestCase):
+    _build_lookup = WhereTestCase._build_lookup
+    _where_as_ldap = WhereTestCase._where_as_ldap
+
+    def _optimize(self, node):
+        clause, params = ldapdb_compiler.render_filter(ldapdb_compiler.optimize_filter(node))
+        return '(%s)' % (clause % tuple(escape_ldap_filter(param) for param in params))
+
+    def _and(self, *children):
+        return ldapdb_compiler.FilterOperation('&', list(children))
+
+    def _or(self, *children):
+        return ldapdb_compiler.FilterOperation('|', list(children))
+
+    def _not(self, child):
+        return ldapdb_compiler.FilterOperation('!', [child])
+
+    def _eq(self, attr, value):
+        return ldapdb_compiler.FilterClause('%s=%%s' % attr, [value])
+
+    def test_flatten(self):
+        node = self._and(
+            self._and(self._eq('objectClass', 'x')),
+            self._and(self._eq('a', 1), self._and(self._eq('b', 2))),
+        )
+        self.assertEqual('(&(objectClass=x)(a=1)(b=2))', self._optimize(node))
+
+        node = self._or(self._eq('a', 1), self._or(self._eq('a', 2), self._eq('a', 3)))
+        self.assertEqual('(|(a=1)(a=2)(a=3))', self._optimize(node))
+
+        # Different operators aren't merged
+        node = self._and(self._eq('a', 1), self._or(self._eq('b', 2), self._eq('c', 3)))
+        self.assertEqual('(&(a=1)(|(b=2)(c=3)))', self._optimize(node))
+
+    def test_duplicates(self):
+        node = self._and(self._eq('a', 1), self._eq('b', 2), self._eq('a', 1))
+        self.assertEqual('(&(a=1)(b=2))', self._optimize(node))
+
+        node = self._or(self._and(self._eq('a', 1), self._eq('b', 2)), self._and(self._eq('a', 1), self._eq('b', 2)))
+        self.assertEqual('(&(a=1)(b=2))', self._optimize(node))
+
+        # Values are compared once escaped
+        node = self._or(self._eq('a', 1), self._eq('a', '1'))
+        self.assertEqual('(a=1)', self._optimize(node))
+
+    def test_double_negation(self):
+        self.assertEqual('(a=1)', self._optimize(self._not(self._not(self._eq('a', 1)))))
+        self.assertEqual('(!(a=1))', self._optimize(self._not(self._not(self._not(self._eq('a', 1))))))
+        # Nested through single-operand operations
+        node = self._not(self._and(self._not(self._eq('a', 1))))
+        self.assertEqual('(a=1)', self._optimize(node))
+
+    def test_empty(self):
+        self.assertEqual('(&)', self._optimize(self._and()))
+        # An empty OR (e.g. from an empty IN list) is false, and can be dropped from an OR
+        self.assertEqual('(&(a=1)(|))', self._optimize(self._and(self._eq('a', 1), self._or())))
+        self.assertEqual('(a=1)', self._optimize(self._or(self._eq('a', 1), self._or())))
+
+    def test_in(self):
+        where = WhereNode()
+        where.add(self._build_lookup("cn", 'in', ["foo", "bar", "foo"]), AND)
+        where.add(self._build_lookup("cn", 'exact', "baz"), OR)
+        self.assertEqual(
+            "(|(cn=foo)(cn=bar)(cn=baz))",
+            self._where_as_ldap(where),
+        )
+
+        where = WhereNode()
+        where.add(self._build_lookup("cn", 'in', ["foo"]), AND)
+        self.assertEqual("(cn=foo)", self._where_as_ldap(where))
+
+
+class SplitInLookupTests(TestCase):
+    _build_lookup = WhereTestCase._build_lookup
+    _where_as_ldap = WhereTestCase._where_as_ldap
+
+    def test_split(self):
+        where = WhereNode()
+        where.add(self._build_lookup('sn', 'exact', 'foo'), AND)
+        where.add(self._build_lookup('cn', 'in', ['a', 'b', 'c', 'd', 'e']), AND)
+        self.assertEqual(
+            ['(&(sn=foo)(|(cn=a)(cn=b)))', '(&(sn=foo)(|(cn=c)(cn=d)))', '(&(sn=foo)(cn=e))'],
+            [self._where_as_ldap(chunk) for chunk in ldapdb_compiler.split_in_lookup(where, 2)],
+        )
+        # The original node is left untouched
+        self.assertEqual('(&(sn=foo)(|(cn=a)(cn=b)(cn=c)(cn=d)(cn=e)))', self._where_as_ldap(where))
+
+        self.assertEqual([where], ldapdb_compiler.split_in_lookup(where, 5))
+
+    def test_split_largest(self):
+        inner = WhereNode(connector=OR)
+        inner.add(self._build_lookup('sn', 'in', ['x', 'y']), OR)
+        inner.add(self._build_lookup('cn', 'in', ['a', 'b', 'c']), OR)
+        where = WhereNode()
+        where.add(self._build_lookup('sn', 'exact', 'foo'), AND)
+        where.add(inner, AND)
+        self.assertEqual(
+            [
+                '(&(sn=foo)(|(sn=x)(sn=y)(cn=a)))',
+                '(&(sn=foo)(|(sn=x)(sn=y)(cn=b)))',
+                '(&(sn=foo)(|(sn=x)(sn=y)(cn=c)))',
+            ],
+            [self._where_as_ldap(chunk) for chunk in ldapdb_compiler.split_in_lookup(where, 1)],
+        )
+
+    def test_negated(self):
+        inner = WhereNode(negated=True)
+        inner.add(self._build_lookup('cn', 'in', ['a', 'b', 'c']), AND)
+        where = WhereNode()
+        where.add(inner, AND)
+        self.assertEqual([where], ldapdb_compiler.split_in_lookup(where, 1))
+
+
+class DeltaModlistTests(TestCase):
+    def test_added_removed(self):
+        old = [b'alice', b'bob', b'carol', b'dave']
+        self.assertEqual(
+            [(ldap.MOD_ADD, 'memberUid', [b'erin'])],
+            models.base.build_delta_modlist('memberUid', old, old + [b'erin']),
+        )
+        self.assertEqual(
+            [(ldap.MOD_DELETE, 'memberUid', [b'bob']), (ldap.MOD_ADD, 'memberUid', [b'erin'])],
+            models.base.build_delta_modlist('memberUid', old, [b'alice', b'carol', b'dave', b'erin']),
+        )
+
+    def test_replace(self):
+        # The delta is as large as the new values
+        self.assertEqual(
+            [(ldap.MOD_REPLACE, 'memberUid', [b'carol', b'dave'])],
+            models.base.build_delta_modlist('memberUid', [b'alice', b'bob'], [b'carol', b'dave']),
+        )
+        self.assertEqual(
+            [(ldap.MOD_DELETE, 'memberUid', [])],
+            models.base.build_delta_modlist('memberUid', [b'alice', b'bob'], []),
+        )
+
+
+class AttributeOperationTests(TestCase):
+    def test_increment(self):
+        field = fields.IntegerField(db_column='uidNumber')
+        self.assertEqual(
+            [(ldap.MOD_INCREMENT, 'uidNumber', [b'-2'])],
+            ldapdb_expressions.Increment(-2).as_ldap_modlist(field, connections['ldap']),
+        )
+        with self.assertRaises(FieldError):
+            ldapdb_expressions.Increment().as_ldap_modlist(fields.ListField(db_column='memberUid'), connections['ldap'])
+
+    def test_add_remove_values(self):
+        field = fields.ListField(db_column='memberUid')
+        self.assertEqual(
+            [(ldap.MOD_ADD, 'memberUid', [b'alice', b'bob'])],
+            ldapdb_expressions.AddValues('bob', 'alice').as_ldap_modlist(field, connections['ldap']),
+        )
+        self.assertEqual(
+            [(ldap.MOD_DELETE, 'memberUid', [b'alice'])],
+            ldapdb_expressions.RemoveValues('alice').as_ldap_modlist(field, connections['ldap']),
+        )
+        with self.assertRaises(FieldError):
+            ldapdb_expressions.AddValues('alice').as_ldap_modlist(fields.CharField(db_column='cn'), connections['ldap'])
+
+
+class ServerSortTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        # Don't query the server for its supported controls.
+        connections['ldap'].features.supports_server_side_sort = True
+
+    def tearDown(self):
+        del connections['ldap'].features.supports_server_side_sort
+        super().tearDown()
+
+    def _sort_control(self, *ordering):
+        query = django_query.Query(model=FakeModel)
+        query.add_ordering(*ordering)
+        compiler = ldapdb_compiler.SQLCompiler(
+            query=query,
+            connection=connections['ldap'],
+            using=None,
+        )
+        return compiler.server_sort_control(compiler.get_ldap_ordering())
+
+    def test_no_ordering(self):
+        self.assertIsNone(self._sort_control())
+
+    def test_ordering(self):
+        self.assertEqual(['cn'], self._sort_control('name').ordering_rules)
+        self.assertEqual(['-cn'], self._sort_control('-name').ordering_rules)
+
+    def test_dn_ordering(self):
+        # The server can't sort on the DN.
+        self.assertIsNone(self._sort_control('dn'))
+        self.assertIsNone(self._sort_control('name', '-dn'))
+
+    def test_unsupported(self):
+        connections['ldap'].features.supports_server_side_sort = False
+        self.assertIsNone(self._sort_control('name'))
+
+    def test_unreadable_root_dse(self):
+        connection = connections['ldap']
+        wrapper = connection.__class__(dict(connection.settings_dict, LIVENESS_CHECK='none'), alias='ldap')
+        wrapper.connection = mock.Mock(timeout=-1)
+        wrapper.connection.search_ext_s.side_effect = ldap.INSUFFICIENT_ACCESS({'desc': "Insufficient access"})
+        try:
+            self.assertEqual(frozenset(), wrapper.features.supported_controls)
+            self.assertFalse(wrapper.features.supports_server_side_sort)
+            self.assertFalse(wrapper.features.supports_virtual_list_view)
+        finally:
+            wrapper.connection = None
+
+    def test_virtual_list_view(self):
+        features = connections['ldap'].features
+        features.supports_virtual_list_view = True
+        try:
+            query = django_query.Query(model=FakeModel)
+            query.add_ordering('name')
+            compiler = ldapdb_compiler.SQLCompiler(query=query, connection=connections['ldap'], using=None)
+            # No upper bound: the window size is unknown
+            query.set_limits(low=10)
+            self.assertFalse(compiler._can_use_vlv())
+
+            query.clear_limits()
+            query.set_limits(low=10, high=20)
+            self.assertTrue(compiler._can_use_vlv())
+
+            features.supports_virtual_list_view = False
+            self.assertFalse(compiler._can_use_vlv())
+        finally:
+            del features.supports_virtual_list_view
+
+
+class FakeSearchLDAPObject(object):
+    """Answer searches with the configured entries, honoring sort and VLV request controls."""
+
+    def __init__(self, entries, sort_error=None, vlv_error=None):
+        self.entries = entries
+        self.sort_error = sort_error
+        self.vlv_error = vlv_error
+        self.timeout = -1
+        # Types of the controls sent with each search
+        self.searches = []
+        self._requests = {}
+
+    def search_ext(self, base, scope, filterstr, attrlist=None, serverctrls=None, timeout=-1, sizelimit=0):
+        self.searches.append([ctrl.controlType for ctrl in serverctrls or []])
+        msgid = len(self.searches)
+        self._requests[msgid] = serverctrls or []
+        return msgid
+
+    def abandon(self, msgid):
+        self._requests.pop(msgid, None)
+
+    def result3(self, msgid, all=1, timeout=-1):
+        entries = list(self.entries)
+        response_controls = []
+        for ctrl in self._requests.pop(msgid):
+            if ctrl.controlType == ldap.controls.sss.SSSRequestControl.controlType:
+                if self.sort_error:
+                    raise self.sort_error({'desc': "Sort failed"})
+                for rule in reversed(ctrl.ordering_rules):
+                    attr = rule.lstrip('-')
+                    entries.sort(key=lambda entry: entry[1][attr][0], reverse=rule.startswith('-'))
+                response = ldap.controls.sss.SSSResponseControl()
+                response.result = 0
+                response_controls.append(response)
+            elif ctrl.controlType == ldap.controls.vlv.VLVRequestControl.controlType:
+                if self.vlv_error:
+                    raise self.vlv_error({'desc': "VLV failed"})
+                # Past the end of the list, the server targets the last entry.
+                target = min(ctrl.offset, len(entries))
+                entries = entries[max(target - 1 - ctrl.before_count, 0):target + ctrl.after_count]
+                response = ldap.controls.vlv.VLVResponseControl()
+                response.target_position = target
+                response.content_count = len(self.entries)
+                response_controls.append(response)
+        return ldap.RES_SEARCH_RESULT, entries, msgid, response_controls
+
+
+class SortedSearchTests(TestCase):
+    entries = [
+        ('cn=%s,ou=test,dc=example,dc=org' % name, {'cn': [name.encode('utf-8')]})
+        for name in ['bob', 'dave', 'alice', 'carol', 'eve']
+    ]
+
+    def _search(self, ldapobj, *ordering, low=0, high=None, vlv=False):
+        """Return the names of the entries fetched by a sliced query, and the database wrapper."""
+        connection = connections['ldap']
+        wrapper = connection.__class__(dict(connection.settings_dict, LIVENESS_CHECK='none'), alias='ldap')
+        wrapper.connection = ldapobj
+        wrapper.features.supports_server_side_sort = True
+        wrapper.features.supports_virtual_list_view = vlv
+
+        query = django_query.Query(model=FakeModel)
+        query.add_ordering(*ordering)
+        query.set_limits(low, high)
+        compiler = ldapdb_compiler.SQLCompiler(query=query, connection=wrapper, using=None)
+        try:
+            vals, low_mark, high_mark = compiler.fetch_entries()
+            names = [attrs['cn'][0].decode('utf-8') for _dn, attrs in list(vals)[low_mark:high_mark]]
+        finally:
+            wrapper.connection = None
+        return names, wrapper
+
+    def test_server_sort(self):
+        ldapobj = FakeSearchLDAPObject(self.entries)
+        names, _wrapper = self._search(ldapobj, '-name')
+        self.assertEqual(['eve', 'dave', 'carol', 'bob', 'alice'], names)
+        self.assertEqual(1, len(ldapobj.searches))
+        self.assertIn(ldap.controls.sss.SSSRequestControl.controlType, ldapobj.searches[0])
+
+    def test_server_sort_rejected(self):
+        ldapobj = FakeSearchLDAPObject(self.entries, sort_error=ldap.UNAVAILABLE_CRITICAL_EXTENSION)
+        names, wrapper = self._search(ldapobj, 'name')
+        # Sorted client-side instead
+        self.assertEqual(['alice', 'bob', 'carol', 'dave', 'eve'], names)
+        self.assertEqual({('cn',)}, wrapper.failed_sort_rules)
+        self.assertNotIn(ldap.controls.sss.SSSRequestControl.controlType, ldapobj.searches[1])
+
+    def test_virtual_list_view(self):
+        ldapobj = FakeSearchLDAPObject(self.entries)
+        names, _wrapper = self._search(ldapobj, 'name', low=1, high=3, vlv=True)
+        self.assertEqual(['bob', 'carol'], names)
+        self.assertEqual(1, len(ldapobj.searches))
+        self.assertIn(ldap.controls.vlv.VLVRequestControl.controlType, ldapobj.searches[0])
+
+    def test_virtual_list_view_past_end(self):
+        ldapobj = FakeSearchLDAPObject(self.entries)
+        # The server returns the last entry, which isn't part of the slice.
+        self.assertEqual([], self._search(ldapobj, 'name', low=10, high=12, vlv=True)[0])
+        self.assertEqual(['eve'], self._search(ldapobj, 'name', low=4, high=6, vlv=True)[0])
+
+    def test_virtual_list_view_rejected(self):
+        ldapobj = FakeSearchLDAPObject(self.entries, vlv_error=ldap.VLV_ERROR)
+        names, wrapper = self._search(ldapobj, 'name', low=1, high=3, vlv=True)
+        # Fetched through a server-sorted search instead
+        self.assertEqual(['bob', 'carol'], names)
+        self.assertEqual({('cn',)}, wrapper.failed_vlv_rules)
+        self.assertNotIn(ldap.controls.vlv.VLVRequestControl.controlType, ldapobj.searches[1])
+        self.assertIn(ldap.controls.sss.SSSRequestControl.controlType, ldapobj.searches[1])
+
+
+class FakeConnection(object):
+    def __init__(self, num):
+        self.num = num
+
+    def __repr__(self):
+        return '<FakeConnection %d>' % self.num
+
+
+class ConnectionPoolTests(TestCase):
+    def _build_pool(self, **kwargs):
+        counter = itertools.count()
+        return ldapdb_pool.ConnectionPool(lambda: FakeConnection(next(counter)), **kwargs)
+
+    def test_reuse(self):
+        pool = self._build_pool()
+        first = pool.acquire()
+        pool.release(first)
+        second = pool.acquire()
+        self.assertIs(first, second)
+
+        stats = pool.stats()
+        self.assertEqual(1, stats['created'])
+        self.assertEqual(2, stats['checkouts'])
+        self.assertEqual(1, stats['checkins'])
+        self.assertEqual(1, stats['in_use'])
+        self.assertEqual(0, stats['idle'])
+
+    def test_max_size(self):
+        pool = self._build_pool(max_size=2, timeout=0)
+        first = pool.acquire()
+        second = pool.acquire()
+        self.assertIsNot(first, second)
+
+        with self.assertRaises(ldap.TIMEOUT):
+            pool.acquire()
+        stats = pool.stats()
+        self.assertEqual(1, stats['waits'])
+        self.assertEqual(1, stats['timeouts'])
+
+        pool.release(second)
+        self.assertIs(second, pool.acquire())
+
+    def test_no_wait(self):
+        pool = self._build_pool(max_size=1, timeout=30)
+        first = pool.acquire()
+        self.assertIsNone(pool.acquire(wait=False))
+        self.assertEqual(0, pool.stats()['waits'])
+
+        pool.release(first)
+        self.assertIs(first, pool.acquire(wait=False))
+
+    def test_discard(self):
+        pool = self._build_pool(max_size=1, timeout=0)
+        first = pool.acquire()
+        pool.release(first, discard=True)
+
+        second = pool.acquire()
+        self.assertIsNot(first, second)
+        self.assertEqual(1, pool.stats()['closed'])
+
+    def test_max_idle(self):
+        pool = self._build_pool(max_idle=0)
+        first = pool.acquire()
+        pool.release(first)
+
+        second = pool.acquire()
+        self.assertIsNot(first, second)
+        self.assertEqual(1, pool.stats()['evicted_idle'])
+
+    def test_max_lifetime(self):
+        pool = self._build_pool(max_lifetime=0)
+        first = pool.acquire()
+        pool.release(first)
+
+        self.assertEqual(0, pool.stats()['idle'])
+        self.assertIsNot(first, pool.acquire())
+
+    def test_last_active(self):
+        pool = self._build_pool()
+        first = pool.acquire()
+        # Bound when created
+        self.assertIsNotNone(pool.last_active(first))
+
+        pool.release(first, last_active=42)
+        self.assertEqual(42, pool.last_active(pool.acquire()))
+        # Unknown after an error
+        pool.release(first)
+        self.assertIsNone(pool.last_active(pool.acquire()))
+
+    def test_factory_failure(self):
+        def factory():
+            raise ldap.SERVER_DOWN({'desc': "Can't contact LDAP server"})
+
+        pool = ldapdb_pool.ConnectionPool(factory, max_size=1, timeout=0)
+        with self.assertRaises(ldap.SERVER_DOWN):
+            pool.acquire()
+        # The reserved slot has been freed
+        self.assertEqual(0, pool.stats()['size'])
+
+    def test_registry(self):
+        self.addCleanup(ldapdb_pool.clear_pools)
+
+        def factory():
+            return FakeConnection(0)
+
+        pool = ldapdb_pool.get_pool('key', factory, max_size=2)
+        self.assertIs(pool, ldapdb_pool.get_pool('key', factory, max_size=2))
+
+        # New options replace the pool
+        new_pool = ldapdb_pool.get_pool('key', factory, max_size=3)
+        self.assertIsNot(pool, new_pool)
+        self.assertEqual(3, new_pool.max_size)
+
+        ldapdb_pool.clear_pools()
+        self.assertIsNot(new_pool, ldapdb_pool.get_pool('key', factory, max_size=3))
+
+
+class LivenessTests(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(ldapdb_pool.clear_pools)
+        self.addCleanup(ldapdb_health.clear_health)
+        counter = itertools.count()
+        patcher = mock.patch.object(
+            ldapdb_base.DatabaseWrapper, '_open_connection',
+            side_effect=lambda conn_params: FakeConnection(next(counter)),
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # Connections failing their liveness check
+        self.dead = set()
+
+    def _wrapper(self, **options):
+        connection = connections['ldap']
+        wrapper = connection.__class__(dict(connection.settings_dict, **options), alias='ldap')
+        self.addCleanup(wrapper.close)
+
+        def check_liveness(conn_params):
+            if wrapper.connection in self.dead:
+                raise ldap.SERVER_DOWN({'desc': "Can't contact LDAP server"})
+
+        wrapper.check_liveness = mock.Mock(side_effect=check_liveness)
+        return wrapper
+
+    def test_pool_reconnect(self):
+        # All pooled connections broke, e.g. after a server restart.
+        wrapper = self._wrapper(POOL={'MAX_SIZE': 5}, LIVENESS_INTERVAL=0)
+        wrapper.ensure_connection()
+        others = [wrapper.pool.acquire() for _i in range(2)]
+        for connection in others:
+            wrapper.pool.release(connection)
+        self.dead.update(others + [wrapper.connection])
+        wrapper.close()
+        wrapper.check_liveness.reset_mock()
+
+        wrapper.ensure_connection()
+        self.assertEqual(3, wrapper.connection.num)
+        # The three broken connections, then the new one
+        self.assertEqual(4, wrapper.check_liveness.call_count)
+        self.assertEqual(3, wrapper.pool.stats()['closed'])
+
+    def test_pool_failover(self):
+        self.addCleanup(ldapdb_health.clear_breakers)
+        wrapper = self._wrapper(
+            POOL={'MAX_SIZE': 5},
+            LIVENESS_INTERVAL=0,
+            CIRCUIT_BREAKER={'FAILURE_THRESHOLD': 1, 'RESET_TIMEOUT': 60},
+        )
+        wrapper.ensure_connection()
+        first = wrapper.connection
+        second, third = [wrapper.pool.acquire() for _i in range(2)]
+        first._uri = second._uri = 'ldap://a'
+        third._uri = 'ldap://b'
+        wrapper.pool.release(third)
+        wrapper.pool.release(second)
+        self.dead.add(first)
+        wrapper.close()
+
+        # The server of the first connection failed: skip its other connections.
+        wrapper.ensure_connection()
+        self.assertIs(third, wrapper.connection)
+        self.assertEqual(2, wrapper.pool.stats()['closed'])
+        self.assertEqual('open', ldapdb_health.get_breaker('ldap://a').state)
+
+    def test_server_down(self):
+        # A connection that failed is checked before its next use, even within
+        # the liveness interval, including by the next thread using it.
+        wrapper = self._wrapper(POOL={'MAX_SIZE': 5}, LIVENESS_INTERVAL=60)
+        wrapper.ensure_connection()
+        connection = wrapper.connection
+        connection.modify_s = mock.Mock(side_effect=ldap.SERVER_DOWN({'desc': "Can't contact LDAP server"}))
+        with self.assertRaises(ldap.SERVER_DOWN):
+            wrapper.modify_s('cn=foo,dc=example,dc=org', [])
+        self.dead.add(connection)
+        wrapper.close()
+        wrapper.check_liveness.assert_not_called()
+
+        other = self._wrapper(POOL={'MAX_SIZE': 5}, LIVENESS_INTERVAL=60)
+        other.ensure_connection()
+        self.assertEqual(1, other.check_liveness.call_count)
+        self.assertIsNot(connection, other.connection)
+
+    def test_search_reconnect(self):
+        # Not checked within the liveness interval, a broken connection is
+        # replaced as soon as a search fails.
+        entries = [('cn=foo,dc=example,dc=org', {'cn': [b'foo']})]
+        broken = FakeSearchLDAPObject([])
+        broken.result3 = mock.Mock(side_effect=ldap.SERVER_DOWN({'desc': "Can't contact LDAP server"}))
+        working = FakeSearchLDAPObject(entries)
+        wrapper = self._wrapper(LIVENESS_INTERVAL=60)
+        with mock.patch.object(ldapdb_base.DatabaseWrapper, '_open_connection', side_effect=[broken, working]):
+            self.assertEqual(entries, list(wrapper.search_s('dc=example,dc=org', ldap.SCOPE_SUBTREE)))
+        self.assertIs(working, wrapper.connection)
+
+
+class SearchUnionTests(TestCase):
+    entries = [
+        ('cn=%s,ou=test,dc=example,dc=org' % name, {'cn': [name.encode('utf-8')]})
+        for name in ['alice', 'bob']
+    ]
+
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(ldapdb_pool.clear_pools)
+        patcher = mock.patch.object(
+            ldapdb_base.DatabaseWrapper, '_open_connection',
+            side_effect=lambda conn_params: FakeSearchLDAPObject(self.entries),
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_saturated_pool(self):
+        connection = connections['ldap']
+        wrapper = connection.__class__(
+            dict(connection.settings_dict, POOL={'MAX_SIZE': 3}, LIVENESS_CHECK='none'),
+            alias='ldap',
+        )
+        self.addCleanup(wrapper.close)
+        wrapper.ensure_connection()
+        # Other threads hold the remaining connections.
+        held = [wrapper.pool.acquire() for _i in range(2)]
+        self.addCleanup(lambda: [wrapper.pool.release(held_connection) for held_connection in held])
+
+        searches = [('ou=%d,dc=example,dc=org' % i, ldap.SCOPE_SUBTREE, '(objectClass=*)') for i in range(3)]
+        self.assertEqual(self.entries, list(wrapper.search_union(searches)))
+        # The searches ran on the current connection, without waiting for the pool.
+        self.assertEqual(3, len(wrapper.connection.searches))
+        self.assertEqual(0, wrapper.pool.stats()['waits'])
+
+
+class FakeLDAPObject(object):
+    """Record asynchronous operations, answering them with the configured errors."""
+
+    def __init__(self, errors=None):
+        self.errors = errors or {}
+        self.pending = {}
+        self.max_in_flight = 0
+        self.timeout = -1
+        self._msgids = itertools.count(1)
+
+    def delete_ext(self, dn):
+        msgid = next(self._msgids)
+        self.pending[msgid] = dn
+        self.max_in_flight = max(self.max_in_flight, len(self.pending))
+        return msgid
+
+    def result3(self, msgid, timeout=-1):
+        dn = self.pending.pop(msgid)
+        if dn in self.errors:
+            raise self.errors[dn]({'desc': "Failed", 'info': dn})
+        return ldap.RES_DELETE, [], msgid, []
+
+
+class PipelineTests(TestCase):
+    def _pipeline(self, ldapobj, dns, window, query_cache=None):
+        connection = connections['ldap']
+        wrapper = connection.__class__(connection.settings_dict, alias='ldap')
+        wrapper.connection = ldapobj
+        wrapper.query_cache = query_cache
+        wrapper._fresh_connection = True
+        try:
+            return wrapper.pipeline(((dn, 'delete_ext', ()) for dn in dns), window=window)
+        finally:
+            wrapper.connection = None
+
+    def test_window(self):
+        ldapobj = FakeLDAPObject()
+        dns = ['cn=%d,dc=example,dc=org' % i for i in range(10)]
+        results = self._pipeline(ldapobj, dns, window=3)
+
+        self.assertEqual([(dn, None) for dn in dns], results)
+        self.assertEqual(3, ldapobj.max_in_flight)
+        self.assertEqual({}, ldapobj.pending)
+
+    def test_invalidate(self):
+        query_cache = mock.Mock()
+        dns = ['cn=%d,dc=example,dc=org' % i for i in range(10)]
+        self._pipeline(FakeLDAPObject(), dns, window=3, query_cache=query_cache)
+        # A single invalidation, once all operations were answered
+        query_cache.invalidate_many.assert_called_once_with(dns)
+        query_cache.invalidate.assert_not_called()
+
+    def test_errors(self):
+        ldapobj = FakeLDAPObject(errors={
+            'cn=1,dc=example,dc=org': ldap.NO_SUCH_OBJECT,
+            'cn=2,dc=example,dc=org': ldap.INSUFFICIENT_ACCESS,
+        })
+        dns = ['cn=%d,dc=example,dc=org' % i for i in range(4)]
+        results = self._pipeline(ldapobj, dns, window=2)
+
+        self.assertEqual(dns, [dn for dn, _error in results])
+        self.assertEqual(
+            [None, ldap.NO_SUCH_OBJECT, ldap.INSUFFICIENT_ACCESS, None],
+            [error if error is None else type(error) for _dn, error in results],
+        )
+
+
+class RenameTests(TestCase):
+    def test_invalidate(self):
+        connection = connections['ldap']
+        wrapper = connection.__class__(dict(connection.settings_dict, LIVENESS_CHECK='none'), alias='ldap')
+        wrapper.connection = mock.Mock()
+        wrapper.entry_cache = mock.Mock()
+        try:
+            # The RDN contains an escaped comma
+            wrapper.rename_s(r'cn=foo\,bar,ou=groups,dc=example,dc=org', 'cn=baz')
+        finally:
+            wrapper.connection = None
+        self.assertEqual(
+            [
+                mock.call(r'cn=foo\,bar,ou=groups,dc=example,dc=org', subtree=True),
+                mock.call('cn=baz,ou=groups,dc=example,dc=org', subtree=True),
+            ],
+            wrapper.entry_cache.invalidate.call_args_list,
+        )
+
+
+class FakeAsyncLDAPObject(object):
+    """Answer searches with the messages delivered to them, through a socket pair."""
+
+    def __init__(self):
+        self.reader, self.writer = socket.socketpair()
+        self.reader.setblocking(False)
+        self.delivered = {}
+        self.queued = collections.defaultdict(list)
+        self.searches = []
+        self.search_args = []
+        self.timeout = -1
+
+    def close(self):
+        self.reader.close()
+        self.writer.close()
+
+    def fileno(self):
+        return self.reader.fileno()
+
+    def deliver(self, msgid, message):
+        self.delivered.setdefault(msgid, []).append(message)
+        self.writer.send(b'.')
+
+    def search_ext(self, base, scope, filterstr, attrlist, serverctrls=None, timeout=-1, sizelimit=0):
+        self.searches.append(base)
+        self.search_args.append({'serverctrls': serverctrls or [], 'sizelimit': sizelimit})
+        return len(self.searches)
+
+    def abandon(self, msgid):
+        pass
+
+    def result3(self, msgid, all=1, timeout=-1):
+        # Like libldap, read all available messages, and queue them by msgid.
+        try:
+            while self.reader.recv(1024):
+                pass
+        except BlockingIOError:
+            pass
+        for delivered_msgid, messages in list(self.delivered.items()):
+            self.queued[delivered_msgid].extend(messages)
+            del self.delivered[delivered_msgid]
+        if self.queued[msgid]:
+            message = self.queued[msgid].pop(0)
+            if isinstance(message, Exception):
+                raise message
+            res_type, res_data = message
+            return res_type, res_data, msgid, []
+        return None, None, None, None
+
+
+class AsyncResultTests(TestCase):
+    def setUp(self):
+        super().setUp()
+        connection = connections['ldap']
+        self.wrapper = connection.__class__(connection.settings_dict, alias='ldap')
+        self.ldapobj = FakeAsyncLDAPObject()
+        self.addCleanup(self.ldapobj.close)
+
+    async def test_result(self):
+        loop = asyncio.get_running_loop()
+        entry = ('cn=foo,dc=example,dc=org', {})
+        loop.call_later(0.01, self.ldapobj.deliver, 1, (ldap.RES_SEARCH_ENTRY, [entry]))
+        self.assertEqual(
+            (ldap.RES_SEARCH_ENTRY, [entry], []),
+            await self.wrapper._aresult(self.ldapobj, 1, timeout=1),
+        )
+        with self.assertRaises(ldap.TIMEOUT):
+            await self.wrapper._aresult(self.ldapobj, 1, timeout=0.01)
+        self.assertEqual({}, self.wrapper._async_waiters)
+
+    @mock.patch.object(ldapdb_base, 'ASYNC_POLL_INTERVAL', 30)
+    async def test_concurrent(self):
+        # Responses to all searches arrive at once, and are read by the first
+        # coroutine to poll the connection: others must not miss them.
+        loop = asyncio.get_running_loop()
+        loop.call_later(0.01, self.ldapobj.deliver, 1, (ldap.RES_SEARCH_RESULT, []))
+        loop.call_later(0.01, self.ldapobj.deliver, 2, (ldap.RES_SEARCH_RESULT, []))
+        loop.call_later(0.01, self.ldapobj.deliver, 3, (ldap.RES_SEARCH_RESULT, []))
+        results = await asyncio.wait_for(
+            asyncio.gather(*[self.wrapper._aresult(self.ldapobj, msgid, timeout=-1) for msgid in [1, 2, 3]]),
+            timeout=5,
+        )
+        self.assertEqual([(ldap.RES_SEARCH_RESULT, [], [])] * 3, results)
+        self.assertEqual({}, self.wrapper._async_waiters)
+
+    async def test_acquire_connect(self):
+        # Concurrent searches open a single connection, in a thread.
+        def ensure_connection():
+            self.wrapper.connection = self.ldapobj
+
+        with mock.patch.object(self.wrapper, 'ensure_connection', side_effect=ensure_connection) as ensure:
+            acquired = await asyncio.gather(*[self.wrapper._aacquire() for _i in range(3)])
+        self.assertEqual([self.ldapobj] * 3, acquired)
+        self.assertEqual(1, ensure.call_count)
+        self.assertEqual(3, self.wrapper._async_searches)
+
+    @mock.patch.object(ldapdb_base, 'sync_to_async', side_effect=AssertionError("No thread expected"))
+    async def test_acquire_check(self, _sync_to_async):
+        # An open connection is checked on the event loop, unless already in use.
+        self.wrapper.connection = self.ldapobj
+        loop = asyncio.get_running_loop()
+        loop.call_later(0.01, self.ldapobj.deliver, 1, (ldap.RES_SEARCH_RESULT, []))
+        self.assertEqual(self.ldapobj, await asyncio.wait_for(self.wrapper._aacquire(), timeout=5))
+        self.assertEqual([''], self.ldapobj.searches)
+        self.assertEqual(self.ldapobj, await self.wrapper._aacquire())
+        self.assertEqual([''], self.ldapobj.searches)
+        self.assertEqual(2, self.wrapper._async_searches)
+
+    def test_release(self):
+        # Released once the last search is done, after CONN_MAX_AGE.
+        self.wrapper.connection = self.ldapobj
+        self.wrapper._async_searches = 2
+        self.wrapper._arelease()
+        self.assertEqual(self.ldapobj, self.wrapper.connection)
+        self.wrapper._arelease()
+        self.assertEqual(self.ldapobj, self.wrapper.connection)
+
+        self.wrapper._async_searches = 1
+        self.wrapper.close_at = 0
+        self.wrapper._arelease()
+        self.assertIsNone(self.wrapper.connection)
+
+
+class AsyncSearchTests(TestCase):
+    def setUp(self):
+        super().setUp()
+        connection = connections['ldap']
+        self.wrapper = connection.__class__(
+            dict(connection.settings_dict, LIVENESS_CHECK='none', SEARCH_CONCURRENCY=2),
+            alias='ldap',
+        )
+        self.wrapper.search_concurrency = 2
+        self.ldapobj = FakeAsyncLDAPObject()
+        self.addCleanup(self.ldapobj.close)
+        self.wrapper.connection = self.ldapobj
+
+    def _compiler(self, *ordering, low=0, high=None):
+        query = django_query.Query(model=FakeModel)
+        query.add_ordering(*ordering)
+        query.set_limits(low, high)
+        return ldapdb_compiler.SQLCompiler(query=query, connection=self.wrapper, using=None)
+
+    def _entry(self, name, base='ou=test,dc=example,dc=org'):
+        return ('cn=%s,%s' % (name, base), {'cn': [name.encode('utf-8')]})
+
+    async def test_concurrent_lookups(self):
+        bases = ['ou=a,dc=example,dc=org', 'ou=b,dc=example,dc=org', 'ou=c,dc=example,dc=org']
+        lookups = [ldapdb_compiler.LdapLookup(base, ldap.SCOPE_SUBTREE, '(cn=*)') for base in bases]
+
+        async def search():
+            return [dn async for dn, _attrs in self._compiler().asearch_lookups(lookups, ['cn'])]
+
+        task = asyncio.ensure_future(search())
+        await asyncio.sleep(0.05)
+        # Up to SEARCH_CONCURRENCY searches run at once.
+        self.assertEqual(bases[:2], self.ldapobj.searches)
+
+        for msgid in [2, 1]:
+            self.ldapobj.deliver(msgid, (ldap.RES_SEARCH_ENTRY, [self._entry('foo', bases[msgid - 1])]))
+            self.ldapobj.deliver(msgid, (ldap.RES_SEARCH_RESULT, []))
+        await asyncio.sleep(0.05)
+        self.assertEqual(bases, self.ldapobj.searches)
+        self.ldapobj.deliver(3, ldap.NO_SUCH_OBJECT())
+
+        # Merged in the order of lookups, ignoring the missing base.
+        self.assertEqual(
+            ['cn=foo,ou=a,dc=example,dc=org', 'cn=foo,ou=b,dc=example,dc=org'],
+            await asyncio.wait_for(task, timeout=5),
+        )
+
+    async def test_server_sort(self):
+        self.wrapper.features.supports_server_side_sort = True
+        task = asyncio.ensure_future(self._compiler('-name', low=1, high=3).afetch_entries())
+        await asyncio.sleep(0.05)
+        # At most high_mark entries are fetched, sorted by the server.
+        self.assertEqual(3, self.ldapobj.search_args[0]['sizelimit'])
+        self.assertEqual(
+            [ldap.controls.sss.SSSRequestControl.controlType],
+            [ctrl.controlType for ctrl in self.ldapobj.search_args[0]['serverctrls']],
+        )
+        self.ldapobj.deliver(1, (ldap.RES_SEARCH_ENTRY, [self._entry(name) for name in ['eve', 'dave', 'carol']]))
+        self.ldapobj.deliver(1, (ldap.RES_SEARCH_RESULT, []))
+        self.assertEqual(
+            [self._entry('dave'), self._entry('carol')],
+            await asyncio.wait_for(task, timeout=5),
+        )
+
+    async def test_server_sort_rejected(self):
+        self.wrapper.features.supports_server_side_sort = True
+        task = asyncio.ensure_future(self._compiler('name', high=2).afetch_entries())
+        await asyncio.sleep(0.05)
+        self.ldapobj.deliver(1, ldap.UNAVAILABLE_CRITICAL_EXTENSION())
+        await asyncio.sleep(0.05)
+        # Sorted client-side instead, fetching all entries.
+        self.assertEqual({('cn',)}, self.wrapper.failed_sort_rules)
+        self.assertEqual(0, self.ldapobj.search_args[1]['sizelimit'])
+        self.assertNotIn(
+            ldap.controls.sss.SSSRequestControl.controlType,
+            [ctrl.controlType for ctrl in self.ldapobj.search_args[1]['serverctrls']],
+        )
+        self.ldapobj.deliver(2, (ldap.RES_SEARCH_ENTRY, [self._entry(name) for name in ['bob', 'carol', 'alice']]))
+        self.ldapobj.deliver(2, (ldap.RES_SEARCH_RESULT, []))
+        self.assertEqual(
+            [self._entry('alice'), self._entry('bob')],
+            await asyncio.wait_for(task, timeout=5),
+        )
+
+
+class EntryCacheTests(TestCase):
+    def _key(self, cache, dn, attrlist=None):
+        return cache.make_key(dn, '(objectClass=*)', attrlist)
+
+    def test_get_set(self):
+        cache = ldapdb_cache.EntryCache()
+        dn = 'cn=foo,dc=example,dc=org'
+        self.assertIsNone(cache.get(self._key(cache, dn, ['cn']), dn))
+
+        entries = [(dn, {'cn': [b'foo']})]
+        cache.set(self._key(cache, dn, ['cn']), dn, entries)
+        self.assertEqual(entries, cache.get(self._key(cache, dn, ['cn']), dn))
+        # DNs are case-insensitive
+        self.assertEqual(entries, cache.get(self._key(cache, 'CN=Foo,dc=example,dc=org', ['cn']), dn))
+        self.assertIsNone(cache.get(self._key(cache, dn, ['sn']), dn))
+
+        stats = cache.stats()
+        self.assertEqual(2, stats['hits'])
+        self.assertEqual(2, stats['misses'])
+        self.assertEqual(1, stats['size'])
+
+    def test_ttl(self):
+        cache = ldapdb_cache.EntryCache(ttl=0)
+        dn = 'cn=foo,dc=example,dc=org'
+        cache.set(self._key(cache, dn), dn, [])
+        self.assertIsNone(cache.get(self._key(cache, dn), dn))
+        self.assertEqual(0, cache.stats()['size'])
+
+    def test_max_size(self):
+        cache = ldapdb_cache.EntryCache(max_size=2)
+        dns = ['cn=%d,dc=example,dc=org' % i for i in range(3)]
+        cache.set(self._key(cache, dns[0]), dns[0], [])
+        cache.set(self._key(cache, dns[1]), dns[1], [])
+        # Mark dns[0] as recently used
+        cache.get(self._key(cache, dns[0]), dns[0])
+        cache.set(self._key(cache, dns[2]), dns[2], [])
+
+        self.assertEqual([], cache.get(self._key(cache, dns[0]), dns[0]))
+        self.assertIsNone(cache.get(self._key(cache, dns[1]), dns[1]))
+        self.assertEqual([], cache.get(self._key(cache, dns[2]), dns[2]))
+
+    def test_invalidate(self):
+        cache = ldapdb_cache.EntryCache()
+        parent = 'ou=people,dc=example,dc=org'
+        child = 'uid=foo,ou=people,dc=example,dc=org'
+        other = 'uid=foo,ou=groups,dc=example,dc=org'
+        for dn in [parent, child, other]:
+            cache.set(self._key(cache, dn), dn, [])
+
+        cache.invalidate('UID=foo,ou=people,dc=example,dc=org')
+        self.assertIsNone(cache.get(self._key(cache, child), child))
+        self.assertEqual([], cache.get(self._key(cache, parent), parent))
+
+        cache.set(self._key(cache, child), child, [])
+        cache.invalidate(parent, subtree=True)
+        self.assertIsNone(cache.get(self._key(cache, parent), parent))
+        self.assertIsNone(cache.get(self._key(cache, child), child))
+        self.assertEqual([], cache.get(self._key(cache, other), other))
+
+
+class QueryCacheTests(TestCase):
+    entries = [('cn=foo,ou=groups,dc=example,dc=org', {'cn': [b'foo'], 'memberUid': [b'alice', b'bob']})]
+
+    def test_get_set(self):
+        cache = ldapdb_cache.QueryCache()
+        self.assertIsNone(cache.get('key', 'ou=groups,dc=example,dc=org'))
+        cache.set('key', 'ou=groups,dc=example,dc=org', self.entries)
+        self.assertEqual(self.entries, cache.get('key', 'ou=groups,dc=example,dc=org'))
+
+        stats = cache.stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+        self.assertEqual(ldapdb_cache.estimate_size(self.entries), stats['bytes'])
+
+    def test_ttl(self):
+        cache = ldapdb_cache.QueryCache(ttl=0)
+        cache.set('key', 'ou=groups,dc=example,dc=org', self.entries)
+        self.assertIsNone(cache.get('key', 'ou=groups,dc=example,dc=org'))
+        cache.set('key', 'ou=groups,dc=example,dc=org', self.entries, ttl=60)
+        self.assertEqual(self.entries, cache.get('key', 'ou=groups,dc=example,dc=org'))
+
+    def test_max_bytes(self):
+        size = ldapdb_cache.estimate_size(self.entries)
+        cache = ldapdb_cache.QueryCache(max_bytes=2 * size)
+        for key in ['first', 'second', 'third']:
+            cache.set(key, 'ou=groups,dc=example,dc=org', self.entries)
+
+        self.assertIsNone(cache.get('first', 'ou=groups,dc=example,dc=org'))
+        self.assertEqual(self.entries, cache.get('second', 'ou=groups,dc=example,dc=org'))
+        self.assertEqual(self.entries, cache.get('third', 'ou=groups,dc=example,dc=org'))
+        self.assertEqual(2 * size, cache.stats()['bytes'])
+
+    def test_invalidate(self):
+        cache = ldapdb_cache.QueryCache()
+        cache.set('root', 'dc=example,dc=org', self.entries)
+        cache.set('groups', 'ou=groups,dc=example,dc=org', self.entries)
+        cache.set('contacts', 'ou=contacts,ou=groups,dc=example,dc=org', self.entries)
+        cache.set('people', 'ou=people,dc=example,dc=org', self.entries)
+
+        # Searches whose subtree includes the modified entry are dropped.
+        cache.invalidate('cn=foo,ou=groups,dc=example,dc=org')
+        self.assertIsNone(cache.get('root', 'dc=example,dc=org'))
+        self.assertIsNone(cache.get('groups', 'ou=groups,dc=example,dc=org'))
+        self.assertIsNotNone(cache.get('contacts', 'ou=contacts,ou=groups,dc=example,dc=org'))
+        self.assertIsNotNone(cache.get('people', 'ou=people,dc=example,dc=org'))
+
+        # As well as searches below a moved subtree.
+        cache.invalidate('ou=groups,dc=example,dc=org', subtree=True)
+        self.assertIsNone(cache.get('contacts', 'ou=contacts,ou=groups,dc=example,dc=org'))
+        self.assertIsNotNone(cache.get('people', 'ou=people,dc=example,dc=org'))
+
+    def test_invalidate_many(self):
+        cache = ldapdb_cache.QueryCache()
+        cache.set('root', 'dc=example,dc=org', self.entries)
+        cache.set('contacts', 'ou=contacts,ou=groups,dc=example,dc=org', self.entries)
+        cache.set('people', 'ou=people,dc=example,dc=org', self.entries)
+        cache.set('rooms', 'ou=rooms,dc=example,dc=org', self.entries)
+
+        cache.invalidate_many([
+            'cn=foo,ou=contacts,ou=groups,dc=example,dc=org',
+            'UID=Bar,ou=people,dc=example,dc=org',
+        ])
+        self.assertIsNone(cache.get('root', 'dc=example,dc=org'))
+        self.assertIsNone(cache.get('contacts', 'ou=contacts,ou=groups,dc=example,dc=org'))
+        self.assertIsNone(cache.get('people', 'ou=people,dc=example,dc=org'))
+        self.assertIsNotNone(cache.get('rooms', 'ou=rooms,dc=example,dc=org'))
+
+    def test_version(self):
+        cache = ldapdb_cache.QueryCache()
+        version = cache.version('ou=groups,dc=example,dc=org')
+        cache.invalidate('cn=foo,ou=groups,dc=example,dc=org')
+        # Results fetched before the invalidation are not cached.
+        cache.set('key', 'ou=groups,dc=example,dc=org', self.entries, version=version)
+        self.assertIsNone(cache.get('key', 'ou=groups,dc=example,dc=org'))
+
+    def test_common_ancestor(self):
+        self.assertEqual(
+            'ou=groups,dc=example,dc=org',
+            ldapdb_cache.common_ancestor(['OU=Groups,dc=example,dc=org']),
+        )
+        self.assertEqual(
+            'dc=example,dc=org',
+            ldapdb_cache.common_ancestor(['ou=a,ou=groups,dc=example,dc=org', 'ou=people,dc=example,dc=org']),
+        )
+        self.assertEqual(
+            'ou=groups,dc=example,dc=org',
+            ldapdb_cache.common_ancestor(['ou=a,ou=groups,dc=example,dc=org', 'ou=groups,dc=example,dc=org']),
+        )
+        self.assertEqual('', ldapdb_cache.common_ancestor(['dc=example,dc=org', 'dc=example,dc=com']))
+
+
+class DjangoCacheTests(TestCase):
+    entries = [('cn=foo,ou=groups,dc=example,dc=org', {'cn': [b'foo'], 'memberUid': [b'alice'] * 1000})]
+
+    def setUp(self):
+        super().setUp()
+        self.cache = ldapdb_cache.DjangoCache('default', key_prefix='ldapdb-tests')
+        self.cache.cache.clear()
+
+    def test_get_set(self):
+        base = 'ou=groups,dc=example,dc=org'
+        self.assertIsNone(self.cache.get('key', base))
+        self.cache.set('key', base, self.entries)
+        self.assertEqual(self.entries, self.cache.get('key', base))
+        self.assertEqual({'hits': 1, 'misses': 1}, self.cache.stats())
+
+    def test_serialization(self):
+        for entries in [[], [('cn=foo,dc=example,dc=org', {'cn': [b'foo']})], self.entries]:
+            with self.subTest(size=len(entries)):
+                self.assertEqual(entries, self.cache.loads(self.cache.dumps(entries)))
+
+    def test_invalidate(self):
+        bases = [
+            'dc=example,dc=org',
+            'ou=groups,dc=example,dc=org',
+            'ou=contacts,ou=groups,dc=example,dc=org',
+            'ou=people,dc=example,dc=org',
+        ]
+
+        def cached():
+            return [self.cache.get('key', base) is not None for base in bases]
+
+        for base in bases:
+            self.cache.set('key', base, self.entries)
+        self.cache.invalidate('cn=foo,ou=groups,dc=example,dc=org')
+        self.assertEqual([False, False, True, True], cached())
+
+        for base in bases:
+            self.cache.set('key', base, self.entries)
+        self.cache.invalidate('ou=groups,dc=example,dc=org', subtree=True)
+        self.assertEqual([False, False, False, True], cached())
+
+        self.cache.clear()
+        self.assertEqual([False, False, False, False], cached())
+
+    def test_invalidate_many(self):
+        base = 'ou=groups,dc=example,dc=org'
+        self.cache.set('key', base, self.entries)
+        self.cache.set('key', 'ou=people,dc=example,dc=org', self.entries)
+        dns = ['cn=group%d,ou=groups,dc=example,dc=org' % i for i in range(10)]
+        with mock.patch.object(self.cache, '_bump', wraps=self.cache._bump) as bump:
+            self.cache.invalidate_many(dns)
+        # Each entry, and each of their 4 common ancestors up to the root DSE, once
+        self.assertEqual(10 + 4, bump.call_count)
+        self.assertIsNone(self.cache.get('key', base))
+        self.assertIsNotNone(self.cache.get('key', 'ou=people,dc=example,dc=org'))
+
+    def test_version(self):
+        base = 'ou=groups,dc=example,dc=org'
+        version = self.cache.version(base)
+        self.cache.invalidate('cn=foo,ou=groups,dc=example,dc=org')
+        self.cache.set('key', base, self.entries, version=version)
+        self.assertIsNone(self.cache.get('key', base))
+
+    def test_evicted_generation(self):
+        base = 'ou=groups,dc=example,dc=org'
+        self.cache.invalidate('cn=foo,ou=groups,dc=example,dc=org')
+        self.cache.set('key', base, self.entries)
+        # Generations lost from the cache don't bring back older results.
+        self.cache.cache.delete(self.cache._generation_key('gen', base))
+        self.cache.invalidate('cn=foo,ou=groups,dc=example,dc=org')
+        self.assertIsNone(self.cache.get('key', base))
+
+
+class ReplicaCacheTests(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(ldapdb_cache.clear_query_caches)
+
+    def _wrappers(self, **cache_settings):
+        """Build a primary database and its replica, both connected."""
+        settings_dict = dict(connections['ldap'].settings_dict, **cache_settings)
+        primary = ldapdb_base.DatabaseWrapper(dict(settings_dict, REPLICAS=['ldap-replica']), alias='ldap')
+        replica = ldapdb_base.DatabaseWrapper(dict(settings_dict, NAME='ldap://replica/'), alias='ldap-replica')
+        databases = dict(settings.DATABASES, **{'ldap': primary.settings_dict, 'ldap-replica': replica.settings_dict})
+        patches = [
+            mock.patch.object(settings, 'DATABASES', databases),
+            mock.patch.object(ldapdb_base, 'connections', {'ldap': primary, 'ldap-replica': replica}),
+            mock.patch.object(ldapdb_base.DatabaseWrapper, '_open_connection'),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        for wrapper in [primary, replica]:
+            wrapper.get_new_connection(wrapper.get_connection_params())
+        return primary, replica
+
+    def test_shared_query_cache(self):
+        primary, replica = self._wrappers(QUERY_CACHE={})
+        self.assertEqual('ldap', replica.get_primary_alias())
+        self.assertIs(primary.query_cache, replica.query_cache)
+
+        primary, replica = self._wrappers(QUERY_CACHE={'CACHE_ALIAS': 'default'})
+        self.assertEqual(primary.query_cache.key_prefix, replica.query_cache.key_prefix)
+
+    def test_invalidate_replicas(self):
+        primary, replica = self._wrappers(ENTRY_CACHE={})
+        dn = 'cn=foo,ou=groups,dc=example,dc=org'
+        key = replica.entry_cache.make_key(dn, '(objectClass=*)', None)
+        replica.entry_cache.set(key, dn, [(dn, {})])
+
+        # Writes to the primary invalidate results read from the replica.
+        primary._invalidate(dn)
+        self.assertIsNone(replica.entry_cache.get(key, dn))
+
+
+class ServerHealthTests(TestCase):
+    def test_latency(self):
+        health = ldapdb_health.ServerHealth(smoothing=0.5)
+        self.assertIsNone(health.latency)
+        health.record_latency(0.2)
+        self.assertEqual(0.2, health.latency)
+        health.record_latency(0.4)
+        self.assertAlmostEqual(0.3, health.latency)
+
+    def test_ejected(self):
+        health = ldapdb_health.ServerHealth()
+        self.assertFalse(health.ejected(30))
+        health.failure()
+        self.assertTrue(health.ejected(30))
+        self.assertFalse(health.ejected(0))
+        # Back as soon as it answers again
+        health.record_latency(0.1)
+        self.assertFalse(health.ejected(30))
+
+
+class CircuitBreakerTests(TestCase):
+    def test_open(self):
+        breaker = ldapdb_health.CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        self.assertTrue(breaker.allow())
+        breaker.failure()
+        self.assertEqual('closed', breaker.state)
+        breaker.failure()
+        self.assertEqual('open', breaker.state)
+        self.assertFalse(breaker.allow())
+
+    def test_half_open(self):
+        breaker = ldapdb_health.CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        breaker.failure()
+        self.assertEqual('half-open', breaker.state)
+        # A single attempt is let through
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.failure()
+        self.assertEqual(2, breaker.trips)
+
+        self.assertTrue(breaker.allow())
+        breaker.success()
+        self.assertEqual('closed', breaker.state)
+        self.assertEqual(0, breaker.trips)
+
+    def test_reset_timeout(self):
+        breaker = ldapdb_health.CircuitBreaker(failure_threshold=1, reset_timeout=10, max_reset_timeout=25)
+        with mock.patch.object(ldapdb_health.time, 'monotonic', return_value=1000):
+            for timeout in [10, 20, 25, 25]:
+                breaker.failure()
+                self.assertGreaterEqual(breaker.open_until, 1000 + timeout / 2)
+                self.assertLessEqual(breaker.open_until, 1000 + timeout)
+
+    def test_backoff_delay(self):
+        for attempt, maximum in [(1, 1), (2, 2), (3, 4), (10, 30)]:
+            delay = ldapdb_health.backoff_delay(attempt, 1, 30)
+            self.assertGreaterEqual(delay, 0)
+            self.assertLessEqual(delay, maximum)
+
+
+class FailoverTests(TestCase):
+    def setUp(self):
+        super().setUp()
+        ldapdb_health.clear_breakers()
+        self.addCleanup(ldapdb_health.clear_breakers)
+
+    def _conn_params(self, **params):
+        conn_params = connections['ldap'].get_connection_params()
+        conn_params.update(uris=['ldap://a', 'ldap://b'], **params)
+        return conn_params
+
+    def _open(self, conn_params, down=()):
+        attempts = []
+
+        def connect(uri, conn_params):
+            attempts.append(uri)
+            if uri in down:
+                raise ldap.SERVER_DOWN({'desc': "Can't contact LDAP server"})
+            return uri
+
+        with mock.patch.object(ldapdb_base.DatabaseWrapper, '_connect', side_effect=connect):
+            try:
+                return ldapdb_base.DatabaseWrapper._open_connection(conn_params), attempts
+            except ldap.SERVER_DOWN:
+                return None, attempts
+
+    def test_uris(self):
+        with mock.patch.dict(settings.DATABASES['ldap'], NAME='ldap://a  ldap://b'):
+            conn_params = connections['ldap'].get_connection_params()
+        self.assertEqual(['ldap://a', 'ldap://b'], conn_params['uris'])
+        self.assertEqual('ldap://a ldap://b', conn_params['uri'])
+
+    def test_ordered(self):
+        self.assertEqual(('ldap://a', ['ldap://a']), self._open(self._conn_params()))
+        self.assertEqual(
+            ('ldap://b', ['ldap://a', 'ldap://b']),
+            self._open(self._conn_params(), down=['ldap://a']),
+        )
+
+    def test_random(self):
+        servers = {self._open(self._conn_params(failover='random'))[0] for _i in range(50)}
+        self.assertEqual({'ldap://a', 'ldap://b'}, servers)
+
+    def test_invalid_failover(self):
+        with self.assertRaises(ImproperlyConfigured):
+            self._open(self._conn_params(failover='latency'))
+
+    def test_retries(self):
+        conn_params = self._conn_params(retry_max=3, retry_delay=0.01, retry_delay_max=0.01)
+        with mock.patch.object(ldapdb_base.time, 'sleep') as sleep:
+            connection, attempts = self._open(conn_params, down=['ldap://a', 'ldap://b'])
+        self.assertIsNone(connection)
+        self.assertEqual(['ldap://a', 'ldap://b'] * 3, attempts)
+        self.assertEqual(2, sleep.call_count)
+
+    def test_circuit_breaker(self):
+        conn_params = self._conn_params(circuit_breaker={'FAILURE_THRESHOLD': 1, 'RESET_TIMEOUT': 60})
+        self.assertEqual(
+            ('ldap://b', ['ldap://a', 'ldap://b']),
+            self._open(conn_params, down=['ldap://a']),
+        )
+        # The first server is skipped while its breaker is open
+        self.assertEqual(('ldap://b', ['ldap://b']), self._open(conn_params, down=['ldap://a']))
+
+        # Fail fast once all breakers are open
+        self._open(conn_params, down=['ldap://b'])
+        conn_params['retry_max'] = 5
+        with mock.patch.object(ldapdb_base.time, 'sleep') as sleep:
+            self.assertEqual((None, []), self._open(conn_params))
+        sleep.assert_not_called()
+
+
+class ReplicaRouterTests(TestCase):
+    def setUp(self):
+        super().setUp()
+        ldapdb_health.clear_health()
+        router.reset_last_write()
+        self.addCleanup(ldapdb_health.clear_health)
+        self.addCleanup(router.reset_last_write)
+        # Connections to the replicas, checked before reads are sent to them
+        self.connections = {'ldap-replica1': mock.Mock(), 'ldap-replica2': mock.Mock()}
+        patcher = mock.patch.object(router, 'connections', self.connections)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _router(self, **options):
+        replica_settings = dict(settings.DATABASES['ldap'])
+        databases = {
+            # Replicas may be declared before the primary
+            'ldap-replica1': replica_settings,
+            'ldap-replica2': replica_settings,
+        }
+        databases.update(settings.DATABASES)
+        databases['ldap'] = dict(settings.DATABASES['ldap'], REPLICAS=['ldap-replica1', 'ldap-replica2'], **options)
+        with mock.patch.object(settings, 'DATABASES', databases):
+            return router.ReplicaRouter()
+
+    def test_routing(self):
+        replica_router = self._router(READ_YOUR_WRITES_WINDOW=0)
+        self.assertEqual('ldap', replica_router.db_for_write(FakeModel))
+        self.assertIn(replica_router.db_for_read(FakeModel), ['ldap-replica1', 'ldap-replica2'])
+        # Other models are left to other routers
+        self.assertIsNone(replica_router.db_for_read(auth_models.Group))
+
+        self.assertFalse(replica_router.allow_migrate('ldap-replica1', 'examples'))
+        self.assertIsNone(replica_router.allow_migrate('default', 'examples'))
+
+    def test_read_your_writes(self):
+        replica_router = self._router(READ_YOUR_WRITES_WINDOW=60)
+        self.assertNotEqual('ldap', replica_router.db_for_read(FakeModel))
+        # Routing a write isn't enough, e.g. for the read of get_or_create().
+        replica_router.db_for_write(FakeModel)
+        self.assertNotEqual('ldap', replica_router.db_for_read(FakeModel))
+
+        connection = connections['ldap']
+        wrapper = connection.__class__(dict(connection.settings_dict, LIVENESS_CHECK='none'), alias='ldap')
+        wrapper.connection = mock.Mock()
+        try:
+            wrapper.modify_s('cn=foo,dc=example,dc=org', [])
+        finally:
+            wrapper.connection = None
+        self.assertEqual('ldap', replica_router.db_for_read(FakeModel))
+
+        # A new request starts
+        router.reset_last_write()
+        self.assertNotEqual('ldap', replica_router.db_for_read(FakeModel))
+
+    def test_ejection(self):
+        replica_router = self._router(REPLICA_EJECT_TIME=60)
+        ldapdb_health.get_health('ldap-replica1').failure()
+        self.assertEqual({'ldap-replica2'}, {replica_router.db_for_read(FakeModel) for _i in range(20)})
+
+        ldapdb_health.get_health('ldap-replica2').failure()
+        self.assertEqual('ldap', replica_router.db_for_read(FakeModel))
+
+    def test_unreachable(self):
+        replica_router = self._router(REPLICA_EJECT_TIME=60)
+        self.connections['ldap-replica1'].ensure_connection.side_effect = ldap.SERVER_DOWN({
+            'desc': "Can't contact LDAP server",
+        })
+        self.assertEqual({'ldap-replica2'}, {replica_router.db_for_read(FakeModel) for _i in range(20)})
+        self.assertTrue(ldapdb_health.get_health('ldap-replica1').ejected(60))
+
+        self.connections['ldap-replica2'].ensure_connection.side_effect = ldap.SERVER_DOWN({
+            'desc': "Can't contact LDAP server",
+        })
+        ldapdb_health.clear_health()
+        self.assertEqual('ldap', replica_router.db_for_read(FakeModel))
 
-        sql = "SELECT COUNT(*) FROM (SELECT examples_ldapgroup.cn AS Col1 FROM examples_ldapgroup ORDER BY examples_ldapgroup.gidNumber ASC LIMIT 2) subquery"  # noqa: E501
-        match = self._run_regex(sql)
-        self.assertEqual(match.group('limit'), '2')
+    def test_least_outstanding(self):
+        replica_router = self._router(REPLICA_SELECTION='least_outstanding')
+        ldapdb_health.get_health('ldap-replica1').begin()
+        self.assertEqual('ldap-replica2', replica_router.db_for_read(FakeModel))
+        ldapdb_health.get_health('ldap-replica2').begin()
+        ldapdb_health.get_health('ldap-replica2').begin()
+        self.assertEqual('ldap-replica1', replica_router.db_for_read(FakeModel))
 
-        sql = "SELECT COUNT(*) FROM (SELECT examples_ldapgroup.cn AS Col1 FROM examples_ldapgroup ORDER BY examples_ldapgroup.gidNumber ASC LIMIT -1 OFFSET 1) subquery"  # noqa: E501
-        match = self._run_regex(sql)
-        self.assertEqual(match.group('limit'), '-1')
-        self.assertEqual(match.group('offset'), '1')
+    def test_latency(self):
+        replica_router = self._router()
+        ldapdb_health.get_health('ldap-replica1').record_latency(0.001)
+        ldapdb_health.get_health('ldap-replica2').record_latency(1.0)
+        reads = [replica_router.db_for_read(FakeModel) for _i in range(100)]
+        self.assertGreater(reads.count('ldap-replica1'), 90)
 
-    def test_regex_django22(self):
-        sql = "SELECT examples_ldapgroup.cn AS Col1 FROM examples_ldapgroup ORDER BY examples_ldapgroup.gidNumber ASC  LIMIT 2"  # noqa: E501
-        match = self._run_regex(sql)
-        self.assertEqual(match.group('limit'), '2')
-        self.assertEqual(match.group('offset'), None)
+    def test_invalid_selection(self):
+        with self.assertRaises(ImproperlyConfigured):
+            self._router(REPLICA_SELECTION='random')